@@ -101,12 +101,24 @@ function receiveServerMessage(event) {
 
   switch(cmd) {
     case "MOV":
-      if(arg.id != PlayerYou || !arg.from) {
+      if(arg.list) {
+        // batched movement: [id, x, y] or [id, x, y, from x, from y]
+        for(let move of arg.list) {
+          if((move[0] != PlayerYou || move.length <= 3) && PlayerWho[move[0]]) {
+            PlayerWho[move[0]].x = move[1];
+            PlayerWho[move[0]].y = move[2];
+          }
+        }
+        NeedMapRedraw = true;
+      } else if(arg.id != PlayerYou || !arg.from) {
         PlayerWho[arg.id].x = arg.to[0];
         PlayerWho[arg.id].y = arg.to[1];
         NeedMapRedraw = true;
       }
       break;
+    case "LOD":
+      logMessage("Loading map "+arg.id+"...", 'server_message');
+      break;
     case "MAI":
       MapWidth = arg.size[0];
       MapHeight = arg.size[1];
@@ -137,6 +149,24 @@ function receiveServerMessage(event) {
         MapObjs[obj[0]][obj[1]] = obj[2];
       }
 
+      NeedMapRedraw = true;
+      break;
+    case "DIF":
+      for (var key in arg.edits) {
+        var edit = arg.edits[key];
+        var tile = edit[5];
+        if(edit[0] == "turf" && tile === null)
+          tile = AtomFromName(MapInfo['default']);
+        // apply rectangle
+        for(var x = edit[1]; x <= edit[3]; x++) {
+          for(var y = edit[2]; y <= edit[4]; y++) {
+            if(edit[0] == "turf")
+              MapTiles[x][y] = tile;
+            else
+              MapObjs[x][y] = (tile === null) ? [] : tile.slice(); // separate lists, since they get added to
+          }
+        }
+      }
       NeedMapRedraw = true;
       break;
     case "BLK":
@@ -270,16 +300,20 @@ function receiveServerMessage(event) {
     case "EML":
       if(arg['receive']) {
           logMessage("You've got mail! (from "+arg.receive['from']+")", 'server_message');
-          Mail.push(arg['receive']);
+          Mail.unshift(arg['receive']);
       } else if(arg['list']) {
+          // newest first, with older mail requested a page at a time
           Mail = arg['list'];
-          let unread = 0;
-          for(let i=0; i<Mail.length; i++) {
-            if(!(Mail[i].flags & 1)) {
-              unread++;
-            }
+          MailNextPage = arg['next'];
+          MailPageRequested = false;
+          logMessage("You've got mail! ("+arg['total']+" messages, "+arg['unread']+" unread)", 'server_message');
+      } else if(arg['page']) {
+          // if the page was asked for twice, only add it once
+          if(MailPageRequested) {
+            Mail = Mail.concat(arg['page']);
+            MailNextPage = arg['next'];
+            MailPageRequested = false;
           }
-          logMessage("You've got mail! ("+Mail.length+" messages, "+unread+" unread)", 'server_message');
       } else if(arg['sent']) {
         closeWindow("mailcompose");
       }
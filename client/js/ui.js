@@ -20,6 +20,8 @@ var PlayerWho = {me: {name: "Player", pic: [0, 2, 25], x: 5, y: 5}};
 var PlayerYou = "me";
 var PlayerImages = {}; // dictionary of Image objects
 var Mail = [];
+var MailNextPage = null; // mail ID to ask for older mail with, if there is any
+var MailPageRequested = false; // asked for older mail and waiting for it
 
 // camera settings
 var ViewWidth;
@@ -1044,6 +1046,21 @@ function updateMailUL() {
     li.id = "maillist"+i;
     ul.appendChild(li);
   }
+
+  if(MailNextPage != null) {
+    let li = document.createElement("li");
+    li.appendChild(document.createTextNode(MailPageRequested ? "(Loading older mail...)" : "(Older mail...)"));
+    li.onclick = function (){
+      // keep the cursor until the page arrives, so it can be asked for again if the request got dropped
+      if(MailPageRequested && !confirm("Still waiting for older mail. Ask again?"))
+        return;
+      SendCmd("EML", {page: MailNextPage});
+      MailPageRequested = true;
+      updateMailUL();
+    };
+    li.classList.add('inventoryli');
+    ul.appendChild(li);
+  }
 }
 
 function previewMail() {
@@ -0,0 +1,51 @@
+#!/bin/python3
+# Measure the cost of Map.broadcast for a MOV message as the number of
+# users on the map grows, against encoding the message once per user.
+
+import os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# buildglobal opens the config and database from the current directory
+os.chdir(tempfile.mkdtemp())
+sys.argv = sys.argv[:1]
+from tilemaptown_server.buildglobal import makeCommand
+from tilemaptown_server.buildmap import Map
+
+class FakeClient(object):
+	def __init__(self, id):
+		self.id = id
+		self.map_id = 0
+		self.bytes_sent = 0
+		self.binary_protocol = False
+
+	def send(self, commandType, commandParams):
+		self.send_raw(makeCommand(commandType, commandParams))
+
+	def send_raw(self, text, key=None):
+		self.bytes_sent += len(text)
+
+def broadcastPerUser(map, commandType, commandParams):
+	""" How Map.broadcast used to work: one encode per user """
+	for client in map.users:
+		client.send(commandType, commandParams)
+
+def timeIt(function, repeat):
+	start = time.perf_counter()
+	for i in range(repeat):
+		function()
+	return (time.perf_counter() - start) / repeat
+
+def main():
+	repeat = 200
+	print("%6s %16s %16s" % ("users", "per-user (us)", "encode-once (us)"))
+	for count in [1, 10, 50, 100, 250, 500, 1000]:
+		m = Map()
+		for i in range(count):
+			m.users.add(FakeClient(i))
+		params = {'id': 1, 'from': [5, 5], 'to': [6, 5]}
+		old = timeIt(lambda: broadcastPerUser(m, "MOV", params), repeat)
+		new = timeIt(lambda: m.broadcast("MOV", params), repeat)
+		print("%6d %16.1f %16.1f" % (count, old * 1000000, new * 1000000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,61 @@
+#!/bin/python3
+# Throughput of BLK messages like the ones building bots send: thousands of
+# rectangles using a small set of tiles, many of them custom dictionary tiles.
+# Compares checking every entry and filling cell by cell, the way BLK used to
+# work, against bulkEdits plus Map.edit.
+
+import os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# buildglobal opens the config and database from the current directory
+os.chdir(tempfile.mkdtemp())
+sys.argv = sys.argv[:1]
+from tilemaptown_server.buildglobal import Config
+from tilemaptown_server.buildmap import Map, tileIsOkay
+from tilemaptown_server.bulkbuild import bulkEdits
+
+def makeBulkBuild(count, width, height, seed=1):
+	rng = random.Random(seed)
+	turf_tiles = ['grass', 'dirt', 'sand', 'water'] + [{'name': 'custom%d' % i, 'pic': [0, i, 0]} for i in range(8)]
+	obj_tiles = [['tree'], ['bush'], [{'name': 'sign', 'pic': [0, 1, 1]}], [{'name': 'lamp', 'pic': [0, 2, 1]}, 'flower']]
+	arg = {'turf': [], 'obj': []}
+	for i in range(count):
+		arg['turf'].append([rng.randint(0, width-1), rng.randint(0, height-1), rng.choice(turf_tiles), rng.randint(1, 16), rng.randint(1, 16)])
+		arg['obj'].append([rng.randint(0, width-1), rng.randint(0, height-1), rng.choice(obj_tiles), rng.randint(1, 4), rng.randint(1, 4)])
+	return arg
+
+def applyPerCell(map, arg):
+	""" Check every entry, then set each cell one at a time """
+	for turf in arg['turf']:
+		if not tileIsOkay(turf[2])[0]:
+			return
+	for obj in arg['obj']:
+		if any(not tileIsOkay(t)[0] for t in obj[2]):
+			return
+	for layer, grid in (('turf', map.turfs), ('obj', map.objs)):
+		for rect in arg[layer]:
+			for w in range(rect[3]):
+				for h in range(rect[4]):
+					if rect[0]+w < map.width and rect[1]+h < map.height:
+						grid.set(rect[0]+w, rect[1]+h, rect[2])
+
+def applyBulk(map, arg):
+	edits, error = bulkEdits(arg, map.width, map.height, tileIsOkay, 0)
+	map.edit(edits, "BLK")
+
+def measure(function, size, arg):
+	map = Map(size, size)
+	start = time.perf_counter()
+	function(map, arg)
+	return time.perf_counter() - start
+
+def main():
+	for size, count in [(100, 1000), (1000, 10000), (1000, 50000)]:
+		arg = makeBulkBuild(count, size, size)
+		print("%dx%d map, %d turf and %d object rectangles" % (size, size, count, count))
+		for name, function in (('per cell', applyPerCell), ('bulkEdits', applyBulk)):
+			elapsed = measure(function, size, arg)
+			print("  %-10s %9.2f ms  %10.0f rectangles/s" % (name, elapsed * 1000, count * 2 / elapsed))
+
+if __name__ == "__main__":
+	main()
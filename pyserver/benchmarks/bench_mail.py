@@ -0,0 +1,86 @@
+#!/bin/python3
+# Compare loading an inbox the old way, looking up the sender and every recipient
+# of every message one query at a time, with loading it a page at a time through
+# the mail module, and sending to many people one row at a time or all together.
+
+import datetime, os, random, sqlite3, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tilemaptown_server.migrations import migrateDatabase
+from tilemaptown_server.mail import loadMailPage, sendMail
+
+def populate(connection, users, inbox, recipients):
+	random.seed(1)
+	now = datetime.datetime.now()
+	connection.executemany("INSERT INTO User (uid, username, name, passhash, passalgo, regtime) VALUES (?, ?, ?, '', 'sha512', ?)",
+		((i, 'user%d' % i, 'User %d' % i, now) for i in range(1, users+1)))
+	def mail():
+		to = [1] + random.sample(range(2, users+1), recipients-1)
+		return (1, random.randint(2, users), ','.join(str(x) for x in to), 'hello', 'contents', now, 0)
+	connection.executemany("INSERT INTO Mail (uid, sender, recipients, subject, contents, time, flags) VALUES (?, ?, ?, ?, ?, ?, ?)", (mail() for i in range(inbox)))
+	connection.commit()
+
+def findUsernameByDBId(connection, dbid):
+	result = connection.execute('SELECT username FROM User WHERE uid=?', (dbid,)).fetchone()
+	return result[0] if result != None else None
+
+def oldLoad(connection, uid):
+	mail = []
+	for row in connection.execute('SELECT id, sender, recipients, subject, contents, flags FROM Mail WHERE uid=?', (uid,)).fetchall():
+		mail.append({'id': row[0], 'from': findUsernameByDBId(connection, row[1]),
+		'to': [findUsernameByDBId(connection, int(x)) for x in row[2].split(',')],
+		'subject': row[3], 'contents': row[4], 'flags': row[5]})
+	return mail
+
+def newLoad(connection, uid, page_size):
+	mail = []
+	before = None
+	while True:
+		page, before = loadMailPage(connection, uid, before, page_size)
+		mail.extend(page)
+		if before == None:
+			return mail
+
+def oldSend(connection, sender, usernames):
+	ids = [connection.execute('SELECT uid FROM User WHERE username=?', (x,)).fetchone()[0] for x in usernames]
+	recipient_string = ','.join(str(x) for x in ids)
+	for id in ids:
+		connection.execute("INSERT INTO Mail (uid, sender, recipients, subject, contents, time, flags) VALUES (?, ?, ?, ?, ?, ?, ?)", (id, sender, recipient_string, 'hi', 'text', datetime.datetime.now(), 0)).lastrowid
+
+def timed(function, *args):
+	queries = [0]
+	args[0].set_trace_callback(lambda sql: queries.__setitem__(0, queries[0]+1))
+	start = time.perf_counter()
+	result = function(*args)
+	elapsed = (time.perf_counter() - start) * 1000
+	args[0].set_trace_callback(None)
+	return result, elapsed, queries[0]
+
+def main():
+	inbox = int(sys.argv[1]) if len(sys.argv) >= 2 else 500
+	recipients = 5
+	path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	connection = sqlite3.connect(path)
+	migrateDatabase(connection)
+	populate(connection, 10000, inbox, recipients)
+	print("%d messages in the inbox, %d recipients each" % (inbox, recipients))
+
+	old, old_ms, old_queries = timed(oldLoad, connection, 1)
+	first, first_ms, first_queries = timed(loadMailPage, connection, 1, None, 50)
+	new, new_ms, new_queries = timed(newLoad, connection, 1, 50)
+	assert sorted(old, key=lambda x: x['id']) == sorted(new, key=lambda x: x['id'])
+	print("%-30s %10s %8s" % ("", "ms", "queries"))
+	print("%-30s %10.2f %8d" % ("load inbox, one at a time", old_ms, old_queries))
+	print("%-30s %10.2f %8d" % ("load first page of 50", first_ms, first_queries))
+	print("%-30s %10.2f %8d" % ("load every page of 50", new_ms, new_queries))
+
+	usernames = ['user%d' % i for i in range(2, 202)]
+	_, old_ms, old_queries = timed(oldSend, connection, 1, usernames)
+	_, new_ms, new_queries = timed(sendMail, connection, 1, usernames, 'hi', 'text')
+	print("%-30s %10.2f %8d" % ("send to 200, one at a time", old_ms, old_queries))
+	print("%-30s %10.2f %8d" % ("send to 200, all together", new_ms, new_queries))
+	connection.close()
+	os.remove(path)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,66 @@
+#!/bin/python3
+# Users wandering between maps with different Server.MapCacheBytes budgets:
+# how many map loads the warm map cache saves, and how long joining takes.
+# A budget of 0, or one smaller than a single map, must still let people in
+# instead of unloading the map they're waiting for as soon as it's loaded.
+
+import asyncio, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# buildglobal opens the config and database from the current directory
+os.chdir(tempfile.mkdtemp())
+sys.argv = sys.argv[:1]
+from tilemaptown_server.buildglobal import *
+from tilemaptown_server.migrations import migrateDatabase
+
+class FakeClient(object):
+	def __init__(self, id):
+		self.id = id
+		self.map = None
+
+async def join(client, map_id):
+	""" The parts of Client.switch_map that matter to the cache """
+	new_map = await asyncio.wait_for(getMapById(map_id), 5)
+	MapCache.take(new_map)
+	if client.map != None:
+		client.map.users.discard(client)
+		client.map.schedule_unload()
+	new_map.users.add(client)
+	client.map = new_map
+
+async def wander(budget, users, maps, moves):
+	Config["Server"]["MapCacheBytes"] = budget
+	random.seed(1)
+	clients = [FakeClient(i) for i in range(users)]
+	loads_before = MapCache.stats['misses']
+	start = time.perf_counter()
+	try:
+		for i in range(moves):
+			await join(random.choice(clients), random.randint(1, maps))
+	except asyncio.TimeoutError:
+		return None
+	elapsed = (time.perf_counter() - start) * 1000 / moves
+	for c in clients:
+		if c.map != None:
+			c.map.users.discard(c)
+			c.map.schedule_unload()
+	return MapCache.stats['misses'] - loads_before, elapsed
+
+async def main():
+	migrateDatabase(Database)
+	Config["Server"]["MapUnloadDelay"] = 300
+	Config["Server"]["AlwaysLoadedMaps"] = []
+	one_map = (await getMapById(1)).memory_size()
+	print("%12s %8s %12s" % ("budget", "loads", "ms per join"))
+	for budget in [0, one_map // 2, one_map * 4, one_map * 100]:
+		result = await wander(budget, 20, 30, 500)
+		if result == None:
+			print("%12d   stuck, the map never finished joining" % budget)
+		else:
+			print("%12d %8d %12.3f" % (budget, result[0], result[1]))
+		# Start each budget with nothing warm
+		for map_id in list(MapCache.maps):
+			MapCache.unload(map_id)
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -0,0 +1,50 @@
+#!/bin/python3
+# Compare the size and load/save speed of the JSON and binary map formats.
+# Pass a database file to also measure every map saved in it, like:
+#   python3 bench_mapformat.py town.db
+
+import os, sqlite3, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tilemaptown_server.mapchunks import MapChunks
+from tilemaptown_server.mapformat import isBinaryMapData, encodeMapData, decodeMapData
+from bench_tilestorage import makeMapData, loadGrids
+
+def timed(function, *args):
+	start = time.perf_counter()
+	result = function(*args)
+	return result, (time.perf_counter() - start) * 1000
+
+def saveJSON(width, height, turfs, objs):
+	return MapChunks(width, height).encode_map(turfs, objs, 'grass')
+
+def compare(label, text):
+	(turfs, objs), json_load = timed(loadGrids, 'array', text)
+	width, height = turfs.width, turfs.height
+	json_text, json_save = timed(saveJSON, width, height, turfs, objs)
+	blob, binary_save = timed(encodeMapData, width, height, turfs, objs)
+	_, binary_load = timed(decodeMapData, blob, 'array')
+	# Saving only copies the grids on the event loop; the encode runs on the database thread
+	_, snapshot = timed(lambda: (turfs.snapshot(), objs.snapshot()))
+	print("%s (%dx%d)" % (label, width, height))
+	print("  json   %10d bytes  load %8.2f ms  save %8.2f ms" % (len(json_text), json_load, json_save))
+	print("  binary %10d bytes  load %8.2f ms  save %8.2f ms  event loop %.2f ms" % (len(blob), binary_load, binary_save, snapshot))
+
+def main():
+	for width, height in [(100, 100), (1000, 1000)]:
+		compare("Generated map", makeMapData(width, height))
+
+	if len(sys.argv) >= 2:
+		database = sqlite3.connect(sys.argv[1])
+		for mid, name, data in database.execute('SELECT mid, name, data FROM Map'):
+			if isBinaryMapData(data):
+				# Measure it the way it would have been saved before
+				width, height, turfs, objs = decodeMapData(data, 'array')
+				data = saveJSON(width, height, turfs, objs)
+			try:
+				compare("Map %d, %s" % (mid, name), data)
+			except (KeyError, ValueError):
+				print("Map %d, %s has no map data" % (mid, name))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,78 @@
+#!/bin/python3
+# Time the server's most common queries on a generated database with 100k users
+# and 50k assets, before and after the schema migrations that add indexes.
+# Pass a number to scale the database, like:
+#   python3 bench_queries.py 0.1
+
+import datetime, os, random, sqlite3, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tilemaptown_server.migrations import migrateDatabase
+
+# name, SQL, function that makes parameters for it
+def makeQueries(users, maps):
+	def user():
+		return random.randint(1, users)
+	def username():
+		return ('user%d' % user(),)
+	return [
+		("findDBIdByUsername", 'SELECT uid FROM User WHERE username=?', username),
+		("login", 'SELECT uid, passhash, passalgo, username, name, pic, mid, map_x, map_y, home, watch, ignore, client_settings, tags FROM User WHERE username=?', username),
+		("login inventory", 'SELECT aid, name, desc, type, flags, folder, data FROM Asset_Info WHERE owner=?', lambda: (user(),)),
+		("login mail", 'SELECT id, sender, recipients, subject, contents, flags FROM Mail WHERE uid=?', lambda: (user(),)),
+		("move folder contents", 'UPDATE Asset_Info SET folder=? WHERE owner=? AND folder=?', lambda: (0, user(), 0)),
+		("mymaps", 'SELECT m.mid, m.name FROM Map m WHERE m.owner=?', lambda: (user(),)),
+		("publicmaps", 'SELECT m.mid, m.name, u.username FROM Map m, User u WHERE m.owner=u.uid and (m.flags&1)!=0', lambda: ()),
+		("map permissions", 'SELECT username, allow, deny FROM Map_Permission mp, User u WHERE mp.mid=? AND mp.uid=u.uid', lambda: (random.randint(1, maps),)),
+	]
+
+def populate(connection, users, assets, maps, mails):
+	random.seed(1)
+	now = datetime.datetime.now()
+	connection.executemany("INSERT INTO User (uid, username, name, passhash, passalgo, regtime, pic, mid, map_x, map_y, watch, ignore, tags) VALUES (?, ?, ?, '', 'sha512', ?, '[0, 2, 25]', 0, 5, 5, '[]', '[]', '{}')",
+		((i, 'user%d' % i, 'User %d' % i, now) for i in range(1, users+1)))
+	connection.executemany("INSERT INTO Asset_Info (aid, name, type, flags, creator, owner, folder, regtime) VALUES (?, ?, ?, 0, ?, ?, ?, ?)",
+		((i + 10, 'item %d' % i, random.randint(0, 6), owner, owner, random.choice([None, 0]), now) for i, owner in ((i, random.randint(1, users)) for i in range(assets))))
+	connection.executemany("INSERT INTO Map (mid, name, owner, flags, regtime, width, height) VALUES (?, ?, ?, ?, ?, 100, 100)",
+		((i, 'map %d' % i, random.randint(1, users), 1 if random.random() < 0.01 else 0, now) for i in range(1, maps+1)))
+	connection.executemany("INSERT OR IGNORE INTO Map_Permission (mid, uid, allow, deny) VALUES (?, ?, 1, 0)",
+		((random.randint(1, maps), random.randint(1, users)) for i in range(maps)))
+	connection.executemany("INSERT INTO Mail (uid, sender, recipients, subject, contents, time, flags) VALUES (?, ?, '', 'hello', 'contents', ?, 0)",
+		((random.randint(1, users), random.randint(1, users), now) for i in range(mails)))
+	connection.commit()
+
+def timeQueries(connection, queries, repeat):
+	results = {}
+	for name, sql, params in queries:
+		random.seed(2)
+		count = repeat if name != "publicmaps" else max(1, repeat // 10)
+		start = time.perf_counter()
+		for i in range(count):
+			connection.execute(sql, params()).fetchall()
+		results[name] = (time.perf_counter() - start) * 1000 / count
+	return results
+
+def main():
+	scale = float(sys.argv[1]) if len(sys.argv) >= 2 else 1
+	users, assets, maps, mails = int(100000 * scale), int(50000 * scale), int(20000 * scale), int(100000 * scale)
+	path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	connection = sqlite3.connect(path)
+	migrateDatabase(connection, target=1)
+	start = time.perf_counter()
+	populate(connection, users, assets, maps, mails)
+	print("%d users, %d assets, %d maps, %d mails generated in %.1f s" % (users, assets, maps, mails, time.perf_counter() - start))
+
+	queries = makeQueries(users, maps)
+	before = timeQueries(connection, queries, 50)
+	migrateDatabase(connection)
+	after = timeQueries(connection, queries, 50)
+
+	print("%-22s %12s %12s %8s  %s" % ("query", "before ms", "after ms", "speedup", "plan after"))
+	for name, sql, params in queries:
+		plan = '; '.join(row[3] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql, params()))
+		print("%-22s %12.3f %12.3f %7.0fx  %s" % (name, before[name], after[name], before[name] / max(after[name], 1e-6), plan))
+	connection.close()
+	os.remove(path)
+
+if __name__ == "__main__":
+	main()
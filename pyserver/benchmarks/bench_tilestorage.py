@@ -0,0 +1,64 @@
+#!/bin/python3
+# Compare memory use and scan speed of the tile storage backends.
+# Each map is built the same way Map.load builds one: by parsing a JSON
+# map section and storing every tile from it into the grid.
+
+import json, os, random, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tilemaptown_server.tilestorage import makeTileGrid, TileStorageBackends
+
+TURF_NAMES = ['grass', 'dirt', 'sand', 'water', 'stone', 'wood_floor', 'brick', 'carpet', 'road', 'snow']
+OBJ_NAMES = ['tree', 'bush', 'flower', 'sign', 'lamp', 'chair', 'table', 'rock']
+
+def makeMapData(width, height, seed=1):
+	""" JSON text of a map with about half of the turfs and a tenth of the objects filled in """
+	rng = random.Random(seed)
+	turfs = []
+	objs = []
+	for x in range(width):
+		for y in range(height):
+			if rng.random() < 0.5:
+				turfs.append([x, y, rng.choice(TURF_NAMES)])
+			if rng.random() < 0.1:
+				if rng.random() < 0.2:
+					objs.append([x, y, [{'name': 'custom', 'pic': [0, rng.randint(0, 3), 0]}]])
+				else:
+					objs.append([x, y, [rng.choice(OBJ_NAMES)]])
+	return json.dumps({'pos': [0, 0, width-1, height-1], 'default': 'grass', 'turf': turfs, 'obj': objs})
+
+def loadGrids(backend, text):
+	s = json.loads(text)
+	width = s["pos"][2]+1
+	height = s["pos"][3]+1
+	turfs = makeTileGrid(width, height, backend)
+	objs = makeTileGrid(width, height, backend)
+	for t in s["turf"]:
+		turfs.set(t[0], t[1], t[2])
+	for o in s["obj"]:
+		objs.set(o[0], o[1], o[2])
+	return turfs, objs
+
+def measure(backend, text):
+	tracemalloc.start()
+	turfs, objs = loadGrids(backend, text)
+	# Only the grids stay alive, so this is what a loaded map costs
+	current = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	start = time.perf_counter()
+	turfs.items()
+	objs.items()
+	scan = time.perf_counter() - start
+	return current, scan
+
+def main():
+	for width, height in [(100, 100), (1000, 1000)]:
+		text = makeMapData(width, height)
+		print("%dx%d map (%d bytes of JSON)" % (width, height, len(text)))
+		for backend in TileStorageBackends:
+			memory, scan = measure(backend, text)
+			print("  %-6s %10.2f MiB  full map_section %8.2f ms" % (backend, memory / (1024*1024), scan * 1000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,49 @@
+#!/bin/python3
+# Bytes sent per map join and per bulk build, as JSON text or binary messages,
+# with and without permessage-deflate (simulated with zlib the same way
+# websockets does it, without context takeover).
+
+import json, os, random, sys, zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tilemaptown_server.mapchunks import MapChunks
+from tilemaptown_server.wireformat import encodeBinaryCommand
+from bench_tilestorage import makeMapData, loadGrids, TURF_NAMES, OBJ_NAMES
+
+def deflated(data):
+	if type(data) == str:
+		data = data.encode()
+	compressor = zlib.compressobj(wbits=-15)
+	# permessage-deflate leaves off the last four bytes of the sync flush
+	return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+def messageSizes(commandType, params, text):
+	binary = encodeBinaryCommand(commandType, params)
+	return (len(text.encode()), deflated(text), len(binary), deflated(binary))
+
+def report(label, sizes):
+	print("%s" % label)
+	print("  text %10d bytes  text+deflate %10d bytes  binary %10d bytes  binary+deflate %10d bytes" % sizes)
+
+def joinSizes(width, height):
+	turfs, objs = loadGrids('array', makeMapData(width, height))
+	text = 'MAP ' + MapChunks(width, height).encode_map(turfs, objs, 'grass')
+	params = {'pos': [0, 0, width-1, height-1], 'default': 'grass', 'turf': turfs.items(), 'obj': objs.items()}
+	return messageSizes('MAP', params, text)
+
+def buildSizes(count, seed=1):
+	rng = random.Random(seed)
+	params = {'turf': [], 'obj': [], 'username': 'builder'}
+	for i in range(count):
+		params['turf'].append([rng.randint(0, 99), rng.randint(0, 99), rng.choice(TURF_NAMES), rng.randint(1, 8), rng.randint(1, 8)])
+		params['obj'].append([rng.randint(0, 99), rng.randint(0, 99), [rng.choice(OBJ_NAMES)], 1, 1])
+	return messageSizes('BLK', params, 'BLK ' + json.dumps(params))
+
+def main():
+	for width, height in [(100, 100), (300, 300)]:
+		report("Joining a %dx%d map (MAP)" % (width, height), joinSizes(width, height))
+	for count in [10, 500]:
+		report("Bulk build with %d turf and %d object rectangles (BLK)" % (count, count), buildSizes(count))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,30 @@
+#!/bin/python3
+# Convert every map still saved as JSON text to the binary map format.
+# Takes the same config file argument as the server; stop the server first.
+
+import time
+from tilemaptown_server.buildglobal import *
+from tilemaptown_server.buildmap import parseMapData
+from tilemaptown_server.mapformat import isBinaryMapData, encodeMapData
+
+converted = 0
+size_before = 0
+size_after = 0
+start = time.perf_counter()
+for mid, data in Database.execute('SELECT mid, data FROM Map').fetchall():
+	if data == None or isBinaryMapData(data):
+		continue
+	try:
+		width, height, turfs, objs = parseMapData(data)
+	except (KeyError, ValueError):
+		print("Skipping map %d, its data couldn't be read" % mid)
+		continue
+	blob = encodeMapData(width, height, turfs, objs)
+	Database.execute('UPDATE Map SET data=? WHERE mid=?', (blob, mid))
+	converted += 1
+	size_before += len(data)
+	size_after += len(blob)
+Database.commit()
+DB.close()
+
+print("Converted %d maps in %.2f seconds, %d bytes -> %d bytes" % (converted, time.perf_counter() - start, size_before, size_after))
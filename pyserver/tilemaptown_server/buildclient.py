@@ -14,18 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio, datetime, random, websockets, json, os.path, hashlib
+import asyncio, datetime, random, websockets, json, os.path, hashlib, collections, time
 from .buildglobal import *
-
-# Make a command to send
-def makeCommand(commandType, commandParams):
-	if commandParams != None:
-		return commandType + " " + json.dumps(commandParams)
-	else:
-		return commandType
+from .wireformat import BinaryCommands, ProtocolFeatures, encodeBinaryCommand
+from .ratelimit import TokenBucket, DefaultCosts, commandCost, countThrottle
+from .metrics import MessagesOut, BytesSent
+from .watchdog import Watchdog
+from .mail import loadMailPage, countMail
 
 userCounter = 1
 
+# Token costs from the config, on top of the defaults
+RateLimitCosts = dict(DefaultCosts)
+RateLimitCosts.update(Config["RateLimit"]["Costs"])
+
 class Client(object):
 	def __init__(self,websocket):
 		global userCounter
@@ -38,8 +40,9 @@ class Client(object):
 		self.pic = [0, 2, 25]
 		self.id = userCounter
 		self.db_id = None        # database key
-		self.ping_timer = 180
-		self.idle_timer = 0
+		self.ping_deadline = None # when the client gets disconnected if it hasn't answered a ping
+		self.ping_timer = None
+		self.last_active = time.monotonic()
 		userCounter += 1
 
 		# other user info
@@ -51,13 +54,21 @@ class Client(object):
 		self.client_settings = ""
 
 		# temporary information
-		self.requests = {} # indexed by username, array with [timer, type]
+		self.requests = {} # indexed by username, array with [expiry timer, type]
 		# valid types are "tpa", "tpahere", "carry"
 		self.tp_history = []
+		self.binary_protocol = False # client asked for MAP, BLK and batched MOV in binary
+		self.loading_map = None # map ID the user is waiting on to finish loading
 
 		# allow cleaning up BotWatch info
 		self.listening_maps = set() # tuples of (category, map)
 
+		# interest management, for only hearing about the nearby parts of the map
+		self.view_size = None     # [width, height] the client said it can see
+		self.view_chunks = None   # chunk rectangle currently in view
+		self.known_chunks = {}    # chunk index -> version last seen, for chunks out of view
+		self.interest_cell = None # chunk the user is indexed under
+
 		# riding information
 		self.vehicle = None     # user being ridden
 		self.passengers = set() # users being carried
@@ -66,11 +77,155 @@ class Client(object):
 		self.username = None
 		self.password = None # actually the password hash
 
+		# outbound messages waiting for the websocket, as [text, coalesce key]
+		self.outbox = collections.deque()
+		self.outbox_bytes = 0
+		self.outbox_keys = {}          # coalesce key -> queued entry
+		self.outbox_ready = asyncio.Event()
+		self.outbox_full_since = None  # when the queue went over its limits
+		self.outbox_timer = None       # checks on the queue again once it's been full for too long
+		self.outbox_dropped = 0
+		self.outbox_coalesced = 0
+		self.evicted = False
+		self.writer_task = None
+
+		# flood control
+		self.rate_limit = TokenBucket(Config["RateLimit"]["Rate"], Config["RateLimit"]["Burst"])
+		self.throttled_since = None # when the client last ran out of tokens, if it still hasn't caught up
+		self.throttle_warned = 0    # when the client was last told it's sending too fast
+
 	def send(self, commandType, commandParams):
 		""" Send a command to the client """
+		if self.binary_protocol and commandType in BinaryCommands:
+			data = encodeBinaryCommand(commandType, commandParams)
+			if data != None:
+				self.send_raw(data, coalesceKey(commandType, commandParams))
+				return
+		self.send_raw(makeCommand(commandType, commandParams), coalesceKey(commandType, commandParams))
+
+	def send_raw(self, text, key=None):
+		""" Queue an already encoded command, as text or binary, to be sent to the client """
+		if self.ws == None or self.evicted:
+			return
+
+		if key != None:
+			if key[0] == "remove":
+				# Don't let anything sent after this replace something queued before it
+				self.outbox_keys.pop(("MOV",)+key[1:], None)
+				self.outbox_keys.pop(("WHO",)+key[1:], None)
+			else:
+				entry = self.outbox_keys.get(key)
+				if entry != None:
+					# Replace the queued message in place, keeping its spot in line
+					self.outbox_bytes += len(text) - len(entry[0])
+					entry[0] = text
+					self.outbox_coalesced += 1
+					OutboxStats['coalesced'] += 1
+					return
+
+		if self.outbox_is_full():
+			self.outbox_dropped += 1
+			OutboxStats['dropped'] += 1
+			self.check_outbox()
+			return
+
+		entry = [text, key]
+		self.outbox.append(entry)
+		self.outbox_bytes += len(text)
+		if key != None and key[0] != "remove":
+			self.outbox_keys[key] = entry
+		self.outbox_ready.set()
+
+	def outbox_is_full(self):
+		return len(self.outbox) >= Config["Server"]["OutboxMaxMessages"] or self.outbox_bytes >= Config["Server"]["OutboxMaxBytes"]
+
+	def check_outbox(self):
+		""" Disconnect the client if it has been too slow to take its messages for too long """
+		if not self.outbox_is_full():
+			self.outbox_full_since = None
+			return
+		now = time.monotonic()
+		if self.outbox_full_since == None:
+			self.outbox_full_since = now
+		waited = now - self.outbox_full_since
+		if waited < Config["Server"]["OutboxEvictTime"]:
+			if self.outbox_timer == None:
+				self.outbox_timer = asyncio.get_event_loop().call_later(Config["Server"]["OutboxEvictTime"] - waited, self.outbox_timeout)
+		elif self.ws != None:
+			print("Evicting slow client "+self.nameAndUsername())
+			OutboxStats['evicted'] += 1
+			self.evicted = True
+			self.outbox.clear()
+			self.outbox_keys.clear()
+			self.outbox_bytes = 0
+			self.outbox_full_since = None
+			self.disconnect()
+
+	def outbox_timeout(self):
+		self.outbox_timer = None
+		self.check_outbox()
+
+	def keep_alive(self, seconds):
+		""" Disconnect the client if it hasn't answered a ping within this many seconds """
+		self.ping_deadline = time.monotonic() + seconds
+		if self.ping_timer == None:
+			self.ping_timer = asyncio.get_event_loop().call_later(max(0, seconds - 60), self.check_ping)
+
+	def check_ping(self):
+		""" Ping the client 60 and 30 seconds before its deadline, and disconnect it once it passes """
+		self.ping_timer = None
 		if self.ws == None:
 			return
-		asyncio.ensure_future(self.ws.send(makeCommand(commandType, commandParams)))
+		# The deadline may have moved since this was scheduled, so go by how much time is actually left
+		left = self.ping_deadline - time.monotonic()
+		if left > 60.5:
+			wait = left - 60
+		elif left > 30.5:
+			self.send("PIN", None)
+			wait = left - 30
+		elif left > 0.5:
+			self.send("PIN", None)
+			wait = left
+		else:
+			self.disconnect()
+			return
+		self.ping_timer = asyncio.get_event_loop().call_later(wait, self.check_ping)
+
+	def add_request(self, username, request_type):
+		""" Remember a request from another user, which expires after 10 minutes """
+		self.remove_request(username)
+		self.requests[username] = [asyncio.get_event_loop().call_later(600, self.requests.pop, username, None), request_type]
+
+	def renew_request(self, username):
+		self.add_request(username, self.requests[username][1])
+
+	def remove_request(self, username):
+		request = self.requests.pop(username, None)
+		if request != None:
+			request[0].cancel()
+
+	def start_writer(self):
+		self.writer_task = asyncio.ensure_future(self.outbox_writer())
+
+	async def outbox_writer(self):
+		""" Send queued messages to the websocket, one at a time """
+		try:
+			while True:
+				while not len(self.outbox):
+					self.outbox_ready.clear()
+					await self.outbox_ready.wait()
+				entry = self.outbox.popleft()
+				if entry[1] != None and self.outbox_keys.get(entry[1]) is entry:
+					del self.outbox_keys[entry[1]]
+				self.outbox_bytes -= len(entry[0])
+				if self.outbox_full_since != None:
+					self.check_outbox()
+				await self.ws.send(entry[0])
+				command = entry[0][0:3]
+				MessagesOut.inc(command.decode() if type(command) == bytes else command)
+				BytesSent.inc(amount=len(entry[0]))
+		except websockets.ConnectionClosed:
+			pass
 
 	def permissionByName(self, perm):
 		perm = perm.lower()
@@ -94,7 +249,7 @@ class Client(object):
 			return True
 		return False
 
-	def ride(self, other):
+	async def ride(self, other):
 		# cannot ride yourself
 		if self == other:
 			return
@@ -112,7 +267,7 @@ class Client(object):
 		other.send("MSG", {'text': 'You carry %s' % self.nameAndUsername()})
 		self.vehicle = other
 		other.passengers.add(self)
-		self.switch_map(other.map_id, new_pos=[other.x, other.y])
+		await self.switch_map(other.map_id, new_pos=[other.x, other.y])
 
 	def dismount(self):
 		if self.vehicle == None:
@@ -140,16 +295,94 @@ class Client(object):
 	def moveTo(self, x, y):
 		self.x = x
 		self.y = y
+		self.update_view()
 		for u in self.passengers:
+			area = (u.x, u.y, x, y)
 			u.moveTo(x, y)
-			u.map.broadcast("MOV", {'id': u.id, 'to': [u.x, u.y]}, remote_category=botwatch_type['move'])
+			if Config["Server"]["MoveTickRate"] > 0:
+				u.map.queue_move(u, area[0], area[1], True)
+			else:
+				u.map.broadcast("MOV", {'id': u.id, 'to': [u.x, u.y]}, remote_category=botwatch_type['move'], area=area)
+
+	def view_radius(self):
+		""" How many tiles away from the user they can see, horizontally and vertically """
+		if self.view_size == None:
+			return (Config["Server"]["ViewRadius"], Config["Server"]["ViewRadius"])
+		return (self.view_size[0] // 2, self.view_size[1] // 2)
+
+	def update_view(self):
+		""" Send the client any parts of the map that just came into view """
+		if not Config["Server"]["InterestManagement"] or self.map == None:
+			return
+		m = self.map
+		m.interest.move(self)
+		old = self.view_chunks
+		new = m.interest.view_rect(self)
+		if new == old:
+			return
+		self.view_chunks = new
+		chunks = m.chunks
+
+		# Remember which version of each chunk that went out of view the client has
+		if old != None:
+			for cx in range(old[0], old[2]+1):
+				for cy in range(old[1], old[3]+1):
+					if cx < new[0] or cx > new[2] or cy < new[1] or cy > new[3]:
+						i = cx*chunks.chunks_tall+cy
+						self.known_chunks[i] = chunks.version[i]
+
+		# Catch the client up on chunks that came into view
+		for cx in range(new[0], new[2]+1):
+			for cy in range(new[1], new[3]+1):
+				if old != None and cx >= old[0] and cx <= old[2] and cy >= old[1] and cy <= old[3]:
+					continue
+				i = cx*chunks.chunks_tall+cy
+				if self.known_chunks.get(i) != chunks.version[i]:
+					bounds = chunks.chunk_bounds(i)
+					self.send("MAP", m.map_section(bounds[0], bounds[1], bounds[2], bounds[3]))
+				for u in m.interest.cells.get((cx, cy), ()):
+					if u is not self:
+						self.send("MOV", {'id': u.id, 'to': [u.x, u.y]})
+
+	async def throttle(self, command, arg):
+		""" Wait until the client can afford a message; returns False if it should be dropped instead """
+		if not Config["RateLimit"]["Enabled"]:
+			return True
+		cost = commandCost(RateLimitCosts, command, arg)
+		wait = self.rate_limit.take(cost)
+		if wait == 0:
+			self.throttled_since = None
+			return True
+
+		# Slow the client down for a little while, and if it keeps going after that, drop what it sends
+		now = time.monotonic()
+		if self.throttled_since == None:
+			self.throttled_since = now
+		if now + wait - self.throttled_since <= Config["RateLimit"]["MaxDelay"]:
+			countThrottle(self.usernameOrId(), False)
+			await asyncio.sleep(wait)
+			self.rate_limit.spend(cost)
+			return True
+
+		countThrottle(self.usernameOrId(), True)
+		if now - self.throttle_warned > 5:
+			self.throttle_warned = now
+			self.send("ERR", {'text': 'You\'re sending messages too quickly, so some of them were ignored'})
+		return False
+
+	def set_features(self, features):
+		""" Turn on the protocol features the client asked for, and return the ones the server supports """
+		features = [f for f in features if f in ProtocolFeatures]
+		self.binary_protocol = 'binary' in features
+		return features
 
 	def who(self):
 		""" A dictionary of information for the WHO command """
 		return {'name': self.name, 'pic': self.pic, 'x': self.x, 'y': self.y, 'id': self.id, 'username': self.username}
 
 	def disconnect(self):
-		asyncio.ensure_future(self.ws.close())
+		if self.ws != None:
+			asyncio.ensure_future(self.ws.close())
 
 	def usernameOrId(self):
 		return self.username or str(self.id)
@@ -165,22 +398,23 @@ class Client(object):
 			return self.tags[name]
 		return default
 
-	def save(self):
-		""" Save user information to the database """
-		c = Database.cursor()
+	async def save(self):
+		""" Queue user information to be saved to the database """
+		if self.db_id == None:
+			# Create new user if user doesn't already exist, so they have a database ID right away
+			self.db_id = await findDBIdByUsername(self.username)
+			if self.db_id == None:
+				self.db_id = await DB.execute("INSERT INTO User (regtime, username) VALUES (?, ?)", (datetime.datetime.now(), self.username,))
+			AllClients.update(self)
 
-		# Create new user if user doesn't already exist
-		if findDBIdByUsername(self.username) == None:
-			c.execute("INSERT INTO User (regtime, username) VALUES (?, ?)", (datetime.datetime.now(), self.username,))
-		# Update database ID in RAM with the possibly newly created row
-		self.db_id = findDBIdByUsername(self.username)
+		# The rest gets written with the next batch
+		Persist.queue_user(self)
 
-		# Update the user
-		values = (self.password, "sha512", self.name, json.dumps(self.pic), self.map_id, self.x, self.y, json.dumps(self.home), json.dumps(list(self.watch_list)), json.dumps(list(self.ignore_list)), self.client_settings, json.dumps(self.tags), datetime.datetime.now(), self.db_id)
-		c.execute("UPDATE User SET passhash=?, passalgo=?, name=?, pic=?, mid=?, map_x=?, map_y=?, home=?, watch=?, ignore=?, client_settings=?, tags=?, lastseen=? WHERE uid=?", values)
-		Database.commit()
+	def save_values(self):
+		""" Parameters for the UPDATE that saves the user """
+		return (self.password, "sha512", self.name, json.dumps(self.pic), self.map_id, self.x, self.y, json.dumps(self.home), json.dumps(list(self.watch_list)), json.dumps(list(self.ignore_list)), self.client_settings, json.dumps(self.tags), datetime.datetime.now(), self.db_id)
 
-	def switch_map(self, map_id, new_pos=None, goto_spawn=True, update_history=True):
+	async def switch_map(self, map_id, new_pos=None, goto_spawn=True, update_history=True):
 		""" Teleport the user to another map """
 		if update_history and self.map_id >= 0:
 			# Add a new teleport history entry if new map
@@ -191,22 +425,43 @@ class Client(object):
 
 		if not self.map or (self.map and self.map.id != map_id):
 			# First check if you can even go to that map
-			new_map = getMapById(map_id)
+			new_map = AllMaps.get(map_id)
+			if new_map == None:
+				# Let the client know why nothing is happening yet
+				self.loading_map = map_id
+				self.send("LOD", {'id': map_id})
+				try:
+					new_map = await getMapById(map_id)
+				finally:
+					self.loading_map = None
+			else:
+				MapCache.touch(new_map)
 			if not new_map.has_permission(self, permission['entry'], True):
 				self.send("ERR", {'text': 'You don\'t have permission to go to map %d' % map_id})
 				return False
+			# Before the old map can go into the cache and push anything out of it
+			MapCache.take(new_map)
 
 			if self.map:
 				# Remove the user for everyone on the map
 				self.map.users.remove(self)
+				self.map.interest.remove(self)
 				self.map.broadcast("WHO", {'remove': self.id}, remote_category=botwatch_type['entry'])
+				self.map.schedule_unload()
 
 			# Get the new map and send it to the client
 			self.map_id = map_id
 			self.map = new_map
 
-			self.send("MAI", self.map.map_info())
-			self.send("MAP", self.map.map_section(0, 0, self.map.width-1, self.map.height-1))
+			self.send_raw(self.map.map_info_payload())
+			if Config["Server"]["InterestManagement"]:
+				# Map data gets sent as it comes into view instead
+				self.view_chunks = None
+				self.known_chunks = {}
+			else:
+				self.send_raw(self.map.map_payload(binary=self.binary_protocol))
+			# Let the client know how up to date the map it has is
+			self.send("DIF", {'edits': [], 'id': self.map.change_id})
 			self.map.users.add(self)
 			self.send("WHO", {'list': self.map.who(), 'you': self.id})
 
@@ -225,20 +480,35 @@ class Client(object):
 			self.moveTo(self.map.start_pos[0], self.map.start_pos[1])
 			self.map.broadcast("MOV", {'id': self.id, 'to': [self.x, self.y]}, remote_category=botwatch_type['move'])
 
+		self.update_view()
+
 		# Move any passengers too
-		for u in self.passengers:
-			u.switch_map(map_id, new_pos=[self.x, self.y])
+		for u in list(self.passengers):
+			await u.switch_map(map_id, new_pos=[self.x, self.y])
 		return True
 
-	def send_home(self):
+	async def send_home(self):
 		""" If player has a home, send them there. If not, to map zero """
 		if self.home != None:
-			self.switch_map(self.home[0], new_pos=[self.home[1], self.home[2]])
+			await self.switch_map(self.home[0], new_pos=[self.home[1], self.home[2]])
 		else:
-			self.switch_map(0)
+			await self.switch_map(0)
 
 	def cleanup(self):
 		self.ws = None
+		if self.writer_task != None:
+			self.writer_task.cancel()
+			self.writer_task = None
+		for timer in (self.ping_timer, self.outbox_timer):
+			if timer != None:
+				timer.cancel()
+		self.ping_timer = None
+		self.outbox_timer = None
+		for username in list(self.requests):
+			self.remove_request(username)
+		self.outbox.clear()
+		self.outbox_keys.clear()
+		self.outbox_bytes = 0
 		temp = set(self.passengers)
 		for u in temp:
 			u.dismount()
@@ -247,32 +517,27 @@ class Client(object):
 		for p in self.listening_maps:
 			BotWatch[p[0]][p[1]].remove(self)
 
-	def login(self, username, password):
+	async def login(self, username, password):
 		""" Attempt to log the client into an account """
 		username = filterUsername(username)
-		result = self.load(username, password)
+		result = await self.load(username, password)
 		if result == True:
-			self.switch_map(self.map_id, goto_spawn=False)
+			await self.switch_map(self.map_id, goto_spawn=False)
 			self.map.broadcast("MSG", {'text': self.name+" has logged in ("+self.username+")"})
 			self.map.broadcast("WHO", {'add': self.who()}, remote_category=botwatch_type['entry']) # update client view
 
 			# send the client their inventory
-			c = Database.cursor()
 			inventory = []
-			for row in c.execute('SELECT aid, name, desc, type, flags, folder, data FROM Asset_Info WHERE owner=?', (self.db_id,)):
+			for row in await DB.fetchall('SELECT aid, name, desc, type, flags, folder, data FROM Asset_Info WHERE owner=?', (self.db_id,)):
 				item = {'id': row[0], 'name': row[1], 'desc': row[2], 'type': row[3], 'flags': row[4], 'folder': row[5], 'data': row[6]}
 				inventory.append(item)
 			self.send("BAG", {'list': inventory})
 
 			# send the client their mail
-			mail = []
-			for row in c.execute('SELECT id, sender, recipients, subject, contents, flags FROM Mail WHERE uid=?', (self.db_id,)):
-				item = {'id': row[0], 'from': findUsernameByDBId(row[1]),
-				'to': [findUsernameByDBId(int(x)) for x in row[2].split(',')],
-				'subject': row[3], 'contents': row[4], 'flags': row[5]}
-				mail.append(item)
-			if len(mail):
-				self.send("EML", {'list': mail})
+			total, unread = await DB.run(countMail, self.db_id)
+			if total:
+				mail, next_page = await DB.run(loadMailPage, self.db_id, None, Config["Server"]["MailPageSize"])
+				self.send("EML", {'list': mail, 'total': total, 'unread': unread, 'next': next_page})
 
 			return True
 		elif result == False:
@@ -281,29 +546,30 @@ class Client(object):
 			self.send("ERR", {'text': 'Login fail, nonexistent account'})
 		return False
 
-	def changepass(self, password):
+	async def changepass(self, password):
 		self.password = hashlib.sha512(password.encode()).hexdigest()
-		self.save()
+		await self.save()
 
-	def register(self, username, password):
+	async def register(self, username, password):
 		username = str(filterUsername(username))
 		# User can't already exist
-		if findDBIdByUsername(username) != None:
+		if await findDBIdByUsername(username) != None:
 			return False
 		self.username = username
-		self.changepass(password)
+		AllClients.update(self)
+		await self.changepass(password)
 		# db_id updated by changepass
 		return True
 
-	def load(self, username, password):
+	async def load(self, username, password):
 		""" Load an account from the database """
 		password = hashlib.sha512(password.encode()).hexdigest()
 		self.password = password
 
-		c = Database.cursor()
-		
-		c.execute('SELECT uid, passhash, passalgo, username, name, pic, mid, map_x, map_y, home, watch, ignore, client_settings, tags FROM User WHERE username=?', (username,))
-		result = c.fetchone()
+		# Don't read the account back while its last save is still waiting to be written
+		Persist.flush_user(username)
+
+		result = await DB.fetchone('SELECT uid, passhash, passalgo, username, name, pic, mid, map_x, map_y, home, watch, ignore, client_settings, tags FROM User WHERE username=?', (username,))
 		if result == None:
 			return None
 		# Refuse to load if incorrect password
@@ -322,5 +588,8 @@ class Client(object):
 		self.ignore_list = set(json.loads(result[11]))
 		self.client_settings = result[12]
 		self.tags = json.loads(result[13])
+		AllClients.update(self)
 
 		return True
+
+Watchdog.label(Client.login, lambda l: 'Logging in %s' % l['username'])
@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sqlite3, json, sys, os.path
+import asyncio, sqlite3, json, sys, os.path, time
+from .registry import ClientRegistry, MapRegistry
+from .dbexecutor import DatabaseExecutor
+from .metrics import MapLoadTime
 
 # Read configuration information
 Config = {}
@@ -46,17 +49,62 @@ setConfigDefault("Server",   "MaxUsers",         200)
 setConfigDefault("Server",   "MaxDBMaps",        5000)
 setConfigDefault("Server",   "WSMaxSize",        0x8000)
 setConfigDefault("Server",   "WSMaxQueue",       32)
+setConfigDefault("Server",   "WSCompression",    True)
+setConfigDefault("Server",   "TileStorage",      "array")
+setConfigDefault("Server",   "MapChunkSize",     16)
+setConfigDefault("Server",   "OutboxMaxMessages", 2000)
+setConfigDefault("Server",   "OutboxMaxBytes",   0x400000)
+setConfigDefault("Server",   "OutboxEvictTime",  15)
+setConfigDefault("Server",   "InterestManagement", False)
+setConfigDefault("Server",   "ViewRadius",       20)
+setConfigDefault("Server",   "MaxViewRadius",    64)
+setConfigDefault("Server",   "MoveTickRate",     0)
+setConfigDefault("Server",   "MapChangeLog",     1000)
+setConfigDefault("Server",   "MaxEditArea",      1000000)
+setConfigDefault("Server",   "MapUnloadDelay",   300)
+setConfigDefault("Server",   "MapCacheBytes",    0x4000000)
+setConfigDefault("Server",   "MailPageSize",     50)
+setConfigDefault("RateLimit", "Enabled",         True)
+setConfigDefault("RateLimit", "Rate",            10)
+setConfigDefault("RateLimit", "Burst",           40)
+setConfigDefault("RateLimit", "MaxDelay",        2)
+setConfigDefault("RateLimit", "Costs",           {})
+setConfigDefault("Metrics",  "Port",             0)
+setConfigDefault("Metrics",  "Host",             "127.0.0.1")
+setConfigDefault("Watchdog", "Threshold",        0.25)
+setConfigDefault("Watchdog", "Interval",         0.05)
+setConfigDefault("Watchdog", "Profile",          False)
+setConfigDefault("Watchdog", "ProfileRate",      100)
+setConfigDefault("Watchdog", "ProfileFile",      "profile.folded")
+setConfigDefault("Watchdog", "ProfileInterval",  30)
 setConfigDefault("Database", "File",             "town.db")
 setConfigDefault("Database", "Setup",            True)
+setConfigDefault("Database", "WAL",              True)
+setConfigDefault("Database", "FlushInterval",    5)
+setConfigDefault("Database", "MapFormat",        "binary")
 setConfigDefault("Images",   "URLWhitelist",     ["https://i.imgur.com/"])
 
 # Open database connection
-Database = sqlite3.connect(Config["Database"]["File"], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+# It's only used directly while setting up; after that everything goes through DB, on its own thread
+Database = sqlite3.connect(Config["Database"]["File"], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread=False)
+if Config["Database"]["WAL"]:
+	# Commits don't need to wait for a full sync with write-ahead logging
+	Database.execute("PRAGMA journal_mode=WAL")
+	Database.execute("PRAGMA synchronous=NORMAL")
+DB = DatabaseExecutor(Database)
 
 # Important information shared by each module
-ServerShutdown = [-1]
-AllClients = set()
-AllMaps = set()
+ServerShutdown = [-1] # seconds until the server shuts down, -1 if it isn't, or 0 once it has
+ShutdownTimer = [None]
+AllClients = ClientRegistry()
+AllMaps = MapRegistry()
+MapLoads = {} # map ID -> future for a map that's being loaded right now
+
+# Totals for the outbound message queues of all clients
+OutboxStats = {'dropped': 0, 'coalesced': 0, 'evicted': 0}
+
+# Lookups in the maps' permission caches, and how many had to go to the database
+PermissionCacheStats = {'hits': 0, 'misses': 0}
 
 # Remote map-watching for bots
 botwatch_type = {}
@@ -79,46 +127,69 @@ permission['map_bot'] = 32      # user is given bot-related permissions
 mapflag = {}
 mapflag['public'] = 1
 
-def mapIdExists(id):
-	for m in AllMaps:
-		if m.id == id:
-			return True
-	c = Database.cursor()
-	c.execute('SELECT mid FROM Map WHERE mid=?', (id,))
-	result = c.fetchone()
+async def mapIdExists(id):
+	if AllMaps.get(id) != None:
+		return True
+	result = await DB.fetchone('SELECT mid FROM Map WHERE mid=?', (id,))
 	return result != None
 
 # Important shared functions
+def makeCommand(commandType, commandParams):
+	""" Make a command to send """
+	if commandParams != None:
+		return commandType + " " + json.dumps(commandParams)
+	else:
+		return commandType
+
+def coalesceKey(commandType, commandParams):
+	""" Queued messages with the same key get replaced by newer ones instead of piling up """
+	if commandParams == None:
+		return None
+	remote_map = commandParams.get('remote_map')
+	if commandType == "MOV" and 'id' in commandParams:
+		return ("MOV", commandParams['id'], remote_map)
+	if commandType == "WHO":
+		if 'add' in commandParams:
+			return ("WHO", commandParams['add']['id'], remote_map)
+		# Removing someone keeps earlier messages about them from being replaced
+		if 'remove' in commandParams:
+			return ("remove", commandParams['remove'], remote_map)
+	return None
+
 def broadcastToAll(text):
+	text = makeCommand("MSG", {'text': text, 'class': 'broadcast_message'})
 	for u in AllClients:
-		u.send("MSG", {'text': text, 'class': 'broadcast_message'})
+		u.send_raw(text)
 
 def findClientByDBId(id, inside=None):
-	for u in inside or AllClients:
+	if inside == None:
+		return AllClients.get_by_db_id(id)
+	for u in inside:
 		if id == u.db_id:
 			return u
 	return None
 
 def findClientByUsername(username, inside=None):
 	username = username.lower()
-	for u in inside or AllClients:
+	if inside == None:
+		u = AllClients.get_by_username(username)
+		if u == None and username.isnumeric():
+			u = AllClients.get_by_id(int(username))
+		return u
+	for u in inside:
 		if username == u.username or (username.isnumeric() and int(username) == u.id):
 			return u
 	return None
 
-def findUsernameByDBId(dbid):
-	c = Database.cursor()
-	c.execute('SELECT username FROM User WHERE uid=?', (dbid,))
-	result = c.fetchone()
+async def findUsernameByDBId(dbid):
+	result = await DB.fetchone('SELECT username FROM User WHERE uid=?', (dbid,))
 	if result == None:
 		return None
 	return result[0]
 
-def findDBIdByUsername(username):
-	c = Database.cursor()
+async def findDBIdByUsername(username):
 	username = str(username).lower()
-	c.execute('SELECT uid FROM User WHERE username=?', (username,))
-	result = c.fetchone()
+	result = await DB.fetchone('SELECT uid FROM User WHERE username=?', (username,))
 	if result == None:
 		return None
 	return result[0]
@@ -126,14 +197,61 @@ def findDBIdByUsername(username):
 def filterUsername(text):
 	return ''.join([i for i in text if (i.isalnum() or i == '_')]).lower()
 
-def getMapById(mapId):
-	for m in AllMaps:
-		if m.id == mapId:
+async def getMapById(mapId):
+	while True:
+		m = AllMaps.get(mapId)
+		if m != None:
+			MapCache.touch(m)
+			return m
+		# Everyone who wants the same map while it's loading shares one load
+		load = MapLoads.get(mapId)
+		if load == None:
+			load = asyncio.ensure_future(loadMapById(mapId))
+			MapLoads[mapId] = load
+			load.add_done_callback(lambda future: MapLoads.pop(mapId, None))
+		m = await asyncio.shield(load)
+		# Make sure it didn't get unloaded again before this got a turn to run
+		if AllMaps.get(mapId) is m:
 			return m
-	# Map not found, so load it
+
+async def loadMapById(mapId):
+	# If it was unloaded recently, its last save may still be waiting to be written
+	Persist.flush_map(mapId)
+	MapCache.miss()
+	start = time.perf_counter()
 	m = Map()
-	m.load(mapId)
+	await m.load(mapId)
 	AllMaps.add(m)
+	MapLoadTime.time(start)
+	m.schedule_unload(just_loaded=True)
 	return m
 
+def startShutdown(seconds):
+	""" Shut the server down after a number of seconds, or cancel that if seconds is -1 """
+	ServerShutdown[0] = seconds
+	if ShutdownTimer[0] != None:
+		ShutdownTimer[0].cancel()
+		ShutdownTimer[0] = None
+	if seconds > 0:
+		ShutdownTimer[0] = asyncio.get_event_loop().call_later(1, shutdownTimer)
+
+def shutdownTimer():
+	ShutdownTimer[0] = None
+	ServerShutdown[0] -= 1
+	if ServerShutdown[0] == 1:
+		broadcastToAll("Server is going down!")
+		for u in AllClients:
+			u.disconnect()
+		for m in AllMaps:
+			m.save()
+		Persist.flush()
+	elif ServerShutdown[0] == 0:
+		Persist.flush()
+		asyncio.get_event_loop().stop()
+		return
+	ShutdownTimer[0] = asyncio.get_event_loop().call_later(1, shutdownTimer)
+
+from .persistence import Persist
+from .mapcache import MapCache
 from .buildmap import Map
+from . import commands
@@ -14,8 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json, asyncio, random, datetime
+import json, asyncio, collections, functools, time
 from .buildglobal import *
+from .tilestorage import makeTileGrid
+from .mapchunks import MapChunks
+from .mapformat import isBinaryMapData, encodeMapData, decodeMapData
+from .wireformat import BinaryCommands, encodeBinaryCommand
+from .region import clipRegion, regionArea, countRegion
+from .interest import InterestGrid
+from .router import ProtocolCommands
+from .metrics import BroadcastSize
+from .dbexecutor import fetchAll
+from .watchdog import Watchdog
 
 DirX = [ 1,  1,  0, -1, -1, -1,  0,  1]
 DirY = [ 0,  1,  1,  1,  0, -1, -1, -1]
@@ -51,6 +61,23 @@ def tileIsOkay(tile):
 
 	return (True, None)
 
+def parseMapData(data):
+	""" Turn a map's saved data into (width, height, turfs, objs); doesn't touch anything shared, so it can run in a worker thread """
+	if isBinaryMapData(data):
+		return decodeMapData(data, Config["Server"]["TileStorage"])
+
+	# Maps saved before the binary format are JSON text
+	s = json.loads(data)
+	width = s["pos"][2]+1
+	height = s["pos"][3]+1
+	turfs = makeTileGrid(width, height, Config["Server"]["TileStorage"])
+	objs = makeTileGrid(width, height, Config["Server"]["TileStorage"])
+	for t in s["turf"]:
+		turfs.set(t[0], t[1], t[2])
+	for o in s["obj"]:
+		objs.set(o[0], o[1], o[2])
+	return (width, height, turfs, objs)
+
 class Map(object):
 	def __init__(self,width=100,height=100):
 		# map stuff
@@ -69,6 +96,23 @@ class Map(object):
 		self.allow = 0
 		self.deny = 0
 		self.guest_deny = 0
+		self.permission_cache = None # Map_Permission rows for this map, uid -> [allow, deny]
+
+		# movement waiting to be sent out on the next tick, by user ID
+		self.pending_moves = {}
+
+		# recent edits, as (change ID, list of edits), so clients can catch up without the whole map
+		self.change_id = 0
+		self.saved_change_id = 0 # change ID when the map was last queued to be saved
+		self.change_log = collections.deque(maxlen=Config["Server"]["MapChangeLog"])
+
+		# cached MAI and MAP message text, and what they were made from
+		self.map_info_text = None
+		self.map_info_key = None
+		self.map_payload_text = None
+		self.map_payload_source = None
+		self.map_payload_binary = None
+		self.map_payload_binary_source = None
 
 		# map scripting
 		self.has_script = False
@@ -77,17 +121,20 @@ class Map(object):
 
 		self.blank_map(width, height)
 
-	def blank_map(self, width, height):
-		""" Make a blank map of a given size """
+	def blank_map(self, width, height, turfs=None, objs=None):
+		""" Make a blank map of a given size, or one with already filled in tile grids """
 		self.width = width
 		self.height = height
 
 		# construct the map
-		self.turfs = []
-		self.objs = []
-		for x in range(0, width):
-			self.turfs.append([None] * height)
-			self.objs.append([None] * height)
+		if turfs == None:
+			turfs = makeTileGrid(width, height, Config["Server"]["TileStorage"])
+		if objs == None:
+			objs = makeTileGrid(width, height, Config["Server"]["TileStorage"])
+		self.turfs = turfs
+		self.objs = objs
+		self.chunks = MapChunks(width, height, Config["Server"]["MapChunkSize"])
+		self.interest = InterestGrid(self.chunks, Config["Server"]["MaxViewRadius"])
 
 	def set_permission(self, uid, perm, value):
 		if uid == None:
@@ -97,9 +144,7 @@ class Map(object):
 		deny = 0
 
 		# Get current value
-		c = Database.cursor()
-		c.execute('SELECT allow, deny FROM Map_Permission WHERE mid=? AND uid=?', (self.id, uid,))
-		result = c.fetchone()
+		result = self.get_user_permission(uid)
 		if result != None:
 			allow = result[0]
 			deny = result[1]
@@ -117,14 +162,37 @@ class Map(object):
 
 		# Delete if permissions were removed
 		if not (allow | deny):
-			c.execute('DELETE FROM Map_Permission WHERE mid=? AND uid=?', (self.id, uid,))
+			DB.write('DELETE FROM Map_Permission WHERE mid=? AND uid=?', (self.id, uid,))
+			self.permission_cache.pop(uid, None)
 			return
 
 		# Update or insert depending on needs
 		if result != None:
-			c.execute('UPDATE Map_Permission SET allow=?, deny=? WHERE mid=? AND uid=?', (allow, deny, self.id, uid,))
+			DB.write('UPDATE Map_Permission SET allow=?, deny=? WHERE mid=? AND uid=?', (allow, deny, self.id, uid,))
 		else:
-			c.execute("INSERT INTO Map_Permission (mid, uid, allow, deny) VALUES (?, ?, ?, ?)", (self.id, uid, allow, deny,))
+			DB.write("INSERT INTO Map_Permission (mid, uid, allow, deny) VALUES (?, ?, ?, ?)", (self.id, uid, allow, deny,))
+		self.permission_cache[uid] = [allow, deny]
+
+	async def load_permissions(self):
+		""" Read all of the map's per-user permissions into the cache """
+		rows = await DB.fetchall('SELECT uid, allow, deny FROM Map_Permission WHERE mid=?', (self.id,))
+		self.permission_cache = dict((row[0], [row[1], row[2]]) for row in rows)
+
+	def reload_permissions(self):
+		""" Like load_permissions, but waits for the database right here, for code that can't await """
+		rows = DB.submit(fetchAll, 'SELECT uid, allow, deny FROM Map_Permission WHERE mid=?', (self.id,)).result()
+		self.permission_cache = dict((row[0], [row[1], row[2]]) for row in rows)
+
+	def get_user_permission(self, uid):
+		""" [allow, deny] for a user on this map, or None if they have nothing set """
+		if self.permission_cache == None:
+			# Maps load their permissions before anyone can get in, but something can still
+			# change them after the map was cleaned up
+			PermissionCacheStats['misses'] += 1
+			self.reload_permissions()
+		else:
+			PermissionCacheStats['hits'] += 1
+		return self.permission_cache.get(uid)
 
 	def has_permission(self, user, perm, default):
 		has = default
@@ -139,10 +207,8 @@ class Map(object):
 				has = False
 			return has
 
-		# Search Map_Permission table
-		c = Database.cursor()
-		c.execute('SELECT allow, deny FROM Map_Permission WHERE mid=? AND uid=?', (self.id, user.db_id,))
-		result = c.fetchone()
+		# Look up the user's Map_Permission row
+		result = self.get_user_permission(user.db_id)
 		if result == None:
 			return has
 		# Override the defaults
@@ -161,14 +227,12 @@ class Map(object):
 			return self.tags[name]
 		return default
 
-	def load(self, mapId):
+	async def load(self, mapId):
 		""" Load a map from a file """
 		self.id = mapId
+		await self.load_permissions()
 
-		c = Database.cursor()
-
-		c.execute('SELECT name, desc, owner, flags, start_x, start_y, width, height, default_turf, allow, deny, guest_deny, tags, data FROM Map WHERE mid=?', (mapId,))
-		result = c.fetchone()
+		result = await DB.fetchone('SELECT name, desc, owner, flags, start_x, start_y, width, height, default_turf, allow, deny, guest_deny, tags, data FROM Map WHERE mid=?', (mapId,))
 		if result == None:
 			return False
 
@@ -185,49 +249,46 @@ class Map(object):
 		self.guest_deny = result[11]
 		self.tags = json.loads(result[12])
 
-		# Parse map data
-		s = json.loads(result[13])
-		self.blank_map(s["pos"][2]+1, s["pos"][3]+1)
-		for t in s["turf"]:
-			self.turfs[t[0]][t[1]] = t[2]
-		for o in s["obj"]:
-			self.objs[o[0]][o[1]] = o[2]
-		map = False
+		# Parse map data in a worker thread, since big maps take a while
+		width, height, turfs, objs = await asyncio.get_running_loop().run_in_executor(None, parseMapData, result[13])
+		self.blank_map(width, height, turfs, objs)
+		# Already saved, unless it's in the format that isn't used anymore
+		self.chunks.data_saved = isBinaryMapData(result[13]) == (Config["Database"]["MapFormat"] == "binary")
 		return True
 
 	def save(self):
-		""" Save the map to a file """
-
-		c = Database.cursor()
-
-		# Create map if it doesn't already exist
-		c.execute('SELECT mid FROM Map WHERE mid=?', (self.id,))
-		result = c.fetchone()
-		if result == None:
-			c.execute("INSERT INTO Map (regtime, mid) VALUES (?, ?)", (datetime.datetime.now(), self.id,))
-
-		# Update the map
-		values = (self.name, self.desc, self.owner, self.flags, self.start_pos[0], self.start_pos[1], self.width, self.height, self.default_turf, self.allow, self.deny, self.guest_deny, json.dumps(self.tags), json.dumps(self.map_section(0, 0, self.width-1, self.height-1)), self.id)
-		c.execute("UPDATE Map SET name=?, desc=?, owner=?, flags=?, start_x=?, start_y=?, width=?, height=?, default_turf=?, allow=?, deny=?, guest_deny=?, tags=?, data=? WHERE mid=?", values)
-		Database.commit()
+		""" Queue the map to be saved to the database with the next batch """
+		Persist.queue_map(self)
+		self.saved_change_id = self.change_id
+
+	def save_values(self):
+		""" Parameters for the UPDATE that saves the map, with the map ID last """
+		return (self.name, self.desc, self.owner, self.flags, self.start_pos[0], self.start_pos[1], self.width, self.height, self.default_turf, self.allow, self.deny, self.guest_deny, json.dumps(self.tags), self.id)
+
+	def save_data(self):
+		""" Function that makes the map's tiles the way they get saved in the database, for the database thread to run,
+		or None if they haven't changed since they were last saved """
+		if self.chunks.data_saved:
+			return None
+		self.chunks.data_saved = True
+		if Config["Database"]["MapFormat"] == "json":
+			# Only re-encodes the chunks that changed, so it's cheap enough to do here
+			text = self.chunks.encode_map(self.turfs, self.objs, self.default_turf)
+			return lambda: text
+		# Encoding the whole map takes a while, so copy the grids and leave the rest for the database thread
+		return functools.partial(encodeMapData, self.width, self.height, self.turfs.snapshot(), self.objs.snapshot())
 
 	def map_section(self, x1, y1, x2, y2):
-		""" Returns a section of map as a list of turfs and objects """
-		# clamp down the numbers
-		x1 = min(self.width, max(0, x1))
-		y1 = min(self.height, max(0, y1))
-		x2 = min(self.width, max(0, x2))
-		y2 = min(self.height, max(0, y2))
+		""" Returns a section of map as a list of turfs and objects, or None if none of it is on the map """
+		region = clipRegion(x1, y1, x2, y2, self.width, self.height)
+		if region == None:
+			return None
+		x1, y1, x2, y2 = region
+		countRegion("section", regionArea(region))
 
 		# scan the map
-		turfs = []
-		objs  = []
-		for x in range(x1, x2+1):
-			for y in range(y1, y2+1):
-				if self.turfs[x][y] != None:
-					turfs.append([x, y, self.turfs[x][y]])
-				if self.objs[x][y] != None:
-					objs.append([x, y, self.objs[x][y]])
+		turfs = self.turfs.section(x1, y1, x2, y2)
+		objs  = self.objs.section(x1, y1, x2, y2)
 		return {'pos': [x1, y1, x2, y2], 'default': self.default_turf, 'turf': turfs, 'obj': objs}
 
 	def map_info(self, all_info=False):
@@ -237,18 +298,150 @@ class Map(object):
 			out['start_pos'] = self.start_pos
 		return out
 
-	def broadcast(self, commandType, commandParams, remote_category=None, remote_only=False):
-		""" Send a message to everyone on the map """
+	def map_payload(self, remote_map=None, binary=False):
+		""" Complete, already encoded MAP message for the whole map """
+		text = self.chunks.encode_map(self.turfs, self.objs, self.default_turf)
+		if binary and remote_map == None:
+			if text is not self.map_payload_binary_source:
+				self.map_payload_binary = encodeBinaryCommand("MAP", self.map_section(0, 0, self.width-1, self.height-1))
+				self.map_payload_binary_source = text
+			if self.map_payload_binary != None:
+				return self.map_payload_binary
+		if remote_map != None:
+			return 'MAP ' + text[:-1] + ', "remote_map": %d}' % remote_map
+		# Reuse the same message until the map data changes
+		if text is not self.map_payload_source:
+			self.map_payload_text = 'MAP ' + text
+			self.map_payload_source = text
+		return self.map_payload_text
+
+	def map_info_payload(self, remote_map=None):
+		""" Complete, already encoded MAI message with the basic map info """
+		key = (self.name, self.id, self.owner, self.default_turf, self.width, self.height, self.flags, self.allow, self.deny)
+		if key != self.map_info_key:
+			self.map_info_text = json.dumps(self.map_info())
+			self.map_info_key = key
+		if remote_map != None:
+			return 'MAI ' + self.map_info_text[:-1] + ', "remote_map": %d}' % remote_map
+		return 'MAI ' + self.map_info_text
+
+	def edit(self, edits, operation):
+		""" Apply a list of [layer, x1, y1, x2, y2, tile] edits, where a tile of None clears the rectangle.
+		The rectangles need to be on the map already; see region.py.
+		Returns the change ID they were logged under and the area they covered. """
+		area = None
+		cells = 0
+		for layer, x1, y1, x2, y2, tile in edits:
+			cells += (x2-x1+1) * (y2-y1+1)
+			grid = self.turfs if layer == "turf" else self.objs
+			grid.fill(x1, y1, x2, y2, tile)
+			self.chunks.mark(x1, y1, x2, y2)
+			if area == None:
+				area = [x1, y1, x2, y2]
+			else:
+				area = [min(area[0], x1), min(area[1], y1), max(area[2], x2), max(area[3], y2)]
+		countRegion(operation, cells)
+		return self.log_change(edits), area
+
+	def resend_section(self, client, x1, y1, x2, y2):
+		""" Send a client the real contents of part of the map, to undo a change it wasn't allowed to make """
+		section = self.map_section(x1, y1, x2, y2)
+		if section != None:
+			client.send("MAP", section)
+
+	def log_change(self, edits):
+		""" Add edits that were made to the change log, and return their change ID """
+		self.change_id += 1
+		self.change_log.append((self.change_id, edits))
+		return self.change_id
+
+	def changes_since(self, change_id):
+		""" All edits made after a change ID, or None if the change log doesn't go back that far """
+		if change_id > self.change_id:
+			return None
+		if change_id < self.change_id and (not len(self.change_log) or self.change_log[0][0] > change_id+1):
+			return None
+		edits = []
+		for logged_id, logged_edits in self.change_log:
+			if logged_id > change_id:
+				edits.extend(logged_edits)
+		return edits
+
+	def broadcast(self, commandType, commandParams, remote_category=None, remote_only=False, area=None):
+		""" Send a message to everyone on the map, or just the users who can see the area it's about """
+		users = self.users
+		if area != None and Config["Server"]["InterestManagement"]:
+			users = self.interest.viewers(*area)
+
+		# Encode the message once and send the same text to everyone
 		if not remote_only:
-			for client in self.users:
-				client.send(commandType, commandParams)
+			BroadcastSize.observe(len(users))
+		if not remote_only and len(users):
+			text = makeCommand(commandType, commandParams)
+			key = coalesceKey(commandType, commandParams)
+			binary = None
+			for client in users:
+				if client.binary_protocol and commandType in BinaryCommands:
+					# Same for clients that use the binary protocol
+					if binary == None:
+						binary = encodeBinaryCommand(commandType, commandParams) or text
+					client.send_raw(binary, key)
+				else:
+					client.send_raw(text, key)
 
 		""" Also send it to any registered listeners """
 		if remote_category != None and self.id in BotWatch[remote_category]:
-			commandParams['remote_map'] = self.id
+			# Copy the parameters so the caller's dictionary isn't changed
+			remoteParams = dict(commandParams, remote_map=self.id)
+			text = makeCommand(commandType, remoteParams)
+			key = coalesceKey(commandType, remoteParams)
 			for client in BotWatch[remote_category][self.id]:
 				if (client.map_id != self.id) or remote_only: # don't send twice to people on the map
-					client.send(commandType, commandParams)
+					client.send_raw(text, key)
+
+	def queue_move(self, client, from_x, from_y, forced):
+		""" Remember that a user moved, to tell everyone on the next movement tick """
+		move = self.pending_moves.get(client.id)
+		if move == None:
+			self.pending_moves[client.id] = [client, from_x, from_y, forced]
+		elif forced:
+			move[3] = True
+
+	def flush_moves(self):
+		""" Send everyone one message with all of the movement since the last tick """
+		if not len(self.pending_moves):
+			return
+		moves = self.pending_moves
+		self.pending_moves = {}
+
+		# [id, x, y] for users moved by the server, [id, x, y, from x, from y] for users who moved themselves
+		entries = []
+		areas = []
+		for id, move in moves.items():
+			client = move[0]
+			if client.map is not self:
+				continue
+			if move[3]:
+				entries.append([id, client.x, client.y])
+			else:
+				entries.append([id, client.x, client.y, move[1], move[2]])
+			areas.append((move[1], move[2], client.x, client.y))
+		if not len(entries):
+			return
+
+		if Config["Server"]["InterestManagement"]:
+			# Everyone gets a list of just the movement they can see
+			lists = {}
+			for i in range(len(entries)):
+				for u in self.interest.viewers(*areas[i]):
+					if u not in lists:
+						lists[u] = []
+					lists[u].append(entries[i])
+			for u, entry_list in lists.items():
+				u.send("MOV", {'list': entry_list})
+			self.broadcast("MOV", {'list': entries}, remote_category=botwatch_type['move'], remote_only=True)
+		else:
+			self.broadcast("MOV", {'list': entries}, remote_category=botwatch_type['move'])
 
 	def who(self):
 		""" WHO message data """
@@ -257,851 +450,62 @@ class Map(object):
 			players[str(client.id)] = client.who()
 		return players
 
-	def receive_command(self, client, command, arg):
+	async def receive_command(self, client, command, arg):
 		""" Add a command from the client to a queue, or just execute it """
-		self.execute_command(client, command, arg)
-
-	def execute_command(self, client, command, arg):
+		try:
+			await self.execute_command(client, command, arg)
+		except (KeyError, IndexError, TypeError, ValueError) as e:
+			# A malformed command shouldn't cost the client its connection
+			print("Bad %s from %s: %s" % (command, client.nameAndUsername(), repr(e)))
+			client.send("ERR", {'text': 'Invalid %s message' % command})
+
+	async def execute_command(self, client, command, arg):
 		""" Actually run a command from the client after being processed """
-		global ServerShutdown
-		client.idle_timer = 0
-
-		# todo: use a dictionary instead of if/else chain
-		if command == "MOV":
-			self.broadcast("MOV", {'id': client.id, 'from': arg["from"], 'to': arg["to"]}, remote_category=botwatch_type['move'])
-			client.moveTo(arg["to"][0], arg["to"][1])
-		elif command == "CMD":
-			# separate into command and arguments
-			text = arg["text"]
-			space = text.find(" ")
-			command2 = text.lower()
-			arg2 = ""
-			if space >= 0:
-				command2 = text[0:space].lower()
-				arg2 = text[space+1:]
-
-			if command2 == "nick":
-				if len(arg2) > 0 and not arg2.isspace():
-					self.broadcast("MSG", {'text': "\""+client.name+"\" is now known as \""+escapeTags(arg2)+"\""})
-					client.name = escapeTags(arg2)
-					self.broadcast("WHO", {'add': client.who()}, remote_category=botwatch_type['entry']) # update client view
-			elif command2 == "client_settings":
-				self.client_settings = arg2
-			elif command2 == "tell" or command2 == "msg" or command2 == "p":
-				space2 = arg2.find(" ")
-				if space2 >= 0:
-					username = arg2[0:space2].lower()
-					privtext = arg2[space2+1:]
-					if privtext.isspace():
-						client.send("ERR", {'text': 'Tell them what?'})
-					else:
-						u = findClientByUsername(username)
-						if u:
-							if not client.inBanList(u.ignore_list, 'message %s' % u.name):
-								client.send("PRI", {'text': privtext, 'name':u.name, 'username': u.usernameOrId(), 'receive': False})
-								u.send("PRI", {'text': privtext, 'name':client.name, 'username': client.usernameOrId(), 'receive': True})
-						else:
-							client.failedToFind(username)
-				else:
-					client.send("ERR", {'text': 'Private message who?'})
-
-			# carrying
-			elif command2 == "carry":
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				my_username = client.usernameOrId()
-				if my_username in u.requests:
-					client.send("ERR", {'text': 'You\'ve already sent them a request'})
-					u.requests[my_username][0] = 600 #renew
-				elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
-					client.send("MSG", {'text': 'You requested to carry '+arg2})
-					u.send("MSG", {'text': client.nameAndUsername()+' wants to carry you', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
-					u.requests[my_username] = [600, 'carry']
-			elif command2 == "hopoff":
-				client.dismount()
-			elif command2 == "dropoff":
-				u = findClientByUsername(arg2, inside=client.passengers)
-				if u:
-					u.dismount()
-				else:
-					client.send("ERR", {'text': 'You aren\'t carrying %s' % arg2})
-			elif command2 == "carrywho":
-				if len(client.passengers):
-					names = ''
-					for u in client.passengers:
-						if len(names) > 0:
-							names += ', '
-						names += '%s (%s)' % (u.name, u.usernameOrId())
-					client.send("MSG", {'text': "You are carrying %s" % names})
-				else:
-					client.send("MSG", {'text': "You aren\'t carrying anything"})
-			elif command2 == "ridewho":
-				if client.vehicle:
-					client.send("MSG", {'text': "You are riding %s" % client.vehicle.nameAndUsername()})
-				else:
-					client.send("MSG", {'text': "You aren\'t riding anything"})
-			elif command2 == "rideend":
-				temp = set(client.passengers)
-				for u in temp:
-					u.dismount()
-
-			elif command2 == "tpa":
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				my_username = client.usernameOrId()
-				if my_username in u.requests:
-					client.send("ERR", {'text': 'You\'ve already sent them a request'})
-					u.requests[my_username][0] = 600 #renew
-				elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
-					client.send("MSG", {'text': 'You requested a teleport to '+arg2})
-					u.send("MSG", {'text': client.nameAndUsername()+' wants to teleport to you', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
-					u.requests[my_username] = [600, 'tpa']
-
-			elif command2 == "tpahere":
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				my_username = client.usernameOrId()
-				if my_username in u.requests:
-					client.send("ERR", {'text': 'You\'ve already sent them a request'})
-					u.requests[my_username][0] = 600 #renew
-				elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
-					client.send("MSG", {'text': 'You requested that '+arg2+' teleport to you'})
-					u.send("MSG", {'text': client.nameAndUsername()+' wants you to teleport to them', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
-					u.requests[my_username] = [600, 'tpahere']
-
-			elif command2 == "tpaccept" or command2 == "hopon":
-				arg2 = arg2.lower()
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				if arg2 not in client.requests:
-					client.send("ERR", {'text': 'No pending request from '+arg2})
-				else:
-					client.send("MSG", {'text': 'You accepted a teleport request from '+arg2})
-					u.send("MSG", {'text': u.nameAndUsername()+" accepted your request"})
-					request = client.requests[arg2]
-					if request[1] == 'tpa':
-						u.switch_map(u.map_id, new_pos=[client.x, client.y])
-					elif request[1] == 'tpahere':
-						client.switch_map(u.map_id, new_pos=[u.x, u.y])
-					elif request[1] == 'carry':
-						client.ride(u)
-					del client.requests[arg2]
-
-			elif command2 == "tpdeny" or command2 == "tpdecline":
-				arg2 = arg2.lower()
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				if arg2 not in client.requests:
-					client.send("ERR", {'text': 'No pending request from '+arg2})
-				else:
-					client.send("MSG", {'text': 'You rejected a teleport request from '+arg2})
-					u.send("MSG", {'text': u.nameAndUsername()+" rejected your request"})
-					del client.requests[arg2]
-
-			elif command2 == "tpcancel":
-				arg2 = arg2.lower()
-				u = findClientByUsername(arg2)
-				if u == None:
-					client.failedToFind(arg2)
-					return
-				my_username = client.usernameOrId()
-				if my_username in u.requests:
-					client.send("MSG", {'text': 'Canceled request to '+arg2})
-					del u.requests[my_username]
-				else:
-					client.send("ERR", {'text': 'No request to cancel'})
-
-			elif command2 == "time":
-					client.send("MSG", {'text': datetime.datetime.today().strftime("Now it's %m/%d/%Y, %I:%M %p")})
+		client.last_active = time.monotonic()
+		await ProtocolCommands.dispatch(command, self, client, arg)
 
-			elif command2 == "away":
-				if len(arg2) < 1:
-					client.away = False
-					client.send("MSG", {'text': 'You are no longer marked as away'})
-				else:
-					client.away = arg2
-					client.send("MSG", {'text': 'You are now marked as away ("%s")' % arg2})
-
-			elif command2 == "roll":
-				param = arg2.split('d')
-				if len(param) != 2:
-					param = arg2.split(' ')
-				if len(param) != 2 or (not param[0].isnumeric()) or (not param[1].isnumeric()):
-					client.send("ERR", {'text': 'Syntax: /roll dice sides'})
-				else:
-					dice = int(param[0])
-					sides = int(param[1])
-					sum = 0
-					if dice < 1 or dice > 1000:
-						client.send("ERR", {'text': 'Bad number of dice'})
-						return
-					if sides < 1 or sides > 1000000000:
-						client.send("ERR", {'text': 'Bad number of sides'})
-						return
-					for i in range(dice):
-						sum += random.randint(1, sides)				
-					self.broadcast("MSG", {'text': client.name+" rolled %dd%d and got %d"%(dice, sides, sum)})
-
-			elif command2 == "mapid":
-				client.send("MSG", {'text': 'Map ID is %d' % self.id})
-
-			elif command2 == "newmap":
-				if client.username:
-					# Definitely change this to find the new map ID a better way, like making SQLite decide it
-					new_id = 1
-					while mapIdExists(new_id):
-						new_id +=1
-						if new_id > Config["Server"]["MaxDBMaps"] and Config["Server"]["MaxDBMaps"] > 0:
-							client.send("ERR", {'text': 'There are too many maps'})
-							return
-					try:
-						client.switch_map(int(new_id))
-						client.map.owner = client.db_id
-						client.send("MSG", {'text': 'Welcome to your new map (id %d)' % new_id})
-					except:
-						client.send("ERR", {'text': 'Couldn\'t switch to the new map'})
-						raise
-				else:
-					client.send("ERR", {'text': 'You must be registered to make a new map.'})
-
-			# maybe combine the list add/remove/list commands together?
-			elif command2 == "ignore":
-				arg2 = arg2.lower()
-				client.ignore_list.add(arg2)
-				client.send("MSG", {'text': '\"%s\" added to ignore list' % arg2})
-			elif command2 == "unignore":
-				arg2 = arg2.lower()
-				if arg2 in client.ignore_list:
-					client.ignore_list.remove(arg2)
-				client.send("MSG", {'text': '\"%s\" removed from ignore list' % arg2})
-			elif command2 == "ignorelist":
-				client.send("MSG", {'text': 'Ignore list: '+str(client.ignore_list)})
-
-			elif command2 == "watch":
-				arg2 = arg2.lower()
-				if arg2 in client.watch_list:
-					client.watch_list.remove(arg2)
-				client.send("MSG", {'text': '\"%s\" added to watch list' % arg2})
-			elif command2 == "unwatch":
-				arg2 = arg2.lower()
-				client.watch_list.remove(arg2)
-				client.send("MSG", {'text': '\"%s\" removed from watch list' % arg2})
-			elif command2 == "watchlist":
-				client.send("MSG", {'text': 'Watch list: '+str(client.watch_list)})
-
-
-
-
-			elif command2 in ["grant", "deny", "revoke"]:
-				if client.mustBeOwner(True):
-					# Check syntax
-					param = arg2.lower().split(' ')
-					if len(param) < 2:
-						client.send("ERR", {'text': 'Must specify a permission and a username'})
-						return
-					# Has to be a valid permission
-					if param[0] not in permission:
-						client.send("ERR", {'text': '"%s" Not a valid permission' % param[0]})
-						return
-					permission_value = permission[param[0]]
-					
-					# Special usernames for map defaults
-					if param[1] == '!default':
-						if command2 == "grant":
-							self.allow |= permission_value
-							self.deny &= ~permission_value
-						elif command2 == "deny":
-							self.allow &= ~permission_value
-							self.deny |= permission_value
-						elif command2 == "revoke":
-							self.allow &= ~permission_value
-							self.deny &= ~permission_value
-						self.broadcast("MSG", {'text': "%s sets the default \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[0], command2)})
-						return
-
-					if param[1] == '!guest':
-						if command2 == "deny":
-							self.guest_deny |= permission_value
-						elif command2 == "revoke":
-							self.guest_deny &= ~permission_value
-						self.broadcast("MSG", {'text': "%s sets the guest \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[0], command2)})
-						return
-
-					# Has to be a user that exists
-					uid = findDBIdByUsername(param[1])
-					if uid == None:
-						client.failedToFind(param[1])
-						return
-
-					# Finally we know it's valid
-					value = None
-					if command2 == "grant":
-						value = True
-					if command2 == "deny":
-						value = False
-					self.set_permission(uid, permission_value, value)
-					self.broadcast("MSG", {'text': "%s sets %s's \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[1], param[0], command2)})
-
-			elif command2 == "permlist":
-				c = Database.cursor()
-				perms = "Defaults: "
-
-				# List map default permissions
-				for k,v in permission.items():
-					if (self.allow & v) == v:
-						perms += "+"+k+" "
-					if (self.deny & v) == v:
-						perms += "-"+k+" "
-					if (self.guest_deny & v) == v:
-						perms += "-"+k+"(guest) "
-
-				perms += "[ul]"
-				for row in c.execute('SELECT username, allow, deny FROM Map_Permission mp, User u WHERE mp.mid=? AND mp.uid=u.uid', (self.id,)):
-					perms += "[li][b]"+row[0] + "[/b]: "
-					for k,v in permission.items():
-						if (row[1] & v) == v: # allow
-							perms += "+"+k+" "
-						if (row[2] & v) == v: #deny
-							perms += "-"+k+" "
-					perms += "[/li]"
-				perms += "[/ul]"
-				client.send("MSG", {'text': perms})
-
-			elif command2 == "mymaps":
-				if client.db_id == None:
-					return
-				c = Database.cursor()
-				maps = "My maps: [ul]"
-				for row in c.execute('SELECT m.mid, m.name FROM Map m WHERE m.owner=?', (client.db_id,)):
-					maps += "[li][b]%s[/b] [command]map %d[/command][/li]" % (row[1], row[0])
-				maps += "[/ul]"
-				client.send("MSG", {'text': maps})
-
-			elif command2 == "publicmaps":
-				c = Database.cursor()
-				maps = "Public maps: [ul]"
-				for row in c.execute('SELECT m.mid, m.name, u.username FROM Map m, User u WHERE m.owner=u.uid and (m.flags&1)!=0'):
-					maps += "[li][b]%s[/b] (%s) [command]map %d[/command][/li]" % (row[1], row[2], row[0])
-				maps += "[/ul]"
-				client.send("MSG", {'text': maps})
-
-			elif command2 == "mapname":
-				if client.mustBeOwner(False):
-					self.name = arg2
-					client.send("MSG", {'text': 'Map name set to \"%s\"' % self.name})
-			elif command2 == "mapdesc":
-				if client.mustBeOwner(False):
-					self.desc = arg2
-					client.send("MSG", {'text': 'Map description set to \"%s\"' % self.desc})
-			elif command2 == "mapowner":
-				if client.mustBeOwner(False):
-					newowner = findDBIdByUsername(arg2)
-					if newowner:
-						self.owner = newowner
-						client.send("MSG", {'text': 'Map owner set to \"%s\"' % self.owner})
-					else:
-						client.send("MSG", {'text': 'Nonexistent account'})
-
-			elif command2 == "mapprivacy":
-				if client.mustBeOwner(False):
-					if arg2 == "public":
-						self.deny &= ~permission['entry']
-						self.flags |= mapflag['public']
-					elif arg2 == "private":
-						self.deny |= permission['entry']
-						self.flags &= ~mapflag['public']
-					elif arg2 == "unlisted":
-						self.deny &= ~permission['entry']
-						self.flags &= ~mapflag['public']
-					else:
-						client.send("ERR", {'text': 'Map privacy must be public, private, or unlisted'})
-			elif command2 == "mapprotect":
-				if client.mustBeOwner(False):
-					if arg2 == "off":
-						self.allow |= permission['sandbox']
-					elif arg2 == "on":
-						self.allow &= ~permission['sandbox']
-					else:
-						client.send("ERR", {'text': 'Map building must be on or off'})
-			elif command2 == "mapbuild":
-				if client.mustBeOwner(True):
-					if arg2 == "on":
-						self.allow |= permission['build']
-					elif arg2 == "off":
-						self.allow &= ~permission['build']
-					else:
-						client.send("ERR", {'text': 'Map building must be on or off'})
-			elif command2 == "defaultfloor":
-				if client.mustBeOwner(False):
-					self.default_turf = arg2
-					client.send("MSG", {'text': 'Map floor changed to %s' % arg2})
-			elif command2 == "mapspawn":
-				if client.mustBeOwner(False):
-					self.start_pos = [client.x, client.y]
-					client.send("MSG", {'text': 'Map start changed to %d,%d' % (client.x, client.y)})
-
-			elif command2 == "listeners":
-				out = ''
-				for i in botwatch_type.keys():
-					c = botwatch_type[i]
-					if self.id in BotWatch[c]:
-						for u in BotWatch[c][self.id]:
-							out += '%s (%s), ' % (u.username, i)
-				client.send("MSG", {'text': 'Listeners here: ' + out})
-
-			elif command2 == "listen":
-				if client.db_id == None:
-					return
-				params = arg2.split()
-				categories = set(params[0].split(','))
-				maps = set([int(x) for x in params[1].split(',')])
-				for c in categories:
-					# find category number from name
-					if c not in botwatch_type:
-						client.send("ERR", {'text': 'Invalid listen category: %s' % c})
-						return
-					category = botwatch_type[c]
-
-					for m in maps:
-						cursor = Database.cursor()
-						cursor.execute('SELECT allow FROM Map_Permission WHERE mid=? AND uid=?', (m, client.db_id,))
-						result = cursor.fetchone()
-						if (result == None) or (result[0] & permission['map_bot'] == 0):
-							client.send("ERR", {'text': 'Don\'t have permission to listen on map: %d' % m})
-							return
-						if m not in BotWatch[category]:
-							BotWatch[category][m] = set()
-						BotWatch[category][m].add(client)
-						client.listening_maps.add((category, m))
-
-						# Send initial data
-						if c == 'build':
-							map = getMapById(m)
-							data = map.map_info()
-							data['remote_map'] = m
-							client.send("MAI", data)
-
-							data = map.map_section(0, 0, map.width-1, map.height-1)
-							data['remote_map'] = m
-							client.send("MAP", data)
-						elif c == 'entry':
-							client.send("WHO", {'list': getMapById(m).who(), 'remote_map': m})
-
-				client.send("MSG", {'text': 'Listening on maps now: ' + str(client.listening_maps)})
-
-			elif command2 == "unlisten":
-				if client.db_id == None:
-					return
-				params = arg2.split()
-				categories = set(params[0].split(','))
-				maps = [int(x) for x in params[1].split(',')]
-				for c in categories:
-					# find category number from name
-					if c not in botwatch_type:
-						client.send("ERR", {'text': 'Invalid listen category: "%s"' % c})
-						return
-					category = botwatch_type[c]
-
-					for m in maps:
-						if (m in BotWatch[category]) and (client in BotWatch[category][m]):
-							BotWatch[category][m].remove(client)
-							if not len(BotWatch[category][m]):
-								del BotWatch[category][m]
-						if (category, m) in client.listening_maps:
-							client.listening_maps.remove((category, m))
-				client.send("MSG", {'text': 'Stopped listening on maps: ' + str(client.listening_maps)})
-
-			elif command2 == "kick" or command2 == "kickban":
-				arg2 = arg2.lower()
-				if client.mustBeOwner(True):
-					u = findClientByUsername(arg2)
-					if u != None:
-						if u.map_id == client.map_id:
-							client.send("MSG", {'text': 'Kicked '+u.nameAndUsername()})
-							u.send("MSG", {'text': 'Kicked by '+client.nameAndUsername()})
-							u.send_home()
-							if command2 == "kickban":
-								self.set_permission(findDBIdByUsername(arg2), permission['entry'], False)
-						else:
-							client.send("ERR", {'text': 'User not on this map'})
-					else:
-						client.send("ERR", {'text': 'User not found'})
-
-			elif command2 == "goback":
-				if len(client.tp_history) > 0:
-					pos = client.tp_history.pop()
-					client.switch_map(pos[0], new_pos=[pos[1], pos[2]], update_history=False)
-				else:
-					client.send("ERR", {'text': 'Nothing in teleport history'})
-
-			elif command2 == "sethome":
-				client.home = [client.map_id, client.x, client.y]
-				client.send("MSG", {'text': 'Home set'})
-			elif command2 == "home":
-				if client.home == None:
-					client.send("ERR", {'text': 'You don\'t have a home set'})
-				else:
-					client.send("MSG", {'text': 'Teleported to your home'})
-					client.send_home()
-			elif command2 == "map":
-				try:
-					if mapIdExists(int(arg2)):
-						if client.switch_map(int(arg2)):
-							client.send("MSG", {'text': 'Teleported to map %s' % arg2})
-					else:
-						client.send("MSG", {'text': 'Map %s doesn\'t exist' % arg2})
-				except:
-					client.send("ERR", {'text': 'Couldn\'t go to map %s' % arg2})
-			elif command2 == "saveme":
-				if client.username == None:
-					client.send("ERR", {'text': 'You are not logged in'})
-				else:
-					client.save()
-					client.send("MSG", {'text': 'Account saved'})
-			elif command2 == "changepass":
-				if client.username == None:
-					client.send("ERR", {'text': 'You are not logged in'})
-				elif len(arg2):
-					client.changepass(arg2)
-					client.send("MSG", {'text': 'Password changed'})
-				else:
-					client.send("ERR", {'text': 'No password given'})
-			elif command2 == "register":
-				if client.username != None:
-					client.send("ERR", {'text': 'Register fail, you already registered'})
-				else:
-					params = arg2.split()
-					if len(params) != 2:
-						client.send("ERR", {'text': 'Syntax is: /register username password'})
-					else:
-						if client.register(filterUsername(params[0]), params[1]):
-							self.broadcast("MSG", {'text': client.name+" has now registered"})
-							self.broadcast("WHO", {'add': client.who()}) # update client view, probably just for the username
-						else:
-							client.send("ERR", {'text': 'Register fail, account already exists'})
-			elif command2 == "login":
-				params = arg2.split()
-				if len(params) != 2:
-					client.send("ERR", {'text': 'Syntax is: /login username password'})
-				else:
-					client.login(filterUsername(params[0]), params[1])
-			elif command2 == "userpic":
-				arg2 = arg2.split(' ')
-				success = False
-
-				if len(arg2) == 1:
-					defaults = {'bunny': [0, 2, 25], 'cat': [0, 2, 26], 'hamster': [0, 8, 25], 'fire': [0, 4,26]}
-					if arg2[0] in defaults:
-						client.pic = defaults[arg2[0]];
-						success = True
-					# temporary thing to allow custom avatars
-					else:
-						if arg2[0].startswith("http"):
-							if imageURLIsOkay(arg2[0]):
-								client.pic = [arg2[0], 0, 0];
-								success = True
-							else:
-								client.send("ERR", {'text': 'URL doesn\'t match any whitelisted sites'})
-								return
-				elif len(arg2) == 2:
-					if arg2[0].isnumeric() and arg2[1].isnumeric():
-						client.pic = [0, int(arg2[0]), int(arg2[1])]
-						success = True
-				if success:
-					self.broadcast("WHO", {'add': client.who()}) # update client view
-				else:
-					client.send("ERR", {'text': 'Syntax is: /userpic sheet x y'})
-
-			elif command2 == "gwho":
-				names = ''
-				for u in AllClients:
-					if len(names) > 0:
-						names += ', '
-					names += u.nameAndUsername()
-				client.send("MSG", {'text': 'List of users connected: '+names})
-			elif command2 == "who":
-				names = ''
-				for u in self.users:
-					if len(names) > 0:
-						names += ', '
-					names += u.nameAndUsername()
-				client.send("MSG", {'text': 'List of users here: '+names})
-
-			elif command2 == "whereare" or command2 == "wa":
-				names = 'Whereare: [ul]'
-				for m in AllMaps:
-					if m.flags & mapflag['public'] == 0:
-						continue
-					names += '[li][b]%s[/b] (%d): ' % (m.name, len(m.users))
-					for u in m.users:
-						names += u.nameAndUsername()+', '
-					names = names.rstrip(', ') + ' [command]map %d[/command][/li]' % m.id
-				names += '[/ul]'
-
-				client.send("MSG", {'text': names})
-
-			elif command2 == "savemap":
-				self.save()
-				self.broadcast("MSG", {'text': client.name+" saved the map"})
-
-			# Server admin commands
-			elif command2 == "broadcast":
-				if client.mustBeServerAdmin() and len(arg2) > 0:
-					broadcastToAll("Admin broadcast: "+arg2)
-			elif command2 == "kill":
-				if client.mustBeServerAdmin():
-					u = findClientByUsername(arg2)
-					if u != None:
-						client.send("MSG", {'text': 'Killed '+u.nameAndUsername()})
-						u.send("MSG", {'text': 'Killed by '+client.nameAndUsername()})
-						u.disconnect()
-			elif command2 == "shutdown":
-				if client.mustBeServerAdmin():
-					if arg2 == "cancel":
-						ServerShutdown[0] = -1
-						broadcastToAll("Server shutdown canceled")
-					elif arg2.isnumeric():
-						ServerShutdown[0] = int(arg2)
-						broadcastToAll("Server shutdown in %d seconds! (started by %s)" % (ServerShutdown[0], client.name))
-			else:
-				client.send("ERR", {'text': 'Invalid command?'})
-
-		elif command == "BAG":
-			if client.db_id != None:
-				c = Database.cursor()
-				if "create" in arg:
-					# restrict type variable
-					if arg['create']['type'] < 0 or arg['create']['type'] > 6:
-						arg['create']['type'] = 0
-					c.execute("INSERT INTO Asset_Info (creator, owner, name, type, regtime, flags) VALUES (?, ?, ?, ?, ?, ?)", (client.db_id, client.db_id, arg['create']['name'], arg['create']['type'], datetime.datetime.now(), 0))
-					c.execute('SELECT last_insert_rowid()')
-					client.send("BAG", {'update': {'id': c.fetchone()[0], 'name': arg['create']['name'], 'type': arg['create']['type']}})
-
-				elif "clone" in arg:
-					c.execute('SELECT name, desc, type, flags, creator, folder, data FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['clone']))
-					row = c.fetchone()
-					if row == None:
-						client.send("ERR", {'text': 'Invalid item ID'})
-						return
-
-					c.execute("INSERT INTO Asset_Info (name, desc, type, flags, creator, folder, data, owner, regtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", \
-                      (row[0], row[1], row[2], row[3], row[4], row[5], row[6], client.db_id, datetime.datetime.now()))
-					c.execute('SELECT last_insert_rowid()')
-					client.send("BAG", {'update': {'id': c.fetchone()[0], 'name': row[0], 'desc': row[1], 'type': row[2], 'flags': row[3], 'folder': row[5], 'data': row[6]}})
-
-				elif "update" in arg:
-					# get the initial data
-					c.execute('SELECT name, desc, flags, folder, data, type FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['update']['id']))
-					result = c.fetchone()
-					if result == None:
-						client.send("ERR", {'text': 'Invalid item ID'})
-						return
-					out = {'name': result[0], 'desc': result[1], 'flags': result[2], 'folder': result[3], 'data': result[4]}
-					asset_type = result[5]
-					if asset_type == 2 and "data" in arg['update'] and not imageURLIsOkay(arg['update']['data']):
-						client.send("ERR", {'text', 'Image asset URL doesn\'t match any whitelisted sites'})
-						return
-					if asset_type == 3 and "data" in arg['update']:
-						tile_test = tileIsOkay(arg['update']['data'])
-						if not tile_test[0]:
-							client.send("ERR", {'text': 'Tile [tt]%s[/tt] rejected (%s)' % (arg['update']['data'], tile_test[1])})
-							return
-
-					# overwrite any specified columns
-					for key, value in arg['update'].items():
-						out[key] = value
-						if type(out[key]) == dict:
-							out[key] = json.dumps(out[key]);
-					c.execute('UPDATE Asset_Info SET name=?, desc=?, flags=?, folder=?, data=? WHERE owner=? AND aid=?', (out['name'], out['desc'], out['flags'], out['folder'], out['data'], client.db_id, arg['update']['id']))
-
-					# send back confirmation
-					client.send("BAG", {'update': arg['update']})
-
-				elif "delete" in arg:
-					# move deleted contents of a deleted folder outside the folder
-					c.execute('SELECT folder FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['delete']))
-					result = c.fetchone()
-					if result == None:
-						client.send("ERR", {'text': 'Invalid item ID'})
-						return
-					# probably better to handle this with a foreign key constraint and cascade?
-					# it's NOT updated client-side but it shouldn't matter
-					c.execute('UPDATE Asset_Info SET folder=? WHERE owner=? AND folder=?', (result[0], client.db_id, arg['delete']))
-
-					# actually delete
-					c.execute('DELETE FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['delete']))
-					client.send("BAG", {'remove': arg['delete']})
-			else:
-				client.send("ERR", {'text': 'Guests don\'t have an inventory currently. Use [tt]/register username password[/tt]'})
-
-		elif command == "EML": #mail
-			if client.db_id != None:
-				c = Database.cursor()
-				if "send" in arg:
-					# todo: definitely needs some limits in place to prevent abuse!
+	def schedule_unload(self, just_loaded=False):
+		""" If nobody is on the map, keep it around for a while and then unload it """
+		if not len(self.users) and self.id not in Config["Server"]["AlwaysLoadedMaps"]:
+			MapCache.add(self, just_loaded)
 
-					# get a list of all the people to mail
-					recipient_id = set([findDBIdByUsername(x) for x in arg['send']['to']])
-					recipient_string = ','.join([str(x) for x in recipient_id])
+	def memory_size(self):
+		""" Rough number of bytes the map takes up while it's loaded """
+		cached = len(self.map_info_text or '') + len(self.map_payload_text or '') + len(self.map_payload_binary or b'')
+		return self.turfs.memory_size() + self.objs.memory_size() + self.chunks.memory_size() + cached
 
-					if any([x == None for x in recipient_id]):
-						client.send("ERR", {'text': 'Couldn\'t find one or more users you wanted to mail'})
-						return
-
-					# let the client know who sent it, since the 'send' argument will get passed along directly
-					arg['send']['from'] = client.username
-
-					# send everyone their mail
-					for id in recipient_id:
-						if id == None:
-							continue
-						c.execute("INSERT INTO Mail (uid, sender, recipients, subject, contents, time, flags) VALUES (?, ?, ?, ?, ?, ?, ?)", (id, client.db_id, recipient_string, arg['send']['subject'], arg['send']['contents'], datetime.datetime.now(), 0))
-
-						# is that person online? tell them!
-						find = findClientByDBId(id)
-						if find:
-							arg['send']['id'] = c.execute('SELECT last_insert_rowid()').fetchone()[0]
-							find.send("EML", {'receive': arg['send']})
-
-					client.send("EML", {'sent': {'subject': arg['send']['subject']}}) #acknowledge
-					client.send("MSG", {'text': 'Sent mail to %d users' % len(recipient_id)})
-
-				elif "read" in arg:
-					c.execute('UPDATE Mail SET flags=1 WHERE uid=? AND id=?', (client.db_id, arg['read']))
-				elif "delete" in arg:
-					c.execute('DELETE FROM Mail WHERE uid=? AND id=?', (client.db_id, arg['delete']))
-
-			else:
-				client.send("ERR", {'text': 'Guests don\'t have mail. Use [tt]/register username password[/tt]'})
-
-		elif command == "MSG":
-			text = arg["text"]
-			self.broadcast("MSG", {'name': client.name, 'username': client.usernameOrId(), 'text': escapeTags(text)}, remote_category=botwatch_type['chat'])
-
-		elif command == "TSD":
-			c = Database.cursor()
-			c.execute('SELECT data FROM Asset_Info WHERE type=4 AND aid=?', (arg['id'],))
-			result = c.fetchone()
-			if result == None:
-				client.send("ERR", {'text': 'Invalid item ID'})
-			else:
-				client.send("TSD", {'id': arg['id'], 'data': result[0]})
-		elif command == "IMG":
-			c = Database.cursor()
-			c.execute('SELECT data FROM Asset_Info WHERE type=2 AND aid=?', (arg['id'],))
-			result = c.fetchone()
-			if result == None:
-				client.send("ERR", {'text': 'Invalid item ID'})
-			else:
-				client.send("IMG", {'id': arg['id'], 'url': result[0]})
-
-		elif command == "MAI":
-			send_all_info = client.mustBeOwner(True, giveError=False)
-			client.send("MAI", self.map.map_info(all_info=send_all_info))
-		elif command == "DEL":
-			x1 = arg["pos"][0]
-			y1 = arg["pos"][1]
-			x2 = arg["pos"][2]
-			y2 = arg["pos"][3]
-			if self.has_permission(client, permission['build'], True) or client.mustBeOwner(True, giveError=False):
-				for x in range(x1, x2+1):
-					for y in range(y1, y2+1):
-						if arg["turf"]:
-							self.turfs[x][y] = None;
-						if arg["obj"]:
-							self.objs[x][y] = None;
-				self.broadcast("MAP", self.map_section(x1, y1, x2, y2))
-
-				# make username available to listeners
-				arg['username'] = client.usernameOrId()
-				self.broadcast("DEL", arg, remote_only=True, remote_category=botwatch_type['build'])
-			else:
-				client.send("MAP", self.map_section(x1, y1, x2, y2))
-				client.send("ERR", {'text': 'Building is disabled on this map'})
-		elif command == "PUT":
-			x = arg["pos"][0]
-			y = arg["pos"][1]
-			if self.has_permission(client, permission['build'], True) or client.mustBeOwner(True, giveError=False):
-				# verify the the tiles you're attempting to put down are actually good
-				if arg["obj"]: #object
-					tile_test = [tileIsOkay(x) for x in arg["atom"]]
-					if all(x[0] for x in tile_test): # all tiles pass the test
-						self.objs[x][y] = arg["atom"]
-						self.broadcast("MAP", self.map_section(x, y, x, y))
-					else:
-						# todo: give a reason?
-						client.send("MAP", self.map_section(x, y, x, y))
-						client.send("ERR", {'text': 'Placed objects rejected'})
-				else: #turf
-					tile_test = tileIsOkay(arg["atom"])
-					if tile_test[0]:
-						self.turfs[x][y] = arg["atom"]
-						self.broadcast("MAP", self.map_section(x, y, x, y))
-
-						# make username available to listeners
-						arg['username'] = client.usernameOrId()
-						self.broadcast("PUT", arg, remote_only=True, remote_category=botwatch_type['build'])
-					else:
-						client.send("MAP", self.map_section(x, y, x, y))
-						client.send("ERR", {'text': 'Tile [tt]%s[/tt] rejected (%s)' % (arg["atom"], tile_test[1])})
-			else:
-				client.send("MAP", self.map_section(x, y, x, y))
-				client.send("ERR", {'text': 'Building is disabled on this map'})
-		elif command == "BLK":
-			if self.has_permission(client, permission['bulk_build'], False) or client.mustBeOwner(True, giveError=False):
-				# verify the tiles
-				for turf in arg["turf"]:
-					if not tileIsOkay(turf[2])[0]:
-						client.send("ERR", {'text': 'Bad turf in bulk build'})
-						return
-				for obj in arg["obj"]:
-					tile_test = [tileIsOkay(x) for x in obj[2]]
-					if any(not x[0] for x in tile_test): # any tiles don't pass the test
-						client.send("ERR", {'text': 'Bad obj in bulk build'})
-						return
-				# make username available to other clients
-				arg['username'] = client.usernameOrId()
-
-				# place the tiles
-				for turf in arg["turf"]:
-					x = turf[0]
-					y = turf[1]
-					a = turf[2]
-					width = 1
-					height = 1
-					if len(turf) == 5:
-						width = turf[3]
-						height = turf[4]
-					for w in range(0, width):
-						for h in range(0, height):
-							self.turfs[x+w][y+h] = a
-				# place the object lists
-				for obj in arg["obj"]:
-					x = obj[0]
-					y = obj[1]
-					a = obj[2]
-					width = 1
-					height = 1
-					if len(turf) == 5:
-						width = turf[3]
-						height = turf[4]
-					for w in range(0, width):
-						for h in range(0, height):
-							self.objs[x+w][y+h] = a
-				self.broadcast("BLK", arg, remote_category=botwatch_type['build'])
-			else:
-				client.send("ERR", {'text': 'Bulk building is disabled on this map'})
+	def unload(self):
+		if len(self.users) or self not in AllMaps:
+			return
+		print("Unloading map "+str(self.id))
+		self.save()
+		self.clean_up()
+		AllMaps.remove(self)
 
 	def clean_up(self):
 		""" Clean up everything before a map unload """
-		pass
+		self.permission_cache = None
+
+def createMap(connection, values, make_data, taken, limit):
+	""" Runs on the database thread: save a new map under the lowest map ID that isn't in use,
+	and return that ID, or None if there are too many maps """
+	taken = taken | set(row[0] for row in connection.execute('SELECT mid FROM Map'))
+	new_id = 1
+	while new_id in taken:
+		new_id += 1
+	if limit > 0 and new_id > limit:
+		return None
+	Persist.write(connection, [], [values[:-1] + (new_id,)], [(make_data, new_id)])
+	return new_id
+
+async def newMap(owner):
+	""" Make a new blank map belonging to someone, and return its ID, or None if there are too many maps """
+	m = Map()
+	m.owner = owner
+	# Maps that are loaded, being loaded or waiting to be saved might not be in the database yet
+	taken = set(x.id for x in AllMaps) | set(MapLoads) | set(Persist.maps)
+	# Picking the ID and saving the map happen together on the database thread, so two new maps can't get the same one
+	return await DB.run(createMap, m.save_values(), m.save_data(), taken, Config["Server"]["MaxDBMaps"])
+
+Watchdog.label(Map.receive_command, lambda l: '%s on map %d from %s' % (l['command'], l['self'].id, l['client'].nameAndUsername()))
+Watchdog.label(Map.load, lambda l: 'Loading map %d' % l['mapId'])
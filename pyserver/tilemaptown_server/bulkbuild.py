@@ -0,0 +1,71 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from .tilestorage import tileKey
+from .region import isInteger, clipRegion, regionArea
+
+# Bulk building: turning a BLK message into edits for Map.edit.
+# Everything is checked before anything is changed, so a bad entry anywhere
+# means none of the message gets applied.
+
+def bulkEdits(arg, width, height, tileIsOkay, max_area):
+	""" Turn a BLK message into [layer, x1, y1, x2, y2, tile] edits, clipped to the map.
+	Returns (edits, None), or (None, error message) if something in it is invalid or it changes over max_area cells. """
+	checked = {} # tile key -> whether it passed, so each unique tile is only tested once
+
+	edits = []
+	area = 0
+	for layer in ("turf", "obj"):
+		for rect in arg.get(layer, ()):
+			if type(rect) != list or len(rect) not in (3, 5):
+				return (None, 'Bad %s in bulk build' % layer)
+			x, y, tile = rect[0], rect[1], rect[2]
+			w, h = (rect[3], rect[4]) if len(rect) == 5 else (1, 1)
+			if not (isInteger(x) and isInteger(y) and isInteger(w) and isInteger(h)) or w < 1 or h < 1:
+				return (None, 'Bad %s in bulk build' % layer)
+
+			# Objects are lists of tiles, and every one of them has to pass
+			if layer == "obj" and type(tile) != list:
+				return (None, 'Bad obj in bulk build')
+			key = tileKey(tile)
+			okay = checked.get(key)
+			if okay == None:
+				try:
+					if layer == "obj":
+						okay = all(tileIsOkay(t)[0] for t in tile)
+					else:
+						okay = tileIsOkay(tile)[0]
+				except ValueError: # string that looked like JSON but wasn't
+					okay = False
+				checked[key] = okay
+			if not okay:
+				return (None, 'Bad %s in bulk build' % layer)
+
+			# Only the part that's actually on the map
+			region = clipRegion(x, y, x+w-1, y+h-1, width, height)
+			if region != None:
+				area += regionArea(region)
+				if max_area and area > max_area:
+					return (None, 'Bulk build is too big (over %d tiles)' % max_area)
+				edits.append([layer, region[0], region[1], region[2], region[3], tile])
+	return (edits, None)
+
+def bulkMessage(edits):
+	""" BLK message parameters that describe a list of edits """
+	out = {"turf": [], "obj": []}
+	for layer, x1, y1, x2, y2, tile in edits:
+		out[layer].append([x1, y1, tile, x2-x1+1, y2-y1+1])
+	return out
@@ -0,0 +1,1036 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Handlers for protocol messages and for the slash commands sent inside CMD.
+# Protocol handlers take (map, client, arg), and slash command handlers take
+# (map, client, command, arg) so one handler can serve several names.
+
+import json, random, datetime, threading
+from .buildglobal import *
+from .buildmap import escapeTags, imageURLIsOkay, tileIsOkay, newMap
+from .bulkbuild import bulkEdits, bulkMessage
+from .region import RegionStats, regionFromPos, regionArea
+from .router import ProtocolCommands, SlashCommands
+from .ratelimit import RateLimitStats
+from .watchdog import Watchdog
+from .profiler import Profiler
+from .mail import loadMailPage, sendMail
+
+@ProtocolCommands.register("MOV")
+async def protocolMOV(map, client, arg):
+	if Config["Server"]["MoveTickRate"] > 0:
+		map.queue_move(client, client.x, client.y, False)
+	else:
+		map.broadcast("MOV", {'id': client.id, 'from': arg["from"], 'to': arg["to"]}, remote_category=botwatch_type['move'], area=(arg["from"][0], arg["from"][1], arg["to"][0], arg["to"][1]))
+	client.moveTo(arg["to"][0], arg["to"][1])
+
+@ProtocolCommands.register("CMD")
+async def protocolCMD(map, client, arg):
+	# separate into command and arguments
+	text = arg["text"]
+	space = text.find(" ")
+	command2 = text.lower()
+	arg2 = ""
+	if space >= 0:
+		command2 = text[0:space].lower()
+		arg2 = text[space+1:]
+
+	if not await SlashCommands.dispatch(command2, map, client, command2, arg2):
+		client.send("ERR", {'text': 'Invalid command?'})
+
+@ProtocolCommands.register("BAG")
+async def protocolBAG(map, client, arg):
+	if client.db_id != None:
+		if "create" in arg:
+			# restrict type variable
+			if arg['create']['type'] < 0 or arg['create']['type'] > 6:
+				arg['create']['type'] = 0
+			aid = await DB.execute("INSERT INTO Asset_Info (creator, owner, name, type, regtime, flags) VALUES (?, ?, ?, ?, ?, ?)", (client.db_id, client.db_id, arg['create']['name'], arg['create']['type'], datetime.datetime.now(), 0))
+			client.send("BAG", {'update': {'id': aid, 'name': arg['create']['name'], 'type': arg['create']['type']}})
+
+		elif "clone" in arg:
+			row = await DB.fetchone('SELECT name, desc, type, flags, creator, folder, data FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['clone']))
+			if row == None:
+				client.send("ERR", {'text': 'Invalid item ID'})
+				return
+
+			aid = await DB.execute("INSERT INTO Asset_Info (name, desc, type, flags, creator, folder, data, owner, regtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+                      (row[0], row[1], row[2], row[3], row[4], row[5], row[6], client.db_id, datetime.datetime.now()))
+			client.send("BAG", {'update': {'id': aid, 'name': row[0], 'desc': row[1], 'type': row[2], 'flags': row[3], 'folder': row[5], 'data': row[6]}})
+
+		elif "update" in arg:
+			# get the initial data
+			result = await DB.fetchone('SELECT name, desc, flags, folder, data, type FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['update']['id']))
+			if result == None:
+				client.send("ERR", {'text': 'Invalid item ID'})
+				return
+			out = {'name': result[0], 'desc': result[1], 'flags': result[2], 'folder': result[3], 'data': result[4]}
+			asset_type = result[5]
+			if asset_type == 2 and "data" in arg['update'] and not imageURLIsOkay(arg['update']['data']):
+				client.send("ERR", {'text', 'Image asset URL doesn\'t match any whitelisted sites'})
+				return
+			if asset_type == 3 and "data" in arg['update']:
+				tile_test = tileIsOkay(arg['update']['data'])
+				if not tile_test[0]:
+					client.send("ERR", {'text': 'Tile [tt]%s[/tt] rejected (%s)' % (arg['update']['data'], tile_test[1])})
+					return
+
+			# overwrite any specified columns
+			for key, value in arg['update'].items():
+				out[key] = value
+				if type(out[key]) == dict:
+					out[key] = json.dumps(out[key]);
+			DB.write('UPDATE Asset_Info SET name=?, desc=?, flags=?, folder=?, data=? WHERE owner=? AND aid=?', (out['name'], out['desc'], out['flags'], out['folder'], out['data'], client.db_id, arg['update']['id']))
+
+			# send back confirmation
+			client.send("BAG", {'update': arg['update']})
+
+		elif "delete" in arg:
+			# move deleted contents of a deleted folder outside the folder
+			result = await DB.fetchone('SELECT folder FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['delete']))
+			if result == None:
+				client.send("ERR", {'text': 'Invalid item ID'})
+				return
+			# probably better to handle this with a foreign key constraint and cascade?
+			# it's NOT updated client-side but it shouldn't matter
+			DB.write('UPDATE Asset_Info SET folder=? WHERE owner=? AND folder=?', (result[0], client.db_id, arg['delete']))
+
+			# actually delete
+			DB.write('DELETE FROM Asset_Info WHERE owner=? AND aid=?', (client.db_id, arg['delete']))
+			client.send("BAG", {'remove': arg['delete']})
+	else:
+		client.send("ERR", {'text': 'Guests don\'t have an inventory currently. Use [tt]/register username password[/tt]'})
+
+@ProtocolCommands.register("EML")
+async def protocolEML(map, client, arg):
+	if client.db_id != None:
+		if "send" in arg:
+			# todo: definitely needs some limits in place to prevent abuse!
+
+			# look up everyone to mail and deliver it to all of them together
+			send = arg['send']
+			delivered = await DB.run(sendMail, client.db_id, send['to'], send['subject'], send['contents'])
+			if delivered == None:
+				client.send("ERR", {'text': 'Couldn\'t find one or more users you wanted to mail'})
+				return
+
+			# let the client know who sent it, since the 'send' argument will get passed along directly
+			send['from'] = client.username
+
+			# is anyone online? tell them!
+			for mail_id, id in delivered:
+				find = findClientByDBId(id)
+				if find:
+					find.send("EML", {'receive': dict(send, id=mail_id)})
+
+			client.send("EML", {'sent': {'subject': send['subject']}}) #acknowledge
+			client.send("MSG", {'text': 'Sent mail to %d users' % len(delivered)})
+
+		elif "page" in arg:
+			mail, next_page = await DB.run(loadMailPage, client.db_id, int(arg['page']), Config["Server"]["MailPageSize"])
+			client.send("EML", {'page': mail, 'next': next_page})
+		elif "read" in arg:
+			DB.write('UPDATE Mail SET flags=1 WHERE uid=? AND id=?', (client.db_id, arg['read']))
+		elif "delete" in arg:
+			DB.write('DELETE FROM Mail WHERE uid=? AND id=?', (client.db_id, arg['delete']))
+
+	else:
+		client.send("ERR", {'text': 'Guests don\'t have mail. Use [tt]/register username password[/tt]'})
+
+@ProtocolCommands.register("MSG")
+async def protocolMSG(map, client, arg):
+	text = arg["text"]
+	map.broadcast("MSG", {'name': client.name, 'username': client.usernameOrId(), 'text': escapeTags(text)}, remote_category=botwatch_type['chat'])
+
+@ProtocolCommands.register("TSD")
+async def protocolTSD(map, client, arg):
+	result = await DB.fetchone('SELECT data FROM Asset_Info WHERE type=4 AND aid=?', (arg['id'],))
+	if result == None:
+		client.send("ERR", {'text': 'Invalid item ID'})
+	else:
+		client.send("TSD", {'id': arg['id'], 'data': result[0]})
+
+@ProtocolCommands.register("IMG")
+async def protocolIMG(map, client, arg):
+	result = await DB.fetchone('SELECT data FROM Asset_Info WHERE type=2 AND aid=?', (arg['id'],))
+	if result == None:
+		client.send("ERR", {'text': 'Invalid item ID'})
+	else:
+		client.send("IMG", {'id': arg['id'], 'url': result[0]})
+
+@ProtocolCommands.register("DIF")
+async def protocolDIF(map, client, arg):
+	# Client wants to catch up on edits after a change ID it already has
+	edits = map.changes_since(int(arg["since"]))
+	if edits != None:
+		client.send("DIF", {'edits': edits, 'id': map.change_id})
+	elif Config["Server"]["InterestManagement"]:
+		# Too far behind, so resend everything in view
+		client.view_chunks = None
+		client.known_chunks = {}
+		client.update_view()
+		client.send("DIF", {'edits': [], 'id': map.change_id})
+	else:
+		client.send_raw(map.map_payload(binary=client.binary_protocol))
+		client.send("DIF", {'edits': [], 'id': map.change_id})
+
+@ProtocolCommands.register("VEW")
+async def protocolVEW(map, client, arg):
+	# Client says how much of the map it can show
+	client.view_size = [min(max(int(arg["size"][0]), 1), Config["Server"]["MaxViewRadius"]*2+1), min(max(int(arg["size"][1]), 1), Config["Server"]["MaxViewRadius"]*2+1)]
+	client.update_view()
+
+@ProtocolCommands.register("MAI")
+async def protocolMAI(map, client, arg):
+	send_all_info = client.mustBeOwner(True, giveError=False)
+	client.send("MAI", map.map_info(all_info=send_all_info))
+
+@ProtocolCommands.register("DEL")
+async def protocolDEL(map, client, arg):
+	region = regionFromPos(arg.get("pos"), map.width, map.height)
+	if region == None:
+		client.send("ERR", {'text': 'Can\'t delete outside of the map'})
+		return
+	x1, y1, x2, y2 = region
+	too_big = Config["Server"]["MaxEditArea"] and regionArea(region) > Config["Server"]["MaxEditArea"]
+	if map.has_permission(client, permission['build'], True) or client.mustBeOwner(True, giveError=False):
+		if too_big:
+			# don't resend the area either, since sending that much map is what the limit is there to prevent
+			client.send("ERR", {'text': 'Can\'t delete more than %d tiles at once' % Config["Server"]["MaxEditArea"]})
+			return
+		edits = []
+		if arg["turf"]:
+			edits.append(["turf", x1, y1, x2, y2, None])
+		if arg["obj"]:
+			edits.append(["obj", x1, y1, x2, y2, None])
+		if len(edits):
+			change_id, area = map.edit(edits, "DEL")
+			map.broadcast("DIF", {'edits': edits, 'id': change_id, 'username': client.usernameOrId()}, remote_category=botwatch_type['build'], area=area)
+
+		# make username available to listeners
+		arg['username'] = client.usernameOrId()
+		arg['pos'] = [x1, y1, x2, y2]
+		map.broadcast("DEL", arg, remote_only=True, remote_category=botwatch_type['build'])
+	else:
+		if not too_big:
+			map.resend_section(client, x1, y1, x2, y2)
+		client.send("ERR", {'text': 'Building is disabled on this map'})
+
+@ProtocolCommands.register("PUT")
+async def protocolPUT(map, client, arg):
+	region = regionFromPos(arg.get("pos"), map.width, map.height)
+	if region == None or len(arg["pos"]) != 2:
+		client.send("ERR", {'text': 'Can\'t build outside of the map'})
+		return
+	x = region[0]
+	y = region[1]
+	if map.has_permission(client, permission['build'], True) or client.mustBeOwner(True, giveError=False):
+		# verify the the tiles you're attempting to put down are actually good
+		if arg["obj"]: #object
+			tile_test = [tileIsOkay(x) for x in arg["atom"]]
+			if all(x[0] for x in tile_test): # all tiles pass the test
+				edits = [["obj", x, y, x, y, arg["atom"]]]
+				change_id, area = map.edit(edits, "PUT")
+				map.broadcast("DIF", {'edits': edits, 'id': change_id, 'username': client.usernameOrId()}, remote_category=botwatch_type['build'], area=area)
+			else:
+				# todo: give a reason?
+				map.resend_section(client, x, y, x, y)
+				client.send("ERR", {'text': 'Placed objects rejected'})
+		else: #turf
+			tile_test = tileIsOkay(arg["atom"])
+			if tile_test[0]:
+				edits = [["turf", x, y, x, y, arg["atom"]]]
+				change_id, area = map.edit(edits, "PUT")
+				map.broadcast("DIF", {'edits': edits, 'id': change_id, 'username': client.usernameOrId()}, remote_category=botwatch_type['build'], area=area)
+
+				# make username available to listeners
+				arg['username'] = client.usernameOrId()
+				map.broadcast("PUT", arg, remote_only=True, remote_category=botwatch_type['build'])
+			else:
+				map.resend_section(client, x, y, x, y)
+				client.send("ERR", {'text': 'Tile [tt]%s[/tt] rejected (%s)' % (arg["atom"], tile_test[1])})
+	else:
+		map.resend_section(client, x, y, x, y)
+		client.send("ERR", {'text': 'Building is disabled on this map'})
+
+@ProtocolCommands.register("BLK")
+async def protocolBLK(map, client, arg):
+	if map.has_permission(client, permission['bulk_build'], False) or client.mustBeOwner(True, giveError=False):
+		# verify everything before changing anything
+		edits, error = bulkEdits(arg, map.width, map.height, tileIsOkay, Config["Server"]["MaxEditArea"])
+		if error != None:
+			client.send("ERR", {'text': error})
+			return
+		if not len(edits):
+			return
+
+		# send out what was actually placed, clipped to the map
+		change_id, area = map.edit(edits, "BLK")
+		message = bulkMessage(edits)
+		message['username'] = client.usernameOrId()
+		message['id'] = change_id
+		map.broadcast("BLK", message, remote_category=botwatch_type['build'], area=area)
+	else:
+		client.send("ERR", {'text': 'Bulk building is disabled on this map'})
+
+@SlashCommands.register("nick")
+async def commandNick(map, client, command, arg):
+	if len(arg) > 0 and not arg.isspace():
+		map.broadcast("MSG", {'text': "\""+client.name+"\" is now known as \""+escapeTags(arg)+"\""})
+		client.name = escapeTags(arg)
+		map.broadcast("WHO", {'add': client.who()}, remote_category=botwatch_type['entry']) # update client view
+
+@SlashCommands.register("client_settings")
+async def commandClientSettings(map, client, command, arg):
+	client.client_settings = arg
+
+@SlashCommands.register("tell", "msg", "p")
+async def commandTell(map, client, command, arg):
+	space2 = arg.find(" ")
+	if space2 >= 0:
+		username = arg[0:space2].lower()
+		privtext = arg[space2+1:]
+		if privtext.isspace():
+			client.send("ERR", {'text': 'Tell them what?'})
+		else:
+			u = findClientByUsername(username)
+			if u:
+				if not client.inBanList(u.ignore_list, 'message %s' % u.name):
+					client.send("PRI", {'text': privtext, 'name':u.name, 'username': u.usernameOrId(), 'receive': False})
+					u.send("PRI", {'text': privtext, 'name':client.name, 'username': client.usernameOrId(), 'receive': True})
+			else:
+				client.failedToFind(username)
+	else:
+		client.send("ERR", {'text': 'Private message who?'})
+
+# carrying
+@SlashCommands.register("carry")
+async def commandCarry(map, client, command, arg):
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	my_username = client.usernameOrId()
+	if my_username in u.requests:
+		client.send("ERR", {'text': 'You\'ve already sent them a request'})
+		u.renew_request(my_username)
+	elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
+		client.send("MSG", {'text': 'You requested to carry '+arg})
+		u.send("MSG", {'text': client.nameAndUsername()+' wants to carry you', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
+		u.add_request(my_username, 'carry')
+
+@SlashCommands.register("hopoff")
+async def commandHopoff(map, client, command, arg):
+	client.dismount()
+
+@SlashCommands.register("dropoff")
+async def commandDropoff(map, client, command, arg):
+	u = findClientByUsername(arg, inside=client.passengers)
+	if u:
+		u.dismount()
+	else:
+		client.send("ERR", {'text': 'You aren\'t carrying %s' % arg})
+
+@SlashCommands.register("carrywho")
+async def commandCarrywho(map, client, command, arg):
+	if len(client.passengers):
+		names = ''
+		for u in client.passengers:
+			if len(names) > 0:
+				names += ', '
+			names += '%s (%s)' % (u.name, u.usernameOrId())
+		client.send("MSG", {'text': "You are carrying %s" % names})
+	else:
+		client.send("MSG", {'text': "You aren\'t carrying anything"})
+
+@SlashCommands.register("ridewho")
+async def commandRidewho(map, client, command, arg):
+	if client.vehicle:
+		client.send("MSG", {'text': "You are riding %s" % client.vehicle.nameAndUsername()})
+	else:
+		client.send("MSG", {'text': "You aren\'t riding anything"})
+
+@SlashCommands.register("rideend")
+async def commandRideend(map, client, command, arg):
+	temp = set(client.passengers)
+	for u in temp:
+		u.dismount()
+
+@SlashCommands.register("tpa")
+async def commandTpa(map, client, command, arg):
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	my_username = client.usernameOrId()
+	if my_username in u.requests:
+		client.send("ERR", {'text': 'You\'ve already sent them a request'})
+		u.renew_request(my_username)
+	elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
+		client.send("MSG", {'text': 'You requested a teleport to '+arg})
+		u.send("MSG", {'text': client.nameAndUsername()+' wants to teleport to you', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
+		u.add_request(my_username, 'tpa')
+
+@SlashCommands.register("tpahere")
+async def commandTpahere(map, client, command, arg):
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	my_username = client.usernameOrId()
+	if my_username in u.requests:
+		client.send("ERR", {'text': 'You\'ve already sent them a request'})
+		u.renew_request(my_username)
+	elif not client.inBanList(u.ignore_list, 'message %s' % u.name):
+		client.send("MSG", {'text': 'You requested that '+arg+' teleport to you'})
+		u.send("MSG", {'text': client.nameAndUsername()+' wants you to teleport to them', 'buttons': ['Accept', 'tpaccept '+my_username, 'Decline', 'tpdeny '+my_username]})
+		u.add_request(my_username, 'tpahere')
+
+@SlashCommands.register("tpaccept", "hopon")
+async def commandTpaccept(map, client, command, arg):
+	arg = arg.lower()
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	if arg not in client.requests:
+		client.send("ERR", {'text': 'No pending request from '+arg})
+	else:
+		client.send("MSG", {'text': 'You accepted a teleport request from '+arg})
+		u.send("MSG", {'text': u.nameAndUsername()+" accepted your request"})
+		request = client.requests[arg]
+		if request[1] == 'tpa':
+			await u.switch_map(u.map_id, new_pos=[client.x, client.y])
+		elif request[1] == 'tpahere':
+			await client.switch_map(u.map_id, new_pos=[u.x, u.y])
+		elif request[1] == 'carry':
+			await client.ride(u)
+		client.remove_request(arg)
+
+@SlashCommands.register("tpdeny", "tpdecline")
+async def commandTpdeny(map, client, command, arg):
+	arg = arg.lower()
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	if arg not in client.requests:
+		client.send("ERR", {'text': 'No pending request from '+arg})
+	else:
+		client.send("MSG", {'text': 'You rejected a teleport request from '+arg})
+		u.send("MSG", {'text': u.nameAndUsername()+" rejected your request"})
+		client.remove_request(arg)
+
+@SlashCommands.register("tpcancel")
+async def commandTpcancel(map, client, command, arg):
+	arg = arg.lower()
+	u = findClientByUsername(arg)
+	if u == None:
+		client.failedToFind(arg)
+		return
+	my_username = client.usernameOrId()
+	if my_username in u.requests:
+		client.send("MSG", {'text': 'Canceled request to '+arg})
+		u.remove_request(my_username)
+	else:
+		client.send("ERR", {'text': 'No request to cancel'})
+
+@SlashCommands.register("time")
+async def commandTime(map, client, command, arg):
+		client.send("MSG", {'text': datetime.datetime.today().strftime("Now it's %m/%d/%Y, %I:%M %p")})
+
+@SlashCommands.register("away")
+async def commandAway(map, client, command, arg):
+	if len(arg) < 1:
+		client.away = False
+		client.send("MSG", {'text': 'You are no longer marked as away'})
+	else:
+		client.away = arg
+		client.send("MSG", {'text': 'You are now marked as away ("%s")' % arg})
+
+@SlashCommands.register("roll")
+async def commandRoll(map, client, command, arg):
+	param = arg.split('d')
+	if len(param) != 2:
+		param = arg.split(' ')
+	if len(param) != 2 or (not param[0].isnumeric()) or (not param[1].isnumeric()):
+		client.send("ERR", {'text': 'Syntax: /roll dice sides'})
+	else:
+		dice = int(param[0])
+		sides = int(param[1])
+		sum = 0
+		if dice < 1 or dice > 1000:
+			client.send("ERR", {'text': 'Bad number of dice'})
+			return
+		if sides < 1 or sides > 1000000000:
+			client.send("ERR", {'text': 'Bad number of sides'})
+			return
+		for i in range(dice):
+			sum += random.randint(1, sides)				
+		map.broadcast("MSG", {'text': client.name+" rolled %dd%d and got %d"%(dice, sides, sum)})
+
+@SlashCommands.register("mapid")
+async def commandMapid(map, client, command, arg):
+	client.send("MSG", {'text': 'Map ID is %d' % map.id})
+
+@SlashCommands.register("newmap")
+async def commandNewmap(map, client, command, arg):
+	if client.username:
+		new_id = await newMap(client.db_id)
+		if new_id == None:
+			client.send("ERR", {'text': 'There are too many maps'})
+			return
+		try:
+			await client.switch_map(new_id)
+			client.send("MSG", {'text': 'Welcome to your new map (id %d)' % new_id})
+		except:
+			client.send("ERR", {'text': 'Couldn\'t switch to the new map'})
+			raise
+	else:
+		client.send("ERR", {'text': 'You must be registered to make a new map.'})
+
+# maybe combine the list add/remove/list commands together?
+@SlashCommands.register("ignore")
+async def commandIgnore(map, client, command, arg):
+	arg = arg.lower()
+	client.ignore_list.add(arg)
+	client.send("MSG", {'text': '\"%s\" added to ignore list' % arg})
+
+@SlashCommands.register("unignore")
+async def commandUnignore(map, client, command, arg):
+	arg = arg.lower()
+	if arg in client.ignore_list:
+		client.ignore_list.remove(arg)
+	client.send("MSG", {'text': '\"%s\" removed from ignore list' % arg})
+
+@SlashCommands.register("ignorelist")
+async def commandIgnorelist(map, client, command, arg):
+	client.send("MSG", {'text': 'Ignore list: '+str(client.ignore_list)})
+
+@SlashCommands.register("watch")
+async def commandWatch(map, client, command, arg):
+	arg = arg.lower()
+	if arg in client.watch_list:
+		client.watch_list.remove(arg)
+	client.send("MSG", {'text': '\"%s\" added to watch list' % arg})
+
+@SlashCommands.register("unwatch")
+async def commandUnwatch(map, client, command, arg):
+	arg = arg.lower()
+	client.watch_list.remove(arg)
+	client.send("MSG", {'text': '\"%s\" removed from watch list' % arg})
+
+@SlashCommands.register("watchlist")
+async def commandWatchlist(map, client, command, arg):
+	client.send("MSG", {'text': 'Watch list: '+str(client.watch_list)})
+
+@SlashCommands.register("grant", "deny", "revoke")
+async def commandGrant(map, client, command, arg):
+	if client.mustBeOwner(True):
+		# Check syntax
+		param = arg.lower().split(' ')
+		if len(param) < 2:
+			client.send("ERR", {'text': 'Must specify a permission and a username'})
+			return
+		# Has to be a valid permission
+		if param[0] not in permission:
+			client.send("ERR", {'text': '"%s" Not a valid permission' % param[0]})
+			return
+		permission_value = permission[param[0]]
+
+		# Special usernames for map defaults
+		if param[1] == '!default':
+			if command == "grant":
+				map.allow |= permission_value
+				map.deny &= ~permission_value
+			elif command == "deny":
+				map.allow &= ~permission_value
+				map.deny |= permission_value
+			elif command == "revoke":
+				map.allow &= ~permission_value
+				map.deny &= ~permission_value
+			map.broadcast("MSG", {'text': "%s sets the default \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[0], command)})
+			return
+
+		if param[1] == '!guest':
+			if command == "deny":
+				map.guest_deny |= permission_value
+			elif command == "revoke":
+				map.guest_deny &= ~permission_value
+			map.broadcast("MSG", {'text': "%s sets the guest \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[0], command)})
+			return
+
+		# Has to be a user that exists
+		uid = await findDBIdByUsername(param[1])
+		if uid == None:
+			client.failedToFind(param[1])
+			return
+
+		# Finally we know it's valid
+		value = None
+		if command == "grant":
+			value = True
+		if command == "deny":
+			value = False
+		map.set_permission(uid, permission_value, value)
+		map.broadcast("MSG", {'text': "%s sets %s's \"%s\" permission to [b]%s[/b]" % (client.nameAndUsername(), param[1], param[0], command)})
+
+@SlashCommands.register("permlist")
+async def commandPermlist(map, client, command, arg):
+	perms = "Defaults: "
+
+	# List map default permissions
+	for k,v in permission.items():
+		if (map.allow & v) == v:
+			perms += "+"+k+" "
+		if (map.deny & v) == v:
+			perms += "-"+k+" "
+		if (map.guest_deny & v) == v:
+			perms += "-"+k+"(guest) "
+
+	perms += "[ul]"
+	for row in await DB.fetchall('SELECT username, allow, deny FROM Map_Permission mp, User u WHERE mp.mid=? AND mp.uid=u.uid', (map.id,)):
+		perms += "[li][b]"+row[0] + "[/b]: "
+		for k,v in permission.items():
+			if (row[1] & v) == v: # allow
+				perms += "+"+k+" "
+			if (row[2] & v) == v: #deny
+				perms += "-"+k+" "
+		perms += "[/li]"
+	perms += "[/ul]"
+	client.send("MSG", {'text': perms})
+
+@SlashCommands.register("mymaps")
+async def commandMymaps(map, client, command, arg):
+	if client.db_id == None:
+		return
+	maps = "My maps: [ul]"
+	for row in await DB.fetchall('SELECT m.mid, m.name FROM Map m WHERE m.owner=?', (client.db_id,)):
+		maps += "[li][b]%s[/b] [command]map %d[/command][/li]" % (row[1], row[0])
+	maps += "[/ul]"
+	client.send("MSG", {'text': maps})
+
+@SlashCommands.register("publicmaps")
+async def commandPublicmaps(map, client, command, arg):
+	maps = "Public maps: [ul]"
+	for row in await DB.fetchall('SELECT m.mid, m.name, u.username FROM Map m, User u WHERE m.owner=u.uid and (m.flags&1)!=0'):
+		maps += "[li][b]%s[/b] (%s) [command]map %d[/command][/li]" % (row[1], row[2], row[0])
+	maps += "[/ul]"
+	client.send("MSG", {'text': maps})
+
+@SlashCommands.register("mapname")
+async def commandMapname(map, client, command, arg):
+	if client.mustBeOwner(False):
+		map.name = arg
+		client.send("MSG", {'text': 'Map name set to \"%s\"' % map.name})
+
+@SlashCommands.register("mapdesc")
+async def commandMapdesc(map, client, command, arg):
+	if client.mustBeOwner(False):
+		map.desc = arg
+		client.send("MSG", {'text': 'Map description set to \"%s\"' % map.desc})
+
+@SlashCommands.register("mapowner")
+async def commandMapowner(map, client, command, arg):
+	if client.mustBeOwner(False):
+		newowner = await findDBIdByUsername(arg)
+		if newowner:
+			map.owner = newowner
+			client.send("MSG", {'text': 'Map owner set to \"%s\"' % map.owner})
+		else:
+			client.send("MSG", {'text': 'Nonexistent account'})
+
+@SlashCommands.register("mapprivacy")
+async def commandMapprivacy(map, client, command, arg):
+	if client.mustBeOwner(False):
+		if arg == "public":
+			map.deny &= ~permission['entry']
+			map.flags |= mapflag['public']
+		elif arg == "private":
+			map.deny |= permission['entry']
+			map.flags &= ~mapflag['public']
+		elif arg == "unlisted":
+			map.deny &= ~permission['entry']
+			map.flags &= ~mapflag['public']
+		else:
+			client.send("ERR", {'text': 'Map privacy must be public, private, or unlisted'})
+
+@SlashCommands.register("mapprotect")
+async def commandMapprotect(map, client, command, arg):
+	if client.mustBeOwner(False):
+		if arg == "off":
+			map.allow |= permission['sandbox']
+		elif arg == "on":
+			map.allow &= ~permission['sandbox']
+		else:
+			client.send("ERR", {'text': 'Map building must be on or off'})
+
+@SlashCommands.register("mapbuild")
+async def commandMapbuild(map, client, command, arg):
+	if client.mustBeOwner(True):
+		if arg == "on":
+			map.allow |= permission['build']
+		elif arg == "off":
+			map.allow &= ~permission['build']
+		else:
+			client.send("ERR", {'text': 'Map building must be on or off'})
+
+@SlashCommands.register("defaultfloor")
+async def commandDefaultfloor(map, client, command, arg):
+	if client.mustBeOwner(False):
+		map.default_turf = arg
+		client.send("MSG", {'text': 'Map floor changed to %s' % arg})
+
+@SlashCommands.register("mapspawn")
+async def commandMapspawn(map, client, command, arg):
+	if client.mustBeOwner(False):
+		map.start_pos = [client.x, client.y]
+		client.send("MSG", {'text': 'Map start changed to %d,%d' % (client.x, client.y)})
+
+@SlashCommands.register("listeners")
+async def commandListeners(map, client, command, arg):
+	out = ''
+	for i in botwatch_type.keys():
+		c = botwatch_type[i]
+		if map.id in BotWatch[c]:
+			for u in BotWatch[c][map.id]:
+				out += '%s (%s), ' % (u.username, i)
+	client.send("MSG", {'text': 'Listeners here: ' + out})
+
+@SlashCommands.register("listen")
+async def commandListen(map, client, command, arg):
+	if client.db_id == None:
+		return
+	params = arg.split()
+	categories = set(params[0].split(','))
+	maps = set([int(x) for x in params[1].split(',')])
+	for c in categories:
+		# find category number from name
+		if c not in botwatch_type:
+			client.send("ERR", {'text': 'Invalid listen category: %s' % c})
+			return
+		category = botwatch_type[c]
+
+		for m in maps:
+			result = await DB.fetchone('SELECT allow FROM Map_Permission WHERE mid=? AND uid=?', (m, client.db_id,))
+			if (result == None) or (result[0] & permission['map_bot'] == 0):
+				client.send("ERR", {'text': 'Don\'t have permission to listen on map: %d' % m})
+				return
+			if m not in BotWatch[category]:
+				BotWatch[category][m] = set()
+			BotWatch[category][m].add(client)
+			client.listening_maps.add((category, m))
+
+			# Send initial data
+			if c == 'build':
+				remote = await getMapById(m)
+				client.send_raw(remote.map_info_payload(remote_map=m))
+				client.send_raw(remote.map_payload(remote_map=m))
+			elif c == 'entry':
+				client.send("WHO", {'list': (await getMapById(m)).who(), 'remote_map': m})
+
+	client.send("MSG", {'text': 'Listening on maps now: ' + str(client.listening_maps)})
+
+@SlashCommands.register("unlisten")
+async def commandUnlisten(map, client, command, arg):
+	if client.db_id == None:
+		return
+	params = arg.split()
+	categories = set(params[0].split(','))
+	maps = [int(x) for x in params[1].split(',')]
+	for c in categories:
+		# find category number from name
+		if c not in botwatch_type:
+			client.send("ERR", {'text': 'Invalid listen category: "%s"' % c})
+			return
+		category = botwatch_type[c]
+
+		for m in maps:
+			if (m in BotWatch[category]) and (client in BotWatch[category][m]):
+				BotWatch[category][m].remove(client)
+				if not len(BotWatch[category][m]):
+					del BotWatch[category][m]
+			if (category, m) in client.listening_maps:
+				client.listening_maps.remove((category, m))
+	client.send("MSG", {'text': 'Stopped listening on maps: ' + str(client.listening_maps)})
+
+@SlashCommands.register("kick", "kickban")
+async def commandKick(map, client, command, arg):
+	arg = arg.lower()
+	if client.mustBeOwner(True):
+		u = findClientByUsername(arg)
+		if u != None:
+			if u.map_id == client.map_id:
+				client.send("MSG", {'text': 'Kicked '+u.nameAndUsername()})
+				u.send("MSG", {'text': 'Kicked by '+client.nameAndUsername()})
+				await u.send_home()
+				if command == "kickban":
+					map.set_permission(await findDBIdByUsername(arg), permission['entry'], False)
+			else:
+				client.send("ERR", {'text': 'User not on this map'})
+		else:
+			client.send("ERR", {'text': 'User not found'})
+
+@SlashCommands.register("goback")
+async def commandGoback(map, client, command, arg):
+	if len(client.tp_history) > 0:
+		pos = client.tp_history.pop()
+		await client.switch_map(pos[0], new_pos=[pos[1], pos[2]], update_history=False)
+	else:
+		client.send("ERR", {'text': 'Nothing in teleport history'})
+
+@SlashCommands.register("sethome")
+async def commandSethome(map, client, command, arg):
+	client.home = [client.map_id, client.x, client.y]
+	client.send("MSG", {'text': 'Home set'})
+
+@SlashCommands.register("home")
+async def commandHome(map, client, command, arg):
+	if client.home == None:
+		client.send("ERR", {'text': 'You don\'t have a home set'})
+	else:
+		client.send("MSG", {'text': 'Teleported to your home'})
+		await client.send_home()
+
+@SlashCommands.register("map")
+async def commandMap(map, client, command, arg):
+	try:
+		if await mapIdExists(int(arg)):
+			if await client.switch_map(int(arg)):
+				client.send("MSG", {'text': 'Teleported to map %s' % arg})
+		else:
+			client.send("MSG", {'text': 'Map %s doesn\'t exist' % arg})
+	except:
+		client.send("ERR", {'text': 'Couldn\'t go to map %s' % arg})
+
+@SlashCommands.register("saveme")
+async def commandSaveme(map, client, command, arg):
+	if client.username == None:
+		client.send("ERR", {'text': 'You are not logged in'})
+	else:
+		await client.save()
+		client.send("MSG", {'text': 'Account saved'})
+
+@SlashCommands.register("changepass")
+async def commandChangepass(map, client, command, arg):
+	if client.username == None:
+		client.send("ERR", {'text': 'You are not logged in'})
+	elif len(arg):
+		await client.changepass(arg)
+		client.send("MSG", {'text': 'Password changed'})
+	else:
+		client.send("ERR", {'text': 'No password given'})
+
+@SlashCommands.register("register")
+async def commandRegister(map, client, command, arg):
+	if client.username != None:
+		client.send("ERR", {'text': 'Register fail, you already registered'})
+	else:
+		params = arg.split()
+		if len(params) != 2:
+			client.send("ERR", {'text': 'Syntax is: /register username password'})
+		else:
+			if await client.register(filterUsername(params[0]), params[1]):
+				map.broadcast("MSG", {'text': client.name+" has now registered"})
+				map.broadcast("WHO", {'add': client.who()}) # update client view, probably just for the username
+			else:
+				client.send("ERR", {'text': 'Register fail, account already exists'})
+
+@SlashCommands.register("login")
+async def commandLogin(map, client, command, arg):
+	params = arg.split()
+	if len(params) != 2:
+		client.send("ERR", {'text': 'Syntax is: /login username password'})
+	else:
+		await client.login(filterUsername(params[0]), params[1])
+
+@SlashCommands.register("userpic")
+async def commandUserpic(map, client, command, arg):
+	arg = arg.split(' ')
+	success = False
+
+	if len(arg) == 1:
+		defaults = {'bunny': [0, 2, 25], 'cat': [0, 2, 26], 'hamster': [0, 8, 25], 'fire': [0, 4,26]}
+		if arg[0] in defaults:
+			client.pic = defaults[arg[0]];
+			success = True
+		# temporary thing to allow custom avatars
+		else:
+			if arg[0].startswith("http"):
+				if imageURLIsOkay(arg[0]):
+					client.pic = [arg[0], 0, 0];
+					success = True
+				else:
+					client.send("ERR", {'text': 'URL doesn\'t match any whitelisted sites'})
+					return
+	elif len(arg) == 2:
+		if arg[0].isnumeric() and arg[1].isnumeric():
+			client.pic = [0, int(arg[0]), int(arg[1])]
+			success = True
+	if success:
+		map.broadcast("WHO", {'add': client.who()}) # update client view
+	else:
+		client.send("ERR", {'text': 'Syntax is: /userpic sheet x y'})
+
+@SlashCommands.register("gwho")
+async def commandGwho(map, client, command, arg):
+	names = ''
+	for u in AllClients:
+		if len(names) > 0:
+			names += ', '
+		names += u.nameAndUsername()
+	client.send("MSG", {'text': 'List of users connected: '+names})
+
+@SlashCommands.register("who")
+async def commandWho(map, client, command, arg):
+	names = ''
+	for u in map.users:
+		if len(names) > 0:
+			names += ', '
+		names += u.nameAndUsername()
+	client.send("MSG", {'text': 'List of users here: '+names})
+
+@SlashCommands.register("whereare", "wa")
+async def commandWhereare(map, client, command, arg):
+	names = 'Whereare: [ul]'
+	for m in AllMaps:
+		if m.flags & mapflag['public'] == 0:
+			continue
+		names += '[li][b]%s[/b] (%d): ' % (m.name, len(m.users))
+		for u in m.users:
+			names += u.nameAndUsername()+', '
+		names = names.rstrip(', ') + ' [command]map %d[/command][/li]' % m.id
+	names += '[/ul]'
+
+	client.send("MSG", {'text': names})
+
+@SlashCommands.register("savemap")
+async def commandSavemap(map, client, command, arg):
+	map.save()
+	map.broadcast("MSG", {'text': client.name+" saved the map"})
+
+# Server admin commands
+@SlashCommands.register("broadcast")
+async def commandBroadcast(map, client, command, arg):
+	if client.mustBeServerAdmin() and len(arg) > 0:
+		broadcastToAll("Admin broadcast: "+arg)
+
+@SlashCommands.register("kill")
+async def commandKill(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		u = findClientByUsername(arg)
+		if u != None:
+			client.send("MSG", {'text': 'Killed '+u.nameAndUsername()})
+			u.send("MSG", {'text': 'Killed by '+client.nameAndUsername()})
+			u.disconnect()
+
+@SlashCommands.register("netstats")
+async def commandNetstats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		stats = 'Outbound queues: %d dropped, %d coalesced, %d evicted [ul]' % (OutboxStats['dropped'], OutboxStats['coalesced'], OutboxStats['evicted'])
+		for u in sorted(AllClients, key=lambda u: u.outbox_bytes, reverse=True)[:10]:
+			stats += '[li]%s: %d queued (%d bytes), %d dropped, %d coalesced[/li]' % (u.nameAndUsername(), len(u.outbox), u.outbox_bytes, u.outbox_dropped, u.outbox_coalesced)
+		stats += '[/ul]'
+		client.send("MSG", {'text': stats})
+
+@SlashCommands.register("cachestats")
+async def commandCachestats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		client.send("MSG", {'text': 'Permission cache: %d hits, %d misses' % (PermissionCacheStats['hits'], PermissionCacheStats['misses'])})
+
+@SlashCommands.register("regionstats")
+async def commandRegionstats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		stats = 'Map regions: [ul]'
+		for operation, counts in sorted(RegionStats.items()):
+			stats += '[li]%s: %d times, %d tiles[/li]' % (operation, counts[0], counts[1])
+		stats += '[/ul]'
+		client.send("MSG", {'text': stats})
+
+@SlashCommands.register("mapcache")
+async def commandMapcache(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		stats = MapCache.stats
+		lookups = stats['hits'] + stats['misses']
+		client.send("MSG", {'text': 'Map cache: %d empty maps, about %d KB, %d hits (reloads avoided), %d misses, %d%% hit rate, %d unloaded after being idle, %d unloaded to make room' % (len(MapCache), MapCache.bytes // 1024, stats['hits'], stats['misses'], (100 * stats['hits'] // lookups) if lookups else 0, stats['expired'], stats['evicted'])})
+
+@SlashCommands.register("dbstats")
+async def commandDbstats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		stats = Persist.stats
+		client.send("MSG", {'text': 'Save queue: %d waiting, %d flushes, %d users and %d maps written, last flush %.1f ms, slowest %.1f ms, %d queries waiting on the database thread' % (Persist.queue_depth(), stats['flushes'], stats['users_written'], stats['maps_written'], stats['last_flush_ms'], stats['max_flush_ms'], DB.pending)})
+
+@SlashCommands.register("ratestats")
+async def commandRatestats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		throttled = sorted(RateLimitStats.items(), key=lambda t: t[1][0] + t[1][1], reverse=True)
+		stats = 'Rate limited users: [ul]'
+		for who, counts in throttled[:15]:
+			stats += '[li]%s: %d messages delayed, %d dropped[/li]' % (who, counts[0], counts[1])
+		stats += '[/ul]'
+		client.send("MSG", {'text': stats})
+
+@SlashCommands.register("slowlog")
+async def commandSlowlog(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		if Watchdog.threshold == None:
+			client.send("MSG", {'text': 'The watchdog isn\'t running (Watchdog.Threshold is 0)'})
+			return
+		out = 'Slow events over %d ms: [ul]' % (Watchdog.threshold * 1000)
+		for report in list(Watchdog.reports)[-10:]:
+			out += '[li]%s: %s%s, %d ms' % (report['time'].strftime("%H:%M:%S"), escapeTags(report['what']), ' (%s)' % escapeTags(report['context']) if report['context'] else '', report['ms'])
+			if len(report['stack']):
+				out += ', at [tt]%s[/tt]' % escapeTags(report['stack'][-1].strip().split('\n')[0])
+			out += '[/li]'
+		out += '[/ul]'
+		client.send("MSG", {'text': out})
+
+@SlashCommands.register("profile")
+async def commandProfile(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		if arg == "start":
+			Profiler.start(threading.get_ident(), Config["Watchdog"]["ProfileRate"], Config["Watchdog"]["ProfileFile"], Config["Watchdog"]["ProfileInterval"])
+			client.send("MSG", {'text': 'Profiling, writing to %s' % Config["Watchdog"]["ProfileFile"]})
+		elif arg == "stop":
+			Profiler.stop()
+			client.send("MSG", {'text': 'Stopped profiling, %d samples written to %s' % (Profiler.samples, Config["Watchdog"]["ProfileFile"])})
+		else:
+			client.send("MSG", {'text': 'Profiler is %s, %d samples so far. Use [tt]/profile start[/tt] or [tt]/profile stop[/tt]' % ('running' if Profiler.running else 'stopped', Profiler.samples)})
+
+@SlashCommands.register("cmdstats")
+async def commandCmdstats(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		timings = []
+		for router in (ProtocolCommands, SlashCommands):
+			for name, stats in router.stats.items():
+				if stats.calls:
+					timings.append((stats.total_ms, router.name, name, stats))
+		timings.sort(key=lambda t: t[0], reverse=True)
+		out = 'Slowest commands by total time: [ul]'
+		for total, kind, name, stats in timings[:15]:
+			out += '[li]%s %s: %d calls, %d errors, %.1f ms total, %.2f ms average, p50 under %g ms, p99 under %g ms, slowest %.1f ms[/li]' % (kind, name, stats.calls, stats.errors, total, total / stats.calls, stats.percentile(0.5), stats.percentile(0.99), stats.max_ms)
+		out += '[/ul]'
+		client.send("MSG", {'text': out})
+
+@SlashCommands.register("shutdown")
+async def commandShutdown(map, client, command, arg):
+	if client.mustBeServerAdmin():
+		if arg == "cancel":
+			startShutdown(-1)
+			broadcastToAll("Server shutdown canceled")
+		elif arg.isnumeric():
+			startShutdown(max(1, int(arg)))
+			broadcastToAll("Server shutdown in %d seconds! (started by %s)" % (ServerShutdown[0], client.name))
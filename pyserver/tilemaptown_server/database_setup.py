@@ -16,104 +16,11 @@
 
 import sqlite3, json, glob
 from .buildglobal import *
+from .migrations import migrateDatabase
 
 c = Database.cursor()
 
-c.execute("""create table if not exists Meta (
-item text,
-value text
-)""")
-
-# Get/update version number
-c.execute("SELECT value FROM Meta WHERE item='version'")
-version = c.fetchone()
-if version == None:
-	c.execute("INSERT INTO Meta (item, value) VALUES ('version', '1')")
-else:
-	c.execute("UPDATE Meta SET value='1' WHERE item='version'")
-
-c.execute("""create table if not exists Map (
-mid integer primary key,
-name text,
-desc text,
-owner integer,
-flags integer,
-regtime timestamp,
-start_x integer,
-start_y integer,
-width integer,
-height integer,
-default_turf text,
-allow integer,
-deny integer,
-guest_deny integer,
-tags text,
-data text
-)""")
-
-c.execute("""create table if not exists Map_Permission (
-mid integer,
-uid integer,
-allow integer,
-deny integer,
-primary key(mid, uid)
-)""")
-
-c.execute("""create table if not exists Map_Log (
-mid integer,
-uid integer,
-lid integer,
-time timestamp,
-action text,
-info text,
-primary key(mid, uid)
-)""")
-
-c.execute("""create table if not exists User (
-uid integer primary key autoincrement,
-passhash text,
-passalgo text,
-regtime timestamp,
-lastseen timestamp,
-username text,
-name text,
-pic text,
-mid integer,
-map_x integer,
-map_y integer,
-home text,
-watch text,
-ignore text,
-client_settings text,
-flags integer,
-tags text
-)""")
-
-c.execute("""create table if not exists Asset_Info (
-aid integer primary key,
-name text,
-desc text,
-type integer,
-flags integer,
-creator integer,
-regtime timestamp,
-owner integer,
-folder integer,
-data integer
-)""")
-
-c.execute("""create table if not exists Mail (
-id integer primary key,
-uid integer,
-sender integer,
-recipients text,
-subject text,
-contents text,
-time timestamp,
-flags integer,
-foreign key(uid) references User(uid) on delete cascade,
-foreign key(sender) references User(uid) on delete set null
-)""")
+migrateDatabase(Database)
 
 # Make dummy items to prevent some IDs from being used by user assets
 c.execute("SELECT count(*) FROM Asset_Info")
@@ -241,7 +148,8 @@ for fname in glob.glob("maps/*.txt"):
 					# Look up owner
 					owner_name = s["owner"]
 					if owner_name:
-						owner = findDBIdByUsername(owner_name)
+						result = Database.execute('SELECT uid FROM User WHERE username=?', (owner_name.lower(),)).fetchone()
+						owner = result[0] if result != None else None
 
 					mid = int(s["id"])
 					if s["build_enabled"]:
@@ -0,0 +1,92 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio, concurrent.futures, threading, time
+from .metrics import DatabaseTime
+from .watchdog import Watchdog
+
+# Work for the database thread, given the connection first
+def fetchOne(connection, sql, params):
+	return connection.execute(sql, params).fetchone()
+
+def fetchAll(connection, sql, params):
+	return connection.execute(sql, params).fetchall()
+
+def executeGetId(connection, sql, params):
+	return connection.execute(sql, params).lastrowid
+
+def execute(connection, sql, params):
+	connection.execute(sql, params)
+
+class DatabaseExecutor(object):
+	""" Runs database work on one dedicated thread, in the order it was submitted """
+	def __init__(self, connection):
+		self.connection = connection
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+		self.pending = 0
+		# Work is counted in on the event loop and out on the database thread
+		self.pending_lock = threading.Lock()
+
+	def submit(self, function, *args):
+		""" Run function(connection, *args) on the database thread, without waiting for it """
+		with self.pending_lock:
+			self.pending += 1
+		future = self.executor.submit(self.timed, function, *args)
+		future.add_done_callback(self.finished)
+		return future
+
+	def timed(self, function, *args):
+		# Name the work after its SQL if it has any, for the watchdog
+		what = 'Database: ' + (args[0] if len(args) and type(args[0]) == str else function.__qualname__)
+		start = time.perf_counter()
+		try:
+			with Watchdog.watch(what):
+				return function(self.connection, *args)
+		finally:
+			DatabaseTime.time(start)
+
+	def finished(self, future):
+		with self.pending_lock:
+			self.pending -= 1
+
+	def run(self, function, *args):
+		""" Run function(connection, *args) on the database thread and await the result """
+		return asyncio.wrap_future(self.submit(function, *args))
+
+	async def fetchone(self, sql, params=()):
+		return await self.run(fetchOne, sql, params)
+
+	async def fetchall(self, sql, params=()):
+		return await self.run(fetchAll, sql, params)
+
+	async def execute(self, sql, params=()):
+		""" Run a statement and get the ID of the row it inserted, if any """
+		return await self.run(executeGetId, sql, params)
+
+	def write(self, sql, params=()):
+		""" Queue a statement whose result nobody needs to wait for """
+		future = self.submit(execute, sql, params)
+		future.add_done_callback(self.report_error)
+		return future
+
+	def report_error(self, future):
+		if future.exception() != None:
+			print("Database error:", future.exception())
+
+	def close(self):
+		""" Finish everything that's queued, then close the connection """
+		self.executor.shutdown(wait=True)
+		self.connection.close()
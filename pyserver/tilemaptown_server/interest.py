@@ -0,0 +1,84 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Interest management: users only hear about the parts of a map they can see.
+# Views are measured in whole map chunks, so a user always has every chunk
+# inside their view up to date, and only needs to be sent a chunk again if
+# it changed while it was out of view.
+
+class InterestGrid(object):
+	""" Keeps track of which chunk each user on a map is standing in """
+	def __init__(self, chunks, max_radius):
+		self.chunks = chunks
+		self.max_radius = max_radius
+		self.cells = {} # (cx, cy) -> set of users standing in that chunk
+
+	def chunk_at(self, x, y):
+		size = self.chunks.size
+		return (min(max(x, 0), self.chunks.width-1) // size, min(max(y, 0), self.chunks.height-1) // size)
+
+	def chunk_rect(self, x1, y1, x2, y2):
+		""" Rectangle of chunks covering an inclusive tile rectangle """
+		c1 = self.chunk_at(min(x1, x2), min(y1, y2))
+		c2 = self.chunk_at(max(x1, x2), max(y1, y2))
+		return (c1[0], c1[1], c2[0], c2[1])
+
+	def view_rect(self, client):
+		""" Rectangle of chunks a user can see, as (cx1, cy1, cx2, cy2) """
+		rx, ry = client.view_radius()
+		return self.chunk_rect(client.x-rx, client.y-ry, client.x+rx, client.y+ry)
+
+	def move(self, client):
+		""" Update the index after a user moved """
+		cell = self.chunk_at(client.x, client.y)
+		if cell == client.interest_cell:
+			return
+		self.remove(client)
+		if cell not in self.cells:
+			self.cells[cell] = set()
+		self.cells[cell].add(client)
+		client.interest_cell = cell
+
+	def remove(self, client):
+		""" Take a user out of the index """
+		if client.interest_cell == None:
+			return
+		users = self.cells.get(client.interest_cell)
+		if users != None:
+			users.discard(client)
+			if not len(users):
+				del self.cells[client.interest_cell]
+		client.interest_cell = None
+
+	def viewers(self, x1, y1, x2, y2):
+		""" Users whose view overlaps an inclusive tile rectangle """
+		area = self.chunk_rect(x1, y1, x2, y2)
+		# Nobody further away than this many chunks can see the area
+		reach = self.max_radius // self.chunks.size + 1
+		near_x1 = area[0] - reach
+		near_y1 = area[1] - reach
+		near_x2 = area[2] + reach
+		near_y2 = area[3] + reach
+
+		out = []
+		for cell, users in self.cells.items():
+			if cell[0] < near_x1 or cell[0] > near_x2 or cell[1] < near_y1 or cell[1] > near_y2:
+				continue
+			for u in users:
+				view = u.view_chunks
+				if view != None and view[0] <= area[2] and view[2] >= area[0] and view[1] <= area[3] and view[3] >= area[1]:
+					out.append(u)
+		return out
@@ -0,0 +1,89 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mail storage. Each function here runs on the database thread through DB.run(),
+# and does its work in a fixed number of queries no matter how many messages
+# or recipients are involved.
+
+import datetime
+
+# SQLite only allows so many ? parameters in one statement
+MaxParameters = 500
+
+def usernamesForIds(connection, ids):
+	""" Look up the usernames for a collection of user IDs at once, as a dictionary """
+	ids = list(set(ids))
+	names = {}
+	for i in range(0, len(ids), MaxParameters):
+		chunk = ids[i:i+MaxParameters]
+		for row in connection.execute('SELECT uid, username FROM User WHERE uid IN (%s)' % ','.join('?'*len(chunk)), chunk):
+			names[row[0]] = row[1]
+	return names
+
+def idsForUsernames(connection, usernames):
+	""" Look up the user IDs for a collection of usernames at once, as a dictionary """
+	usernames = list(set(usernames))
+	ids = {}
+	for i in range(0, len(usernames), MaxParameters):
+		chunk = usernames[i:i+MaxParameters]
+		for row in connection.execute('SELECT username, uid FROM User WHERE username IN (%s)' % ','.join('?'*len(chunk)), chunk):
+			ids[row[0]] = row[1]
+	return ids
+
+def recipientIds(recipients):
+	return [int(x) for x in recipients.split(',') if x != '']
+
+def loadMailPage(connection, uid, before, count):
+	""" Get up to count messages older than the mail ID before (or the newest ones, if None), newest first.
+	Returns the messages and the ID to ask for the next page with, or None if there aren't any more """
+	if before == None:
+		rows = connection.execute('SELECT id, sender, recipients, subject, contents, flags FROM Mail WHERE uid=? ORDER BY id DESC LIMIT ?', (uid, count+1)).fetchall()
+	else:
+		rows = connection.execute('SELECT id, sender, recipients, subject, contents, flags FROM Mail WHERE uid=? AND id<? ORDER BY id DESC LIMIT ?', (uid, before, count+1)).fetchall()
+	more = len(rows) > count
+	rows = rows[:count]
+
+	# Every sender and recipient on the page gets looked up together
+	user_ids = set()
+	for row in rows:
+		user_ids.add(row[1])
+		user_ids.update(recipientIds(row[2]))
+	names = usernamesForIds(connection, user_ids)
+
+	mail = [{'id': row[0], 'from': names.get(row[1]), 'to': [names.get(x) for x in recipientIds(row[2])],
+		'subject': row[3], 'contents': row[4], 'flags': row[5]} for row in rows]
+	return mail, (rows[-1][0] if more else None)
+
+def countMail(connection, uid):
+	""" How many messages someone has, and how many of those are unread """
+	row = connection.execute('SELECT count(*), count(CASE WHEN (flags&1)=0 THEN 1 END) FROM Mail WHERE uid=?', (uid,)).fetchone()
+	return row[0], row[1]
+
+def sendMail(connection, sender, usernames, subject, contents):
+	""" Deliver a message to everyone in usernames. Returns a list of (mail ID, recipient ID),
+	or None without sending anything if any of the usernames don't exist """
+	ids = idsForUsernames(connection, [str(x).lower() for x in usernames])
+	if len(ids) != len(set(str(x).lower() for x in usernames)):
+		return None
+	recipients = list(ids.values())
+	recipient_string = ','.join([str(x) for x in recipients])
+
+	# The database thread is the only writer, so every row past the current last one is one of these
+	last = connection.execute('SELECT ifnull(max(id), 0) FROM Mail').fetchone()[0]
+	now = datetime.datetime.now()
+	connection.executemany("INSERT INTO Mail (uid, sender, recipients, subject, contents, time, flags) VALUES (?, ?, ?, ?, ?, ?, ?)",
+		[(uid, sender, recipient_string, subject, contents, now, 0) for uid in recipients])
+	return connection.execute('SELECT id, uid FROM Mail WHERE id>? AND sender=?', (last, sender)).fetchall()
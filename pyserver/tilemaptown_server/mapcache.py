@@ -0,0 +1,91 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio, collections, time
+from .buildglobal import *
+
+class WarmMapCache(object):
+	""" Maps nobody is on, kept loaded for a while in case someone comes back, least recently used first """
+	def __init__(self):
+		self.maps = collections.OrderedDict() # map ID -> [map, size in bytes, last used, used before]
+		self.bytes = 0
+		self.timer = None # expires the least recently used map once it's been idle long enough
+		self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+	def __len__(self):
+		return len(self.maps)
+
+	def add(self, map, just_loaded=False):
+		""" Start keeping track of a map that just became empty, or was loaded without anyone going to it yet """
+		if map.id in self.maps:
+			return
+		size = map.memory_size()
+		self.maps[map.id] = [map, size, time.monotonic(), not just_loaded]
+		self.bytes += size
+		# Only save now if the tiles changed; unloading it later will save everything else
+		if map.saved_change_id != map.change_id:
+			map.save()
+		# Maps that were just loaded for someone who hasn't gotten to them yet are left for the idle timer,
+		# or a map bigger than the whole budget would get unloaded and loaded again forever
+		for map_id in [k for k, v in self.maps.items() if v[3]]:
+			if self.bytes <= Config["Server"]["MapCacheBytes"]:
+				break
+			self.unload(map_id)
+			self.stats['evicted'] += 1
+		self.schedule()
+
+	def take(self, map):
+		""" Someone is on the map again, so it's not idle anymore; the hit was counted when it was looked up """
+		entry = self.maps.pop(map.id, None)
+		if entry != None:
+			self.bytes -= entry[1]
+
+	def touch(self, map):
+		""" The map was looked up, so keep it around longer; this is the one place hits get counted """
+		entry = self.maps.get(map.id)
+		if entry != None and entry[0] is map:
+			entry[2] = time.monotonic()
+			self.maps.move_to_end(map.id)
+			self.stats['hits'] += 1
+
+	def miss(self):
+		self.stats['misses'] += 1
+
+	def unload(self, map_id):
+		map, size, last_used, used = self.maps.pop(map_id)
+		self.bytes -= size
+		map.unload()
+
+	def schedule(self):
+		""" Make sure the timer is set for when the least recently used map will have been idle long enough """
+		if self.timer != None or not len(self.maps):
+			return
+		oldest = next(iter(self.maps.values()))
+		wait = max(0, oldest[2] + Config["Server"]["MapUnloadDelay"] - time.monotonic())
+		self.timer = asyncio.get_event_loop().call_later(wait, self.expire)
+
+	def expire(self):
+		self.timer = None
+		now = time.monotonic()
+		while len(self.maps):
+			map_id, entry = next(iter(self.maps.items()))
+			if now - entry[2] < Config["Server"]["MapUnloadDelay"]:
+				break
+			self.unload(map_id)
+			self.stats['expired'] += 1
+		self.schedule()
+
+MapCache = WarmMapCache()
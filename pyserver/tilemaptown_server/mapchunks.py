@@ -0,0 +1,98 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array, json
+
+class MapChunks(object):
+	""" Splits a map into square chunks that track when their tiles change """
+	def __init__(self, width, height, size=16):
+		self.width = width
+		self.height = height
+		self.size = size
+		self.chunks_wide = (width + size - 1) // size
+		self.chunks_tall = (height + size - 1) // size
+		count = self.chunks_wide * self.chunks_tall
+
+		# Chunk (cx, cy) is at cx*chunks_tall+cy, same order as the tile grids
+		self.dirty = bytearray([1]) * count
+		self.version = array.array('I', [0]) * count
+
+		# Encoded [x, y, tile] entries for each chunk, as (turf text, obj text)
+		self.encoded = [None] * count
+
+		# Whole map encoding from the last encode_map, and the default turf it used
+		self.map_text = None
+		self.map_text_default = None
+
+		# Whether the tiles have been queued to be saved since they last changed
+		self.data_saved = False
+
+	def memory_size(self):
+		""" Rough number of bytes used by cached encodings """
+		size = len(self.map_text or '')
+		for entry in self.encoded:
+			if entry != None:
+				size += len(entry[0]) + len(entry[1])
+		return size
+
+	def chunk_range(self, x1, y1, x2, y2):
+		""" Chunk indexes covering an inclusive tile rectangle """
+		x1 = max(0, x1) // self.size
+		y1 = max(0, y1) // self.size
+		x2 = min(self.width-1, x2) // self.size
+		y2 = min(self.height-1, y2) // self.size
+		for cx in range(x1, x2+1):
+			for cy in range(y1, y2+1):
+				yield cx*self.chunks_tall+cy
+
+	def mark(self, x1, y1, x2, y2):
+		""" Note that tiles in the inclusive rectangle changed """
+		for i in self.chunk_range(x1, y1, x2, y2):
+			self.dirty[i] = 1
+			self.version[i] += 1
+		self.map_text = None
+		self.data_saved = False
+
+	def dirty_count(self):
+		return self.dirty.count(1)
+
+	def chunk_bounds(self, i):
+		""" Inclusive tile rectangle a chunk covers """
+		cx, cy = divmod(i, self.chunks_tall)
+		x1 = cx * self.size
+		y1 = cy * self.size
+		return (x1, y1, min(self.width, x1 + self.size) - 1, min(self.height, y1 + self.size) - 1)
+
+	def encode_chunk(self, i, turfs, objs):
+		x1, y1, x2, y2 = self.chunk_bounds(i)
+		turf_text = ', '.join([json.dumps(t) for t in turfs.section(x1, y1, x2, y2)])
+		obj_text = ', '.join([json.dumps(o) for o in objs.section(x1, y1, x2, y2)])
+		self.encoded[i] = (turf_text, obj_text)
+		self.dirty[i] = 0
+
+	def encode_map(self, turfs, objs, default_turf):
+		""" JSON text of the whole map, re-encoding only chunks that changed """
+		if self.map_text != None and self.map_text_default == default_turf:
+			return self.map_text
+		i = self.dirty.find(1)
+		while i != -1:
+			self.encode_chunk(i, turfs, objs)
+			i = self.dirty.find(1, i+1)
+		turf_text = ', '.join([e[0] for e in self.encoded if e[0]])
+		obj_text = ', '.join([e[1] for e in self.encoded if e[1]])
+		self.map_text = '{"pos": [0, 0, %d, %d], "default": %s, "turf": [%s], "obj": [%s]}' % (self.width-1, self.height-1, json.dumps(default_turf), turf_text, obj_text)
+		self.map_text_default = default_turf
+		return self.map_text
@@ -0,0 +1,80 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array, json, struct, sys, zlib
+from .tilestorage import makeTileGrid
+
+# Binary map data, saved in the Map table's data column as a BLOB instead of JSON text.
+#
+# Header: "TMTB", format version (u8), width (u32), height (u32)
+# Then everything else, compressed with zlib. For the turf layer and then the object layer:
+#   bytes per index (u8), length of the palette (u32), the palette as a JSON list,
+#   then width*height little-endian palette indexes in column-major order (x*height+y).
+# Palette entry 0 is always null, meaning there's nothing in that cell.
+
+MapFormatMagic = b'TMTB'
+MapFormatVersion = 1
+MapFormatHeader = struct.Struct('<4sBII')
+MapFormatLayer = struct.Struct('<BI')
+
+def isBinaryMapData(data):
+	return type(data) == bytes and data[:4] == MapFormatMagic
+
+def encodeLayer(grid):
+	palette, cells = grid.pack()
+	# Use the smallest index size that fits
+	if len(palette) <= 0xffff and cells.typecode != 'H':
+		cells = array.array('H', cells)
+	if sys.byteorder == 'big':
+		cells = array.array(cells.typecode, cells)
+		cells.byteswap()
+	palette_text = json.dumps(palette, separators=(',', ':')).encode()
+	return MapFormatLayer.pack(cells.itemsize, len(palette_text)) + palette_text + cells.tobytes()
+
+def decodeLayer(body, offset, width, height, backend):
+	itemsize, palette_length = MapFormatLayer.unpack_from(body, offset)
+	offset += MapFormatLayer.size
+	palette = json.loads(body[offset:offset+palette_length])
+	offset += palette_length
+
+	cells = array.array('H' if itemsize == 2 else 'I')
+	if cells.itemsize != itemsize:
+		raise ValueError('unsupported map index size %d' % itemsize)
+	end = offset + width*height*itemsize
+	cells.frombytes(body[offset:end])
+	if sys.byteorder == 'big':
+		cells.byteswap()
+
+	grid = makeTileGrid(width, height, backend)
+	grid.unpack(palette, cells)
+	return (grid, end)
+
+def encodeMapData(width, height, turfs, objs, level=1):
+	""" Binary map data for a map's tile grids; a low compression level keeps saving big maps fast """
+	body = encodeLayer(turfs) + encodeLayer(objs)
+	return MapFormatHeader.pack(MapFormatMagic, MapFormatVersion, width, height) + zlib.compress(body, level)
+
+def decodeMapData(data, backend):
+	""" Read binary map data back into (width, height, turfs, objs) """
+	magic, version, width, height = MapFormatHeader.unpack_from(data, 0)
+	if magic != MapFormatMagic:
+		raise ValueError('not binary map data')
+	if version != MapFormatVersion:
+		raise ValueError('unsupported map format version %d' % version)
+	body = zlib.decompress(data[MapFormatHeader.size:])
+	turfs, offset = decodeLayer(body, 0, width, height, backend)
+	objs, offset = decodeLayer(body, offset, width, height, backend)
+	return (width, height, turfs, objs)
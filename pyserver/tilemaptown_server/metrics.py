@@ -0,0 +1,159 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio, bisect, time
+
+# Counters, histograms and gauges that the rest of the server updates as it
+# runs, shown in the Prometheus text format. Updating one is a dictionary
+# lookup and an addition, so they can stay on all the time. Each one should
+# only be updated from one thread; everything here is updated from the event
+# loop except for the database timings, which only the database thread updates.
+
+TimeBuckets = [0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+CountBuckets = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+def formatLabels(label_name, label):
+	if label_name == None or label == None:
+		return ''
+	return '{%s="%s"}' % (label_name, str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+def formatHistogram(name, labels, buckets, counts, total):
+	""" Lines for one histogram, given how many observations landed in each bucket """
+	lines = []
+	seen = 0
+	inner = labels[1:-1] + ',' if len(labels) else ''
+	for bound, count in zip(buckets, counts):
+		seen += count
+		lines.append('%s_bucket{%sle="%g"} %d' % (name, inner, bound, seen))
+	seen += counts[-1]
+	lines.append('%s_bucket{%sle="+Inf"} %d' % (name, inner, seen))
+	lines.append('%s_sum%s %g' % (name, labels, total))
+	lines.append('%s_count%s %d' % (name, labels, seen))
+	return lines
+
+class Counter(object):
+	""" Number that only goes up, optionally split up by one label """
+	kind = 'counter'
+	def __init__(self, name, help, label_name=None):
+		self.name = name
+		self.help = help
+		self.label_name = label_name
+		self.values = {}
+
+	def inc(self, label=None, amount=1):
+		self.values[label] = self.values.get(label, 0) + amount
+
+	def render(self):
+		return ['%s%s %g' % (self.name, formatLabels(self.label_name, label), value) for label, value in self.values.items()]
+
+class Histogram(object):
+	""" Counts how many observations fall into each of a set of buckets """
+	kind = 'histogram'
+	def __init__(self, name, help, buckets=TimeBuckets):
+		self.name = name
+		self.help = help
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.total = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.total += value
+
+	def time(self, start):
+		""" Observe how many seconds it's been since a time.perf_counter() reading """
+		self.observe(time.perf_counter() - start)
+
+	def render(self):
+		return formatHistogram(self.name, '', self.buckets, self.counts, self.total)
+
+class Gauge(object):
+	""" Number that's read when the metrics are, from a function that returns it, or a dictionary of label -> number """
+	def __init__(self, name, help, function, label_name=None, kind='gauge'):
+		self.kind = kind # or 'counter', for totals that are kept somewhere else
+		self.name = name
+		self.help = help
+		self.function = function
+		self.label_name = label_name
+
+	def render(self):
+		value = self.function()
+		if type(value) == dict:
+			return ['%s%s %g' % (self.name, formatLabels(self.label_name, label), v) for label, v in value.items()]
+		return ['%s %g' % (self.name, value)]
+
+class MetricRegistry(object):
+	""" Every metric the server keeps, in the order they were made """
+	def __init__(self):
+		self.metrics = []
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, help, label_name=None):
+		return self.add(Counter(name, help, label_name))
+
+	def histogram(self, name, help, buckets=TimeBuckets):
+		return self.add(Histogram(name, help, buckets))
+
+	def gauge(self, name, help, function, label_name=None, kind='gauge'):
+		return self.add(Gauge(name, help, function, label_name, kind))
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines.append('# HELP %s %s' % (metric.name, metric.help))
+			lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+			try:
+				lines += metric.render()
+			except Exception as e:
+				# One broken gauge shouldn't take the rest with it
+				lines.append('# %s failed: %s' % (metric.name, repr(e)))
+		return '\n'.join(lines) + '\n'
+
+Metrics = MetricRegistry()
+
+MessagesIn     = Metrics.counter("tilemap_messages_received_total", "Messages received from clients, by command", "command")
+MessagesOut    = Metrics.counter("tilemap_messages_sent_total", "Messages sent to clients, by command", "command")
+BytesSent      = Metrics.counter("tilemap_bytes_sent_total", "Size of messages sent to clients, counting text by characters")
+BroadcastSize  = Metrics.histogram("tilemap_broadcast_recipients", "How many users on the map each broadcast went to", CountBuckets)
+DatabaseTime   = Metrics.histogram("tilemap_database_seconds", "Time the database thread spent on each piece of work")
+MapLoadTime    = Metrics.histogram("tilemap_map_load_seconds", "Time it took to load a map, including waiting for the database")
+MapSaveTime    = Metrics.histogram("tilemap_map_save_seconds", "Time the database thread took to encode a map's tiles to be saved")
+EventLoopLag   = Metrics.histogram("tilemap_event_loop_lag_seconds", "How late the event loop was to run a timer")
+
+async def metricsHandler(reader, writer):
+	""" Tiny HTTP server that answers GET /metrics """
+	try:
+		request = await asyncio.wait_for(reader.readline(), 5)
+		while True:
+			line = await asyncio.wait_for(reader.readline(), 5)
+			if line in (b'\r\n', b'\n', b''):
+				break
+		parts = request.decode('latin-1').split()
+		if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+			status = '200 OK'
+			body = Metrics.render().encode()
+		else:
+			status = '404 Not Found'
+			body = b'Not found\n'
+		writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode() + body)
+		await writer.drain()
+	except (asyncio.TimeoutError, ConnectionError):
+		pass
+	finally:
+		writer.close()
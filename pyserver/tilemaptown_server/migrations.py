@@ -0,0 +1,148 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Each migration brings the database schema up one version. The version the
+# database is at is kept in the Meta table, and every migration past that gets
+# run in order, each in its own transaction. Add new ones to the end of the list;
+# never change one that has already been released.
+
+Migrations = [
+	(1, "Original tables", [
+		"""create table if not exists Map (
+		mid integer primary key,
+		name text,
+		desc text,
+		owner integer,
+		flags integer,
+		regtime timestamp,
+		start_x integer,
+		start_y integer,
+		width integer,
+		height integer,
+		default_turf text,
+		allow integer,
+		deny integer,
+		guest_deny integer,
+		tags text,
+		data text
+		)""",
+
+		"""create table if not exists Map_Permission (
+		mid integer,
+		uid integer,
+		allow integer,
+		deny integer,
+		primary key(mid, uid)
+		)""",
+
+		"""create table if not exists Map_Log (
+		mid integer,
+		uid integer,
+		lid integer,
+		time timestamp,
+		action text,
+		info text,
+		primary key(mid, uid)
+		)""",
+
+		"""create table if not exists User (
+		uid integer primary key autoincrement,
+		passhash text,
+		passalgo text,
+		regtime timestamp,
+		lastseen timestamp,
+		username text,
+		name text,
+		pic text,
+		mid integer,
+		map_x integer,
+		map_y integer,
+		home text,
+		watch text,
+		ignore text,
+		client_settings text,
+		flags integer,
+		tags text
+		)""",
+
+		"""create table if not exists Asset_Info (
+		aid integer primary key,
+		name text,
+		desc text,
+		type integer,
+		flags integer,
+		creator integer,
+		regtime timestamp,
+		owner integer,
+		folder integer,
+		data integer
+		)""",
+
+		"""create table if not exists Mail (
+		id integer primary key,
+		uid integer,
+		sender integer,
+		recipients text,
+		subject text,
+		contents text,
+		time timestamp,
+		flags integer,
+		foreign key(uid) references User(uid) on delete cascade,
+		foreign key(sender) references User(uid) on delete set null
+		)""",
+	]),
+
+	(2, "Indexes for looking up users, inventories, mail and maps", [
+		# Logging in, /tell and everything else that goes from username to user
+		"create index if not exists User_username on User(username)",
+		# Inventory on login, and moving items between folders
+		"create index if not exists Asset_Info_owner on Asset_Info(owner, folder)",
+		# Mail on login
+		"create index if not exists Mail_uid on Mail(uid)",
+		# /mymaps
+		"create index if not exists Map_owner on Map(owner)",
+		# /publicmaps, which only needs the few maps that are public
+		"create index if not exists Map_public on Map(mid) where (flags&1)!=0",
+	]),
+]
+
+def schemaVersion(connection):
+	connection.execute("create table if not exists Meta (item text, value text)")
+	row = connection.execute("SELECT value FROM Meta WHERE item='version'").fetchone()
+	return int(row[0]) if row != None else 0
+
+def migrateDatabase(connection, target=None):
+	""" Run every migration the database doesn't have yet, up to target if given; returns the new version """
+	version = schemaVersion(connection)
+	connection.commit()
+	for number, description, statements in Migrations:
+		if number <= version or (target != None and number > target):
+			continue
+		print("Updating database to version %d: %s" % (number, description))
+		try:
+			connection.execute("BEGIN")
+			for sql in statements:
+				connection.execute(sql)
+			if version == 0:
+				connection.execute("INSERT INTO Meta (item, value) VALUES ('version', ?)", (str(number),))
+			else:
+				connection.execute("UPDATE Meta SET value=? WHERE item='version'", (str(number),))
+			connection.commit()
+		except:
+			connection.rollback()
+			raise
+		version = number
+	return version
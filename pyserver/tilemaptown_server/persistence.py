@@ -0,0 +1,93 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time, datetime
+from .buildglobal import *
+from .metrics import MapSaveTime
+
+class WriteBehind(object):
+	""" Collects users and maps that need saving and writes them all in one transaction """
+	def __init__(self):
+		self.users = {} # username -> client
+		self.maps = {}  # map id -> map
+		self.stats = {'flushes': 0, 'users_written': 0, 'maps_written': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+	def queue_depth(self):
+		return len(self.users) + len(self.maps)
+
+	def queue_user(self, client):
+		self.users[client.username] = client
+
+	def queue_map(self, map):
+		self.maps[map.id] = map
+
+	def flush_user(self, username):
+		""" Make sure the database is up to date for a user before reading them back """
+		if username in self.users:
+			self.flush()
+
+	def flush_map(self, map_id):
+		""" Make sure the database is up to date for a map before reading it back """
+		if map_id in self.maps:
+			self.flush()
+
+	def flush(self):
+		""" Queue everything that's waiting, plus any other pending changes, to be written and committed """
+		start = time.perf_counter()
+		users = self.users
+		maps = self.maps
+		self.users = {}
+		self.maps = {}
+
+		# Take the values now, since the objects can keep changing while the database thread works
+		user_values = [u.save_values() for u in users.values()]
+		map_values = [m.save_values() for m in maps.values()]
+		map_data = [(m.save_data(), m.id) for m in maps.values()]
+		map_data = [x for x in map_data if x[0] != None]
+		future = DB.submit(self.write, user_values, map_values, map_data)
+		future.add_done_callback(lambda future: self.flushed(future, start, len(users), len(maps)))
+		return future
+
+	def write(self, connection, user_values, map_values, map_data):
+		""" Runs on the database thread """
+		c = connection.cursor()
+		if len(user_values):
+			c.executemany("UPDATE User SET passhash=?, passalgo=?, name=?, pic=?, mid=?, map_x=?, map_y=?, home=?, watch=?, ignore=?, client_settings=?, tags=?, lastseen=? WHERE uid=?", user_values)
+		if len(map_values):
+			c.executemany("INSERT OR IGNORE INTO Map (regtime, mid) VALUES (?, ?)", [(datetime.datetime.now(), v[-1]) for v in map_values])
+			c.executemany("UPDATE Map SET name=?, desc=?, owner=?, flags=?, start_x=?, start_y=?, width=?, height=?, default_turf=?, allow=?, deny=?, guest_deny=?, tags=? WHERE mid=?", map_values)
+		if len(map_data):
+			c.executemany("UPDATE Map SET data=? WHERE mid=?", [(self.encode(make), mid) for make, mid in map_data])
+		connection.commit()
+
+	def encode(self, make):
+		start = time.perf_counter()
+		data = make()
+		MapSaveTime.time(start)
+		return data
+
+	def flushed(self, future, start, users_written, maps_written):
+		if future.exception() != None:
+			print("Couldn't save to the database:", future.exception())
+			return
+		elapsed = (time.perf_counter() - start) * 1000
+		self.stats['flushes'] += 1
+		self.stats['users_written'] += users_written
+		self.stats['maps_written'] += maps_written
+		self.stats['last_flush_ms'] = elapsed
+		self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed)
+
+Persist = WriteBehind()
@@ -0,0 +1,90 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path, sys, threading, time
+
+# Sampling profiler for finding out where the event loop spends its time on a
+# live server. A thread looks at the event loop's stack many times a second and
+# counts how often each stack shows up, then writes the counts out in the
+# "collapsed stack" format that flamegraph.pl and speedscope read:
+#   outermost;...;innermost count
+
+def frameName(code):
+	return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class SamplingProfiler(object):
+	""" Samples one thread's stack at a fixed rate and writes the totals to a file now and then """
+	def __init__(self):
+		self.counts = {} # collapsed stack -> samples
+		self.names = {}  # code object -> frame name, so each one is only formatted once
+		self.samples = 0
+		self.running = False
+		self.thread = None
+
+	def start(self, thread_id, rate, filename, write_interval):
+		if self.running:
+			return
+		self.thread_id = thread_id
+		self.rate = rate
+		self.filename = filename
+		self.write_interval = write_interval
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		""" Stop sampling and write what was collected """
+		self.running = False
+		if self.thread != None:
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		last_write = time.monotonic()
+		while self.running:
+			time.sleep(1 / self.rate)
+			self.sample()
+			if time.monotonic() - last_write >= self.write_interval:
+				self.write()
+				last_write = time.monotonic()
+		self.write()
+
+	def sample(self):
+		frame = sys._current_frames().get(self.thread_id)
+		names = []
+		while frame != None:
+			name = self.names.get(frame.f_code)
+			if name == None:
+				name = frameName(frame.f_code)
+				self.names[frame.f_code] = name
+			names.append(name)
+			frame = frame.f_back
+		if not len(names):
+			return
+		names.reverse()
+		stack = ';'.join(names)
+		self.counts[stack] = self.counts.get(stack, 0) + 1
+		self.samples += 1
+
+	def write(self):
+		try:
+			with open(self.filename, 'w') as f:
+				for stack, count in self.counts.items():
+					f.write('%s %d\n' % (stack, count))
+		except OSError as e:
+			print("Couldn't write profile:", e)
+
+Profiler = SamplingProfiler()
@@ -0,0 +1,72 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+# Clients earn tokens at a steady rate and spend them on every message they
+# send, so they can send short bursts but not keep up a flood. Commands that
+# make the server do a lot of work, or send a lot to other people, cost more.
+
+# Cost of each protocol message, or of a slash command written as "/name"
+DefaultCosts = {
+	'PIN': 0, 'MOV': 0.25, 'VEW': 0.25, 'WHO': 0.5,
+	'MSG': 1, 'PUT': 1, 'IMG': 0.5, 'TSD': 0.5, 'MAI': 0.5, 'DIF': 2, 'BAG': 2,
+	'DEL': 3, 'BLK': 5, 'EML': 5, 'IDN': 5,
+	'/roll': 2, '/tell': 1, '/msg': 1, '/p': 1,
+	'/newmap': 20, '/register': 10, '/login': 10, '/changepass': 10, '/savemap': 10,
+}
+
+# username (or ID, for guests) -> [messages delayed, messages dropped]
+RateLimitStats = {}
+
+class TokenBucket(object):
+	""" Holds up to burst tokens, refilled at rate tokens per second """
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.monotonic()
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def take(self, cost):
+		""" Spend tokens if there are enough; returns 0, or how many seconds until there will be enough """
+		self.refill()
+		if self.tokens >= cost:
+			self.tokens -= cost
+			return 0
+		return (cost - self.tokens) / self.rate
+
+	def spend(self, cost):
+		""" Spend tokens even if there aren't enough """
+		self.refill()
+		self.tokens -= cost
+
+def commandCost(costs, command, arg):
+	""" How many tokens a message from a client costs """
+	if command == "CMD" and type(arg) == dict and type(arg.get("text")) == str:
+		name = '/' + arg["text"].split(' ', 1)[0].lower()
+		if name in costs:
+			return costs[name]
+	return costs.get(command, 1)
+
+def countThrottle(who, dropped):
+	if who not in RateLimitStats:
+		RateLimitStats[who] = [0, 0]
+	RateLimitStats[who][1 if dropped else 0] += 1
@@ -0,0 +1,63 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rectangles of map tiles that come from clients. They get put in order,
+# clipped to the map and checked against size limits before anything touches
+# the tile grids, so a bad request gets an error instead of an exception.
+# Every operation also adds up how many cells it had to look at.
+
+RegionStats = {} # operation -> [times done, cells touched]
+
+def isInteger(value):
+	return type(value) == int
+
+def clipRegion(x1, y1, x2, y2, width, height):
+	""" Inclusive rectangle, in order and clipped to a width*height map, or None if none of it is on the map """
+	if not (isInteger(x1) and isInteger(y1) and isInteger(x2) and isInteger(y2)):
+		return None
+	if x2 < x1:
+		x1, x2 = x2, x1
+	if y2 < y1:
+		y1, y2 = y2, y1
+	x1 = max(x1, 0)
+	y1 = max(y1, 0)
+	x2 = min(x2, width-1)
+	y2 = min(y2, height-1)
+	if x1 > x2 or y1 > y2:
+		return None
+	return (x1, y1, x2, y2)
+
+def regionFromPos(pos, width, height):
+	""" Clipped rectangle from a client's [x1, y1, x2, y2] or [x, y], or None if it's invalid or off the map """
+	if type(pos) != list:
+		return None
+	if len(pos) == 2:
+		return clipRegion(pos[0], pos[1], pos[0], pos[1], width, height)
+	if len(pos) == 4:
+		return clipRegion(pos[0], pos[1], pos[2], pos[3], width, height)
+	return None
+
+def regionArea(region):
+	return (region[2]-region[0]+1) * (region[3]-region[1]+1)
+
+def countRegion(operation, cells):
+	""" Add to the cost accounting for an operation """
+	stats = RegionStats.get(operation)
+	if stats == None:
+		stats = [0, 0]
+		RegionStats[operation] = stats
+	stats[0] += 1
+	stats[1] += cells
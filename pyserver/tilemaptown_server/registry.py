@@ -0,0 +1,109 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Collections of connected clients and loaded maps that can be looked up by key.
+# They iterate like the sets they replace.
+
+class ClientRegistry(object):
+	""" Connected clients, indexed by session ID, username and database ID """
+	def __init__(self):
+		self.by_id = {}
+		self.by_username = {} # username -> set of clients, since an account can be logged in more than once
+		self.by_db_id = {}    # db_id -> set of clients
+		self.indexed = {}     # client -> (username, db_id) it's currently indexed under
+
+	def __iter__(self):
+		return iter(self.by_id.values())
+
+	def __len__(self):
+		return len(self.by_id)
+
+	def __contains__(self, client):
+		return client.id in self.by_id
+
+	def add(self, client):
+		self.by_id[client.id] = client
+		self.indexed[client] = (None, None)
+		self.update(client)
+
+	def remove(self, client):
+		self.unindex(client)
+		del self.indexed[client]
+		del self.by_id[client.id]
+
+	def unindex(self, client):
+		username, db_id = self.indexed[client]
+		if username != None:
+			self.by_username[username].discard(client)
+			if not len(self.by_username[username]):
+				del self.by_username[username]
+		if db_id != None:
+			self.by_db_id[db_id].discard(client)
+			if not len(self.by_db_id[db_id]):
+				del self.by_db_id[db_id]
+
+	def update(self, client):
+		""" Reindex a client after its username or database ID changed """
+		if client not in self.indexed or self.indexed[client] == (client.username, client.db_id):
+			return
+		self.unindex(client)
+		if client.username != None:
+			if client.username not in self.by_username:
+				self.by_username[client.username] = set()
+			self.by_username[client.username].add(client)
+		if client.db_id != None:
+			if client.db_id not in self.by_db_id:
+				self.by_db_id[client.db_id] = set()
+			self.by_db_id[client.db_id].add(client)
+		self.indexed[client] = (client.username, client.db_id)
+
+	def get_by_id(self, id):
+		return self.by_id.get(id)
+
+	def get_by_username(self, username):
+		clients = self.by_username.get(username)
+		if clients:
+			return next(iter(clients))
+		return None
+
+	def get_by_db_id(self, db_id):
+		clients = self.by_db_id.get(db_id)
+		if clients:
+			return next(iter(clients))
+		return None
+
+class MapRegistry(object):
+	""" Loaded maps, indexed by map ID """
+	def __init__(self):
+		self.by_id = {}
+
+	def __iter__(self):
+		return iter(self.by_id.values())
+
+	def __len__(self):
+		return len(self.by_id)
+
+	def __contains__(self, map):
+		return self.by_id.get(map.id) is map
+
+	def add(self, map):
+		self.by_id[map.id] = map
+
+	def remove(self, map):
+		del self.by_id[map.id]
+
+	def get(self, id):
+		return self.by_id.get(id)
@@ -0,0 +1,111 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time, bisect
+from .metrics import Metrics, formatHistogram, formatLabels
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LatencyBuckets = [0.1, 0.5, 1, 5, 10, 50, 100, 500, float('inf')]
+
+class CommandStats(object):
+	""" Call count, errors and a latency histogram for one command """
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.total_ms = 0.0
+		self.max_ms = 0.0
+		self.histogram = [0] * len(LatencyBuckets)
+
+	def record(self, elapsed_ms):
+		self.calls += 1
+		self.total_ms += elapsed_ms
+		self.max_ms = max(self.max_ms, elapsed_ms)
+		self.histogram[bisect.bisect_left(LatencyBuckets, elapsed_ms)] += 1
+
+	def percentile(self, fraction):
+		""" Upper bound of the bucket that the given fraction of calls fit within """
+		wanted = self.calls * fraction
+		seen = 0
+		for i, count in enumerate(self.histogram):
+			seen += count
+			if count and seen >= wanted:
+				return LatencyBuckets[i]
+		return 0
+
+class CommandRouter(object):
+	""" Looks up the handler for a command by name, and times every call to it """
+	def __init__(self, name):
+		self.name = name
+		self.handlers = {}
+		self.stats = {}
+
+	def register(self, *names):
+		""" Decorator that makes a function the handler for one or more command names """
+		def decorator(function):
+			for name in names:
+				self.handlers[name] = function
+			return function
+		return decorator
+
+	def __contains__(self, name):
+		return name in self.handlers
+
+	async def dispatch(self, name, *args):
+		""" Run the handler for a command; returns False if there isn't one """
+		handler = self.handlers.get(name)
+		if handler == None:
+			return False
+		stats = self.stats.get(name)
+		if stats == None:
+			stats = CommandStats()
+			self.stats[name] = stats
+
+		start = time.perf_counter()
+		try:
+			await handler(*args)
+		except Exception:
+			stats.errors += 1
+			raise
+		finally:
+			stats.record((time.perf_counter() - start) * 1000)
+		return True
+
+ProtocolCommands = CommandRouter("protocol")
+SlashCommands = CommandRouter("command")
+
+class RouterMetrics(object):
+	""" Shows the timing for every command in the metrics, as one histogram per command """
+	kind = 'histogram'
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+
+	def render(self):
+		lines = []
+		buckets = [bound / 1000 for bound in LatencyBuckets[:-1]]
+		for label, stats in commandStats():
+			lines += formatHistogram(self.name, formatLabels('command', label), buckets, stats.histogram, stats.total_ms / 1000)
+		return lines
+
+def commandStats():
+	""" (name, stats) for every command that has run, with slash commands written as "/name" """
+	for name, stats in ProtocolCommands.stats.items():
+		yield (name, stats)
+	for name, stats in SlashCommands.stats.items():
+		yield ('/' + name, stats)
+
+Metrics.add(RouterMetrics("tilemap_command_seconds", "Time spent running each kind of message or command"))
+Metrics.gauge("tilemap_command_errors_total", "Messages or commands that failed with an error", lambda: {label: stats.errors for label, stats in commandStats()}, "command", "counter")
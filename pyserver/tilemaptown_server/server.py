@@ -14,66 +14,67 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio, datetime, random, websockets, json, sys
+import asyncio, datetime, random, websockets, json, sys, threading
 from .buildglobal import *
 from .buildmap import *
 from .buildclient import *
+from .metrics import Metrics, MessagesIn, EventLoopLag, metricsHandler
+from .router import ProtocolCommands
+from .ratelimit import RateLimitStats
+from .watchdog import Watchdog
+from .profiler import Profiler
 if Config["Database"]["Setup"]:
 	from .database_setup import *
 
-# Timer that runs and performs background tasks
-def mainTimer():
-	global ServerShutdown
+Metrics.gauge("tilemap_clients", "Connected clients", lambda: len(AllClients))
+Metrics.gauge("tilemap_maps_loaded", "Maps currently loaded", lambda: len(AllMaps))
+Metrics.gauge("tilemap_map_users", "Users on each loaded map", lambda: {m.id: len(m.users) for m in AllMaps}, "map")
+Metrics.gauge("tilemap_outbox_messages", "Messages waiting to be sent, across every client", lambda: sum(len(c.outbox) for c in AllClients))
+Metrics.gauge("tilemap_outbox_bytes", "Size of the messages waiting to be sent, across every client", lambda: sum(c.outbox_bytes for c in AllClients))
+Metrics.gauge("tilemap_outbox_max_messages", "Most messages waiting to be sent to any one client", lambda: max([len(c.outbox) for c in AllClients], default=0))
+Metrics.gauge("tilemap_outbox_events_total", "Messages dropped or coalesced and clients evicted because of full outboxes", lambda: OutboxStats, "event", "counter")
+Metrics.gauge("tilemap_map_cache_maps", "Empty maps kept loaded in case someone comes back", lambda: len(MapCache))
+Metrics.gauge("tilemap_map_cache_bytes", "Rough size of the empty maps kept loaded", lambda: MapCache.bytes)
+Metrics.gauge("tilemap_map_cache_total", "Map cache hits (reloads avoided), misses (maps loaded from the database), and maps unloaded for being idle or to make room", lambda: MapCache.stats, "result", "counter")
+Metrics.gauge("tilemap_database_pending", "Pieces of work queued for the database thread", lambda: DB.pending)
+Metrics.gauge("tilemap_save_queue", "Users and maps waiting for the next save", lambda: Persist.queue_depth())
+Metrics.gauge("tilemap_permission_cache_total", "Permission cache hits and misses", lambda: PermissionCacheStats, "result", "counter")
+Metrics.gauge("tilemap_rate_limited_total", "Messages delayed or dropped by rate limiting", lambda: {'delayed': sum(c[0] for c in RateLimitStats.values()), 'dropped': sum(c[1] for c in RateLimitStats.values())}, "action", "counter")
+
+# Timer that writes queued saves to the database
+def persistTimer():
+	global loop
+
+	with Watchdog.watch("Saving"):
+		Persist.flush()
+
+	if ServerShutdown[0] != 0:
+		loop.call_later(Config["Database"]["FlushInterval"], persistTimer)
+
+# Timer that sends out all of the movement on each map at a fixed rate
+def moveTimer():
 	global loop
 
-	# Disconnect pinged-out users
-	for c in AllClients:
-		# Remove requests that time out
-		remove_requests = set()
-		for k,v in c.requests.items():
-			v[0] -= 1 # remove 1 from timer
-			if v[0] < 0:
-				remove_requests.add(k)
-		for r in remove_requests:
-			del c.requests[r]
-
-		c.idle_timer += 1
-
-		# Remove users that time out
-		c.ping_timer -= 1
-		if c.ping_timer == 60 or c.ping_timer == 30:
-			c.send("PIN", None)
-		elif c.ping_timer < 0:
-			c.disconnect()
-
-	# Unload unused maps
-	unloaded = set()
 	for m in AllMaps:
-		if (m.id not in Config["Server"]["AlwaysLoadedMaps"]) and (len(m.users) < 1):
-			print("Unloading map "+str(m.id))
-			m.save()
-			m.clean_up()
-			unloaded.add(m)
-	for m in unloaded:
-		AllMaps.remove(m)
-
-	# Run server shutdown timer, if it's running
-	if ServerShutdown[0] > 0:
-		ServerShutdown[0] -= 1
-		if ServerShutdown[0] == 1:
-			broadcastToAll("Server is going down!")
-			for u in AllClients:
-				u.disconnect()
-			for m in AllMaps:
-				m.save()
-		elif ServerShutdown[0] == 0:
-			loop.stop()
+		m.flush_moves()
+
 	if ServerShutdown[0] != 0:
-		loop.call_later(1, mainTimer)
+		loop.call_later(1 / Config["Server"]["MoveTickRate"], moveTimer)
+
+# Timer that measures how late the event loop is to run things
+def lagTimer(expected):
+	global loop
+
+	EventLoopLag.observe(max(0, loop.time() - expected))
+
+	if ServerShutdown[0] != 0:
+		loop.call_later(1, lagTimer, loop.time() + 1)
 
 # Websocket connection handler
 async def clientHandler(websocket, path):
 	client = Client(websocket)
+	client.start_writer()
+	client.keep_alive(180)
 
 	AllClients.add(client)
 
@@ -90,25 +91,32 @@ async def clientHandler(websocket, path):
 			arg = None
 			if len(message) > 4:
 				arg = json.loads(message[4:])
+			MessagesIn.inc(command if command in ProtocolCommands or command in ("IDN", "PIN") else "other")
+
+			# Keep one client from flooding the server
+			if not await client.throttle(command, arg):
+				continue
 
 			# Identify the user and put them on a map
 			if command == "IDN":
 				result = False
-				if arg != None:
-					result = client.login(filterUsername(arg["username"]), arg["password"])
+				if arg != None and "features" in arg:
+					client.send("IDN", {'features': client.set_features(arg["features"])})
+				if arg != None and "username" in arg:
+					result = await client.login(filterUsername(arg["username"]), arg["password"])
 				if result != True: # default to map 0 if can't log in
-					client.switch_map(0)
+					await client.switch_map(0)
 				if len(Config["Server"]["MOTD"]):
 					client.send("MSG", {'text': Config["Server"]["MOTD"]})
 				client.send("MSG", {'text': 'Users connected: %d' % len(AllClients)})
 			elif command == "PIN":
-				client.ping_timer = 300
+				client.keep_alive(300)
 
 			# Don't allow the user to go any further if they're not on a map
 			if client.map_id == -1:
 				continue
 			# Send the command through to the map
-			client.map.receive_command(client, command, arg)
+			await client.map.receive_command(client, command, arg)
 
 	except websockets.ConnectionClosed:
 		print("disconnected")
@@ -118,27 +126,40 @@ async def clientHandler(websocket, path):
 
 	client.cleanup()
 	if client.username:
-		client.save()
+		await client.save()
 
 	# remove the user from all clients' views
 	if client.map != None:
 		client.map.users.remove(client)
+		client.map.interest.remove(client)
 		client.map.broadcast("WHO", {'remove': client.id})
+		client.map.schedule_unload()
 	AllClients.remove(client)
 
 global loop
 
 def main():
 	global loop
-	start_server = websockets.serve(clientHandler, None, Config["Server"]["Port"], max_size=Config["Server"]["WSMaxSize"], max_queue=Config["Server"]["WSMaxQueue"])
+	start_server = websockets.serve(clientHandler, None, Config["Server"]["Port"], max_size=Config["Server"]["WSMaxSize"], max_queue=Config["Server"]["WSMaxQueue"], compression="deflate" if Config["Server"]["WSCompression"] else None)
 
 	# Start the event loop
 	loop = asyncio.get_event_loop()
-	loop.call_soon(mainTimer)
+	loop.call_later(Config["Database"]["FlushInterval"], persistTimer)
+	if Config["Server"]["MoveTickRate"] > 0:
+		loop.call_soon(moveTimer)
+	loop.call_later(1, lagTimer, loop.time() + 1)
 	loop.run_until_complete(start_server)
+	if Config["Metrics"]["Port"]:
+		loop.run_until_complete(asyncio.start_server(metricsHandler, Config["Metrics"]["Host"], Config["Metrics"]["Port"]))
+	if Config["Watchdog"]["Threshold"] > 0:
+		Watchdog.start(loop, Config["Watchdog"]["Threshold"], Config["Watchdog"]["Interval"])
+	if Config["Watchdog"]["Profile"]:
+		Profiler.start(threading.get_ident(), Config["Watchdog"]["ProfileRate"], Config["Watchdog"]["ProfileFile"], Config["Watchdog"]["ProfileInterval"])
 	print("Server started!")
 	loop.run_forever()
-	Database.close()
+	Profiler.stop()
+	Persist.flush()
+	DB.close()
 
 if __name__ == "__main__":
 	main()
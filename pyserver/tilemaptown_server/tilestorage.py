@@ -0,0 +1,249 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array, json
+
+# Tile storage backends for Map.turfs and Map.objs.
+# Every backend stores a width*height grid where each cell holds a tile
+# (a string, a dictionary, or for objects a list of those) or None.
+
+def tileKey(tile):
+	""" Hashable key that identifies a tile value """
+	if type(tile) == str:
+		return tile
+	# Wrap non-strings in a tuple so they can't collide with string tiles
+	return (json.dumps(tile, sort_keys=True),)
+
+class ListTileGrid(object):
+	""" The original storage: a list of columns, each a list of tiles """
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.columns = []
+		for x in range(0, width):
+			self.columns.append([None] * height)
+
+	def check(self, x, y):
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			raise IndexError('tile position out of range')
+
+	def get(self, x, y):
+		self.check(x, y)
+		return self.columns[x][y]
+
+	def set(self, x, y, tile):
+		self.check(x, y)
+		self.columns[x][y] = tile
+
+	def fill(self, x1, y1, x2, y2, tile):
+		""" Set every cell in the inclusive rectangle to one tile """
+		if x2 < x1 or y2 < y1:
+			return
+		self.check(x1, y1)
+		self.check(x2, y2)
+		for x in range(x1, x2+1):
+			self.columns[x][y1:y2+1] = [tile] * (y2-y1+1)
+
+	def section(self, x1, y1, x2, y2):
+		""" List of [x, y, tile] for every non-empty cell in the inclusive rectangle """
+		if x2 < x1 or y2 < y1:
+			return []
+		self.check(x1, y1)
+		self.check(x2, y2)
+		out = []
+		for x in range(x1, x2+1):
+			column = self.columns[x]
+			for y in range(y1, y2+1):
+				if column[y] != None:
+					out.append([x, y, column[y]])
+		return out
+
+	def items(self):
+		return self.section(0, 0, self.width-1, self.height-1)
+
+	def pack(self):
+		""" (palette, array of palette indexes) for the whole grid, in the same layout ArrayTileGrid uses """
+		palette = [None]
+		palette_index = {}
+		cells = array.array('I', [0]) * (self.width * self.height)
+		i = 0
+		for column in self.columns:
+			for tile in column:
+				if tile != None:
+					key = tileKey(tile)
+					index = palette_index.get(key)
+					if index == None:
+						index = len(palette)
+						palette.append(tile)
+						palette_index[key] = index
+					cells[i] = index
+				i += 1
+		return (palette, cells)
+
+	def unpack(self, palette, cells):
+		""" Replace the whole grid with the output of pack() """
+		height = self.height
+		self.columns = [[palette[index] for index in cells[x*height:(x+1)*height]] for x in range(self.width)]
+
+	def snapshot(self):
+		""" Copy of the grid that another thread can pack() while this one keeps changing """
+		copy = ListTileGrid(0, 0)
+		copy.width = self.width
+		copy.height = self.height
+		copy.columns = [list(column) for column in self.columns]
+		return copy
+
+	def compact(self):
+		pass
+
+	def memory_size(self):
+		""" Rough number of bytes used, not counting the tiles themselves """
+		return 8 * self.width * self.height
+
+class ArrayTileGrid(object):
+	""" Compact storage: a palette of unique tiles plus a flat array of palette indexes """
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+
+		# Index 0 always means "no tile here"
+		self.palette = [None]
+		self.palette_index = {}
+		# Tiles that get painted over stay in the palette, so clean it up once it's grown this big
+		self.compact_at = self.compact_limit(1)
+
+		# Column-major, so that cell (x, y) is at x*height+y
+		self.cells = array.array('H', [0]) * (width * height)
+
+	def check(self, x, y):
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			raise IndexError('tile position out of range')
+
+	def intern(self, tile):
+		""" Get the palette index for a tile, adding it to the palette if needed """
+		if tile == None:
+			return 0
+		key = tileKey(tile)
+		index = self.palette_index.get(key)
+		if index == None:
+			if len(self.palette) >= self.compact_at:
+				self.compact()
+			index = len(self.palette)
+			self.palette.append(tile)
+			self.palette_index[key] = index
+			# Switch to wider indexes once 16 bits isn't enough
+			if index >= 0xffff and self.cells.typecode == 'H':
+				self.cells = array.array('I', self.cells)
+		return index
+
+	def get(self, x, y):
+		self.check(x, y)
+		return self.palette[self.cells[x*self.height+y]]
+
+	def set(self, x, y, tile):
+		self.check(x, y)
+		self.cells[x*self.height+y] = self.intern(tile)
+
+	def fill(self, x1, y1, x2, y2, tile):
+		""" Set every cell in the inclusive rectangle to one tile """
+		if x2 < x1 or y2 < y1:
+			return
+		self.check(x1, y1)
+		self.check(x2, y2)
+		# Intern first, since it can change the array's type
+		index = self.intern(tile)
+		run = array.array(self.cells.typecode, [index]) * (y2-y1+1)
+		for x in range(x1, x2+1):
+			base = x*self.height
+			self.cells[base+y1:base+y2+1] = run
+
+	def section(self, x1, y1, x2, y2):
+		""" List of [x, y, tile] for every non-empty cell in the inclusive rectangle """
+		if x2 < x1 or y2 < y1:
+			return []
+		self.check(x1, y1)
+		self.check(x2, y2)
+		out = []
+		palette = self.palette
+		cells = self.cells
+		for x in range(x1, x2+1):
+			base = x*self.height
+			y = y1
+			for index in cells[base+y1:base+y2+1]:
+				if index:
+					out.append([x, y, palette[index]])
+				y += 1
+		return out
+
+	def items(self):
+		return self.section(0, 0, self.width-1, self.height-1)
+
+	def pack(self):
+		""" (palette, array of palette indexes) for the whole grid; these are the grid's own, so don't modify them """
+		return (self.palette, self.cells)
+
+	def unpack(self, palette, cells):
+		""" Replace the whole grid with the output of pack() """
+		self.palette = palette
+		self.palette_index = {}
+		for index in range(1, len(palette)):
+			self.palette_index[tileKey(palette[index])] = index
+		if len(palette) <= 0xffff and cells.typecode != 'H':
+			cells = array.array('H', cells)
+		self.cells = cells
+		self.compact_at = self.compact_limit(len(palette))
+
+	def snapshot(self):
+		""" Copy of the grid that another thread can pack() while this one keeps changing """
+		copy = ArrayTileGrid(0, 0)
+		copy.width = self.width
+		copy.height = self.height
+		copy.palette = list(self.palette)
+		copy.cells = array.array(self.cells.typecode, self.cells)
+		return copy
+
+	def memory_size(self):
+		""" Rough number of bytes used, counting each palette entry as a small tile """
+		return self.cells.itemsize * len(self.cells) + 100 * len(self.palette)
+
+	def compact(self):
+		""" Drop palette entries that no cell uses anymore """
+		used = set(self.cells)
+		used.discard(0)
+		self.compact_at = self.compact_limit(len(used) + 1)
+		if len(used) + 1 == len(self.palette):
+			return
+		remap = array.array('I', [0]) * len(self.palette)
+		palette = [None]
+		self.palette_index = {}
+		for index in sorted(used):
+			remap[index] = len(palette)
+			self.palette_index[tileKey(self.palette[index])] = len(palette)
+			palette.append(self.palette[index])
+		self.palette = palette
+		remap = remap.tolist()
+		self.cells = array.array('H' if len(palette) <= 0xffff else 'I', [remap[index] for index in self.cells])
+
+	def compact_limit(self, palette_size):
+		""" Palette size to compact at next; compacting scans every cell, so wait until the palette has doubled,
+		and on big maps until enough new tiles were added to make that worth it """
+		return max(256, 2 * palette_size, self.width * self.height // 256)
+
+TileStorageBackends = {'list': ListTileGrid, 'array': ArrayTileGrid}
+
+def makeTileGrid(width, height, backend='array'):
+	""" Make an empty tile grid with the requested backend """
+	return TileStorageBackends[backend](width, height)
@@ -0,0 +1,140 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections, datetime, sys, threading, time, traceback
+
+# Finds out what the server was doing when it froze. The event loop sets a
+# heartbeat several times a second, and a separate thread checks on it; if the
+# heartbeat is late, the watchdog thread takes a look at the event loop's stack.
+# Slow synchronous work on any thread (saving, something on the database
+# thread) can also be watched directly, with a description.
+
+class SlowWatchdog(object):
+	""" Notices when the event loop or a watched piece of work takes too long, and records a stack sample """
+	def __init__(self):
+		self.threshold = None # seconds, or None if the watchdog isn't running
+		self.interval = None
+		self.loop = None
+		self.loop_thread = None
+		self.next_beat = None   # when the event loop's next heartbeat should happen
+		self.loop_report = None # report for the event loop being stuck right now
+		self.busy = {}          # thread ID -> watched work, as [description, start time, report]
+		self.labels = {}        # code object -> function that describes what a frame is doing, from its local variables
+		self.reports = collections.deque(maxlen=50)
+		self.thread = None
+
+	def start(self, loop, threshold, interval):
+		""" Start the watchdog thread; call from the event loop's thread """
+		if self.thread != None:
+			return
+		self.loop = loop
+		self.loop_thread = threading.get_ident()
+		self.threshold = threshold
+		self.interval = interval
+		self.beat()
+		self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+		self.thread.start()
+
+	def beat(self):
+		""" Heartbeat, run on the event loop """
+		now = time.monotonic()
+		if self.loop_report != None:
+			# Now the loop is unstuck, it's known how long it was stuck for
+			self.loop_report['ms'] = (now - self.loop_report['since']) * 1000
+			self.loop_report = None
+		self.next_beat = now + self.interval
+		self.loop.call_later(self.interval, self.beat)
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.check()
+			except Exception as e:
+				print("Watchdog error:", repr(e))
+
+	def check(self):
+		now = time.monotonic()
+		frames = None
+		for ident, work in list(self.busy.items()):
+			if work[2] == None and now - work[1] > self.threshold:
+				frames = frames or sys._current_frames()
+				work[2] = self.report(work[0], now - work[1], frames.get(ident))
+		if self.loop_report == None and self.next_beat != None and now - self.next_beat > self.threshold:
+			watched = self.busy.get(self.loop_thread)
+			if watched != None and watched[2] != None:
+				return # already reported as watched work
+			frames = frames or sys._current_frames()
+			self.loop_report = self.report('Event loop blocked', now - self.next_beat, frames.get(self.loop_thread))
+			self.loop_report['since'] = self.next_beat
+
+	def report(self, what, seconds, frame=None):
+		""" Record that something was slow, with a stack sample if there's a frame to take it from """
+		report = {'what': what, 'ms': seconds * 1000, 'time': datetime.datetime.now(), 'context': self.describe(frame), 'stack': []}
+		if frame != None:
+			report['stack'] = traceback.format_stack(frame)
+		self.reports.append(report)
+		print("Slow: %s%s, %d ms%s" % (what, ' (%s)' % report['context'] if report['context'] else '', report['ms'], ' so far' if frame != None else ''))
+		if len(report['stack']):
+			print(''.join(report['stack']).rstrip())
+		return report
+
+	def describe(self, frame):
+		""" Describe what the innermost labeled function on the stack is doing """
+		while frame != None:
+			label = self.labels.get(frame.f_code)
+			if label != None:
+				try:
+					return label(frame.f_locals)
+				except Exception:
+					return None
+			frame = frame.f_back
+		return None
+
+	def label(self, function, describe):
+		""" When function is on a slow stack, describe(its local variables) says what it was doing """
+		self.labels[function.__code__] = describe
+
+	def watch(self, what):
+		return WatchedWork(self, what)
+
+class WatchedWork(object):
+	""" Context manager for synchronous work the watchdog should keep an eye on """
+	def __init__(self, watchdog, what):
+		self.watchdog = watchdog
+		self.what = what
+
+	def __enter__(self):
+		self.ident = threading.get_ident()
+		self.work = [self.what, time.monotonic(), None]
+		self.outer = self.watchdog.busy.get(self.ident)
+		self.watchdog.busy[self.ident] = self.work
+		return self
+
+	def __exit__(self, *exc):
+		elapsed = time.monotonic() - self.work[1]
+		if self.outer != None:
+			self.watchdog.busy[self.ident] = self.outer
+		else:
+			self.watchdog.busy.pop(self.ident, None)
+		if self.work[2] != None:
+			self.work[2]['ms'] = elapsed * 1000
+		elif self.watchdog.threshold != None and elapsed > self.watchdog.threshold:
+			# Finished between checks, so there's no stack for it
+			self.watchdog.report(self.what, elapsed)
+		return False
+
+Watchdog = SlowWatchdog()
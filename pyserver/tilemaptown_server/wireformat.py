@@ -0,0 +1,210 @@
+# Tilemap Town
+# Copyright (C) 2017-2018 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+# Binary framing for the biggest messages, for clients that ask for it with
+# the "binary" feature in IDN. A binary websocket message starts with the same
+# three letters as the text version, followed by:
+#
+# MAP: x1, y1, x2, y2, default turf, palette, turf count, (x, y, palette index) for each turf,
+#      object count, (x, y, palette index) for each object
+# BLK: palette, turf count, (x, y, palette index, width, height) for each turf rectangle,
+#      object count, the same for each object rectangle, username
+# MOV: count, then for each user (id, x, y, 0) if the server moved them, or (id, x, y, 1, from x, from y)
+#
+# Numbers are unsigned LEB128 varints, with coordinates zigzag encoded first so they can be negative.
+# Strings are a length then UTF-8 text. Tiles are strings of JSON text.
+# A palette is a count followed by that many tiles, and palette indexes count from 0.
+
+def writeVarint(out, value):
+	if value < 0:
+		raise ValueError('varints must not be negative')
+	while value >= 0x80:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+def writeSigned(out, value):
+	writeVarint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+def writeString(out, text):
+	data = text.encode()
+	writeVarint(out, len(data))
+	out += data
+
+class Palette(object):
+	""" Tiles in the order they're first used, so each one is only written once """
+	def __init__(self):
+		self.tiles = []
+		self.index = {}
+
+	def add(self, tile):
+		text = json.dumps(tile)
+		index = self.index.get(text)
+		if index == None:
+			index = len(self.tiles)
+			self.tiles.append(text)
+			self.index[text] = index
+		return index
+
+	def write(self, out):
+		writeVarint(out, len(self.tiles))
+		for text in self.tiles:
+			writeString(out, text)
+
+def encodeMAP(params):
+	palette = Palette()
+	turfs = [(t[0], t[1], palette.add(t[2])) for t in params['turf']]
+	objs = [(o[0], o[1], palette.add(o[2])) for o in params['obj']]
+
+	out = bytearray()
+	for n in params['pos']:
+		writeSigned(out, n)
+	writeString(out, json.dumps(params['default']))
+	palette.write(out)
+	for entries in (turfs, objs):
+		writeVarint(out, len(entries))
+		for x, y, index in entries:
+			writeSigned(out, x)
+			writeSigned(out, y)
+			writeVarint(out, index)
+	return out
+
+def encodeBLK(params):
+	palette = Palette()
+	layers = []
+	for name in ('turf', 'obj'):
+		rects = []
+		for r in params.get(name, ()):
+			if len(r) == 5:
+				rects.append((r[0], r[1], palette.add(r[2]), r[3], r[4]))
+			else:
+				rects.append((r[0], r[1], palette.add(r[2]), 1, 1))
+		layers.append(rects)
+
+	out = bytearray()
+	palette.write(out)
+	for rects in layers:
+		writeVarint(out, len(rects))
+		for x, y, index, width, height in rects:
+			writeSigned(out, x)
+			writeSigned(out, y)
+			writeVarint(out, index)
+			writeVarint(out, width)
+			writeVarint(out, height)
+	writeString(out, params.get('username') or '')
+	return out
+
+def encodeMOV(params):
+	out = bytearray()
+	writeVarint(out, len(params['list']))
+	for move in params['list']:
+		writeVarint(out, move[0])
+		writeSigned(out, move[1])
+		writeSigned(out, move[2])
+		if len(move) == 5:
+			out.append(1)
+			writeSigned(out, move[3])
+			writeSigned(out, move[4])
+		else:
+			out.append(0)
+	return out
+
+BinaryCommands = {'MAP': encodeMAP, 'BLK': encodeBLK, 'MOV': encodeMOV}
+
+# Optional protocol features a client can ask for in IDN
+ProtocolFeatures = set(['binary'])
+
+def encodeBinaryCommand(commandType, commandParams):
+	""" Binary version of a command, or None if it has to go out as text """
+	encoder = BinaryCommands.get(commandType)
+	# Listener messages and single moves stay as text
+	if encoder == None or commandParams == None or 'remote_map' in commandParams:
+		return None
+	if commandType == 'MOV' and 'list' not in commandParams:
+		return None
+	try:
+		return commandType.encode() + encoder(commandParams)
+	except (KeyError, IndexError, TypeError, ValueError):
+		# Anything unusual, like fractional coordinates, is left for JSON to deal with
+		return None
+
+# Reading binary messages, for bots and other clients written in Python
+
+class Reader(object):
+	def __init__(self, data, offset=0):
+		self.data = data
+		self.offset = offset
+
+	def varint(self):
+		value = 0
+		shift = 0
+		while True:
+			byte = self.data[self.offset]
+			self.offset += 1
+			value |= (byte & 0x7f) << shift
+			if byte < 0x80:
+				return value
+			shift += 7
+
+	def signed(self):
+		value = self.varint()
+		return (value >> 1) if not (value & 1) else -((value + 1) >> 1)
+
+	def string(self):
+		length = self.varint()
+		text = self.data[self.offset:self.offset+length].decode()
+		self.offset += length
+		return text
+
+	def palette(self):
+		return [json.loads(self.string()) for i in range(self.varint())]
+
+def decodeMAP(r):
+	pos = [r.signed() for i in range(4)]
+	default = json.loads(r.string())
+	palette = r.palette()
+	turfs = [[r.signed(), r.signed(), palette[r.varint()]] for i in range(r.varint())]
+	objs = [[r.signed(), r.signed(), palette[r.varint()]] for i in range(r.varint())]
+	return {'pos': pos, 'default': default, 'turf': turfs, 'obj': objs}
+
+def decodeBLK(r):
+	palette = r.palette()
+	out = {}
+	for name in ('turf', 'obj'):
+		out[name] = [[r.signed(), r.signed(), palette[r.varint()], r.varint(), r.varint()] for i in range(r.varint())]
+	out['username'] = r.string()
+	return out
+
+def decodeMOV(r):
+	moves = []
+	for i in range(r.varint()):
+		move = [r.varint(), r.signed(), r.signed()]
+		if r.data[r.offset]:
+			r.offset += 1
+			move += [r.signed(), r.signed()]
+		else:
+			r.offset += 1
+		moves.append(move)
+	return {'list': moves}
+
+BinaryDecoders = {'MAP': decodeMAP, 'BLK': decodeBLK, 'MOV': decodeMOV}
+
+def decodeBinaryCommand(data):
+	""" (command type, parameters) for a binary message """
+	commandType = data[0:3].decode()
+	return (commandType, BinaryDecoders[commandType](Reader(data, 3)))